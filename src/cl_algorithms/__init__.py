@@ -1,3 +1,4 @@
 from .experience_replay import ExperienceReplayMemory
 from .ewc import EWC
-from .adapters import AdapterHandler
\ No newline at end of file
+from .adapters import AdapterHandler
+from .frozen_encoder import FrozenEncoderFeatureCache
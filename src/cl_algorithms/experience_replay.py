@@ -1,4 +1,5 @@
 import argparse
+import math
 import random
 import logging
 from typing import List, Dict
@@ -6,7 +7,10 @@ from typing import List, Dict
 import torch
 from torch import nn
 from torch.optim import AdamW
+from torch.utils.data import DataLoader
 
+from data.batch_samplers import ReplayBatchSampler
+from data.parallel_loading import build_batched_dataloader
 from modeling.continual_learner import ContinualLearner
 from train.visionlanguage_tasks.task_trainer import TaskTrainer
 from utils.wandb import wandb_logger
@@ -81,6 +85,9 @@ class TaskMemoryBuffer:
 
         '''
         Creates a memory buffer for new task, which samples a small percentage of training data for experience replay
+
+        Replay batches are sampled with replacement from the memory, and loaded and collated by the buffer's own DataLoader workers
+        (args.replay_num_workers), which keep up to args.replay_prefetch_batches batches ready in between replay steps
         '''
 
         self.task_key = task_key
@@ -93,7 +100,7 @@ class TaskMemoryBuffer:
         if task_key == 'nlvr2':
             self.batch_size = int(args.batch_size/2)
         elif task_key == 'vcr':
-            self.batch_size = int(args.batch_size/4)
+            self.batch_size = int(args.batch_size/task_config['batch_size_divisor'])
         else:
             self.batch_size = args.batch_size
 
@@ -112,11 +119,27 @@ class TaskMemoryBuffer:
 
         logger.info("Created {} replay memory buffer, with {} samples in the memory".format(self.task_name, len(self.memory_idxs)))
 
+        # The workers start loading replay batches right away, while the next tasks are trained
+        self.replay_dataloader = self.create_replay_dataloader(args.replay_num_workers, args.replay_prefetch_batches)
+        self.replay_batches = iter(self.replay_dataloader)
+
     def __len__(self):
         return len(self.memory_idxs)
 
-    def sample_replay_batch(self) -> Dict:
+    def create_replay_dataloader(self, num_workers: int, prefetch_batches: int) -> DataLoader:
+        '''
+        Creates an endless DataLoader of replay batches. With num_workers=0, batches are loaded in the main process when they are sampled
+        '''
+
+        loader_kwargs = {}
+        if num_workers > 0:
+            # Each worker keeps prefetch_factor batches ready, so the queue holds about prefetch_batches batches in total
+            loader_kwargs['prefetch_factor'] = max(1, math.ceil(prefetch_batches / num_workers))
+        return build_batched_dataloader(self.dataset,
+                                        ReplayBatchSampler(self.memory_idxs, self.batch_size),
+                                        collate_fn=self.batch_collate_fn,
+                                        num_workers=num_workers,
+                                        **loader_kwargs)
 
-        sampled_instances = random.sample(self.memory_idxs, self.batch_size)
-        batch = self.batch_collate_fn([self.dataset[i] for i in sampled_instances])
-        return batch
+    def sample_replay_batch(self) -> Dict:
+        return next(self.replay_batches)
@@ -0,0 +1,152 @@
+import argparse
+import logging
+import os
+from tqdm import tqdm
+from typing import List, Dict
+
+import numpy as np
+import torch
+from torch.utils.data import Dataset, DataLoader
+
+from data.parallel_loading import build_batched_dataloader, get_default_batch_sampler, get_batch_size
+from modeling.continual_learner import EncoderWrapper, ContinualLearner
+from utils.tensor_cache import example_ids_digest, state_dict_hash
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(
+        format='%(asctime)s - %(levelname)s - %(name)s - %(message)s',
+        datefmt='%m/%d/%Y %H:%M:%S',
+        level=logging.INFO)
+
+def feature_batch_collate(batch: List[Dict]) -> Dict:
+    '''
+    Collates cached encoder features and targets: tensors are stacked, ints are converted to a LongTensor, everything else is kept as a list
+    '''
+
+    collated_batch = {}
+    for key in batch[0].keys():
+        values = [x[key] for x in batch]
+        if torch.is_tensor(values[0]):
+            collated_batch[key] = torch.stack(values, dim=0)
+        elif isinstance(values[0], int):
+            collated_batch[key] = torch.LongTensor(values)
+        else:
+            collated_batch[key] = values
+    return collated_batch
+
+class CachedFeatureDataset(Dataset):
+
+    def __init__(self, dataset: Dataset, features_file: str):
+        '''
+        Dataset of cached encoder features, together with the targets of the original dataset
+
+        Args:
+        dataset: original task dataset, which implements get_target(index) - returns the (uncollated) target fields of an example,
+                 and get_example_ids() - returns the ids of all examples, in order
+        features_file: .npy file with one row of encoder features for every example in dataset
+        '''
+
+        self.dataset = dataset
+        self.features = np.load(features_file, mmap_mode='r')
+        assert len(self.features) == len(self.dataset)
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, index: int) -> Dict:
+        item = self.dataset.get_target(index)
+        item['encoder_features'] = torch.from_numpy(np.array(self.features[index]))
+        return item
+
+class FrozenEncoderFeatureCache:
+
+    def __init__(self, args: argparse.Namespace, model: ContinualLearner):
+        '''
+        With a frozen encoder, the encoder outputs of every example never change.
+        This class runs the frozen encoder once over each task's train and val splits, stores the pooled outputs in memory-mapped .npy files
+        (one row per example index, stacked per-image/per-choice outputs for NLVR2/VCR), and replaces the task dataloaders
+        with dataloaders over the cached features, so that only the task heads are trained
+
+        Features are stored in <cache_dir>/<encoder hash>/, so they are re-used across experiments with the same (frozen) encoder checkpoint.
+        Each features file is named after a digest of the dataset's example ids in dataset order (see get_example_ids() of the datasets),
+        so that features are never paired with the targets of other examples, e.g. after a rebuilt annotation cache or a different low-shot sample.
+        They are computed in eval mode, i.e. without encoder dropout
+
+        Args:
+        args: Arguments provided by user (uses frozen_features_cache_dir, num_workers)
+        model: ContinualLearner, whose encoder has been frozen
+        '''
+
+        self.args = args
+        self.encoder_hash = state_dict_hash(model.get_encoder().state_dict().items())
+        self.cache_dir = os.path.join(args.frozen_features_cache_dir, self.encoder_hash)
+        if not os.path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir)
+        logger.info("Caching frozen encoder features in {}".format(self.cache_dir))
+
+    def get_features_file(self, task_key: str, dataset: Dataset) -> str:
+        digest = example_ids_digest(dataset.get_example_ids())
+        return os.path.join(self.cache_dir, '{}_{}_{}_{}.npy'.format(task_key, dataset.split, len(dataset), digest))
+
+    def compute_features(self, task_key: str, model: ContinualLearner, dataloader: DataLoader, batch2inputs_converter, features_file: str):
+        '''
+        Runs the frozen encoder over the dataloader's dataset in order, and writes the pooled outputs to features_file
+        '''
+
+        dataset = dataloader.dataset
+        batch_size = get_batch_size(dataloader)
+        ordered_dataloader = build_batched_dataloader(dataset,
+                                                      get_default_batch_sampler(dataset, batch_size, shuffle=False),
+                                                      collate_fn=dataloader.collate_fn,
+                                                      num_workers=self.args.num_workers)
+
+        model.eval()
+        features = None
+        tmp_file = features_file + '.tmp'
+        offset = 0
+        for batch in tqdm(ordered_dataloader, desc='Caching {} {} encoder features'.format(task_key, dataset.split)):
+            inputs = batch2inputs_converter(batch)
+            with torch.no_grad():
+                pooled_output = model(task_key=task_key, **inputs)[0]
+            pooled_output = pooled_output.float().cpu().numpy()
+            if features is None:
+                features = np.lib.format.open_memmap(tmp_file, mode='w+', dtype=np.float32, shape=(len(dataset), *pooled_output.shape[1:]))
+            features[offset: offset+len(pooled_output)] = pooled_output
+            offset += len(pooled_output)
+        assert offset == len(dataset)
+        features.flush()
+        del features
+        os.replace(tmp_file, features_file)
+        model.train()
+
+    def get_cached_dataloader(self, task_key: str, model: ContinualLearner, dataloader: DataLoader, batch2inputs_converter, shuffle: bool) -> DataLoader:
+        '''
+        Returns dataloader over the cached features of dataloader's dataset, computing the features first if they are not cached yet
+        '''
+
+        features_file = self.get_features_file(task_key, dataloader.dataset)
+        if not os.path.exists(features_file):
+            self.compute_features(task_key, model, dataloader, batch2inputs_converter, features_file)
+        logger.info("Using cached encoder features from {}".format(features_file))
+
+        batch_size = get_batch_size(dataloader)
+        # Features are small, so they are read in the main process
+        return DataLoader(CachedFeatureDataset(dataloader.dataset, features_file),
+                          batch_size=batch_size,
+                          shuffle=shuffle,
+                          collate_fn=feature_batch_collate)
+
+    def replace_task_dataloaders(self, task_key: str, task_trainer, model: ContinualLearner, eval_only: bool = False):
+        '''
+        Replaces the task trainer's train and val dataloaders with dataloaders over cached encoder features
+        If eval_only is True (e.g. for forgetting evaluation), only the val dataloader is replaced
+        '''
+
+        model.to(task_trainer.device)
+        train_dataloader = task_trainer.get_train_dataloader()
+        if not eval_only:
+            train_dataloader = self.get_cached_dataloader(task_key, model, train_dataloader,
+                                                          task_trainer.batch2inputs_converter, shuffle=True)
+        eval_dataloader = self.get_cached_dataloader(task_key, model, task_trainer.get_eval_dataloader(),
+                                                     task_trainer.batch2inputs_converter, shuffle=False)
+        task_trainer.replace_dataloaders(train_dataloader, eval_dataloader)
@@ -86,6 +86,7 @@ vcr_config = {
         'model_type': 'multi-choice',
         'task_type': 'qa',
         'num_choices': 4,
+        'batch_size_divisor': 4,            # VCR batches contain batch_size/batch_size_divisor examples (i.e. batch_size image-text pairs)
         'num_epochs': 10,
         'lr': 1e-4,
         'weight_decay': 1e-2,
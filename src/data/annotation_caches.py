@@ -0,0 +1,214 @@
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import itertools
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Dict, Iterable, Iterator, Callable
+
+from data.columnar_cache import ColumnarTable, ColumnarTableWriter
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(
+        format='%(asctime)s - %(levelname)s - %(name)s - %(message)s',
+        datefmt='%m/%d/%Y %H:%M:%S',
+        level=logging.INFO)
+
+DEFAULT_CHUNK_SIZE = 4096           # Number of annotations that are processed (and tokenized in one batch) at a time
+JSON_READ_SIZE = 1 << 20            # Number of characters read from a JSON file at a time
+# Splits that the task trainers load
+TASK_SPLITS = {'vqa': ['train', 'val'],
+               'snli-ve': ['train', 'dev'],
+               'vcr': ['train', 'val']}
+
+class _JsonStreamReader:
+
+    '''
+    Decodes consecutive JSON values from a file object, reading it in blocks of JSON_READ_SIZE characters
+    '''
+
+    def __init__(self, f):
+        self.f = f
+        self.decoder = json.JSONDecoder()
+        self.buffer = ''
+        self.pos = 0
+        self.eof = False
+
+    def read_more(self) -> bool:
+        if self.eof:
+            return False
+        chunk = self.f.read(JSON_READ_SIZE)
+        self.buffer = self.buffer[self.pos:] + chunk
+        self.pos = 0
+        self.eof = len(chunk) == 0
+        return not self.eof
+
+    def peek(self) -> str:
+        '''
+        Skips whitespace, and returns the next character (or '' at the end of the file)
+        '''
+
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos].isspace():
+                self.pos += 1
+            if self.pos < len(self.buffer) or not self.read_more():
+                return self.buffer[self.pos: self.pos+1]
+
+    def expect(self, chars: str) -> str:
+        c = self.peek()
+        if c == '' or c not in chars:
+            raise ValueError("Expected one of '{}' in JSON stream, found '{}'".format(chars, c))
+        self.pos += 1
+        return c
+
+    def decode_value(self):
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+                # A value that ends at the end of the buffer (e.g. a number) may continue in the next block
+                if end < len(self.buffer) or not self.read_more():
+                    self.pos = end
+                    return value
+            except json.JSONDecodeError:
+                if not self.read_more():
+                    raise
+
+def iter_json_array(json_file: str, key: str) -> Iterator:
+
+    '''
+    Yields the items of the array stored under key in the top-level object of a JSON file (e.g. the 'questions' of the VQAv2 question files),
+    decoding one item at a time instead of loading the whole file. Other keys of the top-level object are decoded and skipped
+    '''
+
+    with open(json_file) as f:
+        reader = _JsonStreamReader(f)
+        reader.expect('{')
+        if reader.peek() == '}':
+            return
+        while True:
+            name = reader.decode_value()
+            reader.expect(':')
+            if name != key:
+                reader.decode_value()
+            else:
+                reader.expect('[')
+                if reader.peek() != ']':
+                    while True:
+                        yield reader.decode_value()
+                        if reader.expect(',]') == ']':
+                            break
+                else:
+                    reader.expect(']')
+                return
+            if reader.expect(',}') == '}':
+                raise KeyError("{} not found in {}".format(key, json_file))
+
+def iter_chunks(items: Iterable, chunk_size: int) -> Iterator[List]:
+    iterator = iter(items)
+    while True:
+        chunk = list(itertools.islice(iterator, chunk_size))
+        if len(chunk) == 0:
+            return
+        yield chunk
+
+
+_worker_process_fn = None
+_worker_context = None
+
+def _init_worker(process_fn: Callable, context: Dict):
+    # The context (e.g. the tokenizer) is sent to every worker process once, instead of with every chunk
+    global _worker_process_fn, _worker_context
+    _worker_process_fn, _worker_context = process_fn, context
+
+def _process_chunk(chunk: List) -> Dict[str, List]:
+    return _worker_process_fn(chunk, **_worker_context)
+
+def build_annotation_cache(cache_dir: str,
+                           schema: Dict[str, str],
+                           source_files: List[str],
+                           examples: Iterable,
+                           process_fn: Callable,
+                           context: Dict = None,
+                           num_workers: int = 0,
+                           chunk_size: int = DEFAULT_CHUNK_SIZE) -> ColumnarTable:
+
+    '''
+    Builds the columnar cache of a dataset's annotations, and returns the memory-mapped table
+
+    The examples are read lazily (e.g. streamed from the annotation files) and processed in chunks, so that texts are tokenized in large batches.
+    With num_workers > 0, chunks are processed by a pool of worker processes. At most 2 chunks per worker are in flight, and the results
+    are written to the cache in order as they arrive (see ColumnarTableWriter), so that memory stays bounded by a few chunks
+
+    Args:
+    cache_dir: directory of the cache
+    schema: schema of the cache (see data.columnar_cache)
+    source_files: annotation files that the cache is built from
+    examples: iterable over the raw annotations
+    process_fn: module-level function process_fn(chunk, **context), that returns the values of every schema column for a list of raw annotations
+    context: keyword arguments of process_fn that are the same for all chunks (e.g. the tokenizer), sent to every worker once
+    num_workers: number of worker processes (0 processes the chunks in the current process)
+    chunk_size: number of annotations per chunk
+    '''
+
+    context = context if context is not None else {}
+    start_time = time.time()
+    writer = ColumnarTableWriter(cache_dir, schema, source_files)
+    chunks = iter_chunks(examples, chunk_size)
+    if num_workers == 0:
+        for chunk in chunks:
+            writer.write_columns(process_fn(chunk, **context))
+    else:
+        with ProcessPoolExecutor(num_workers, initializer=_init_worker, initargs=(process_fn, context)) as executor:
+            pending = deque()
+            for chunk in chunks:
+                pending.append(executor.submit(_process_chunk, chunk))
+                if len(pending) >= 2 * num_workers:
+                    writer.write_columns(pending.popleft().result())
+            while len(pending) > 0:
+                writer.write_columns(pending.popleft().result())
+    table = writer.close()
+    logger.info("Built annotation cache {} with {} examples in {:.1f} seconds".format(cache_dir, len(table), time.time() - start_time))
+    return table
+
+
+def main():
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--tasks", type=str, nargs='+', default=['vqa', 'snli-ve', 'vcr'], choices=['vqa', 'snli-ve', 'vcr'],
+                        help="Vision-language tasks whose annotation caches are built.")
+    parser.add_argument("--climb_data_dir", type=str, required=True,
+                        help="Directory where all the CLiMB data is stored")
+    parser.add_argument("--num_workers", type=int, default=os.cpu_count(),
+                        help="Number of worker processes that process and tokenize the annotations.")
+    parser.add_argument("--chunk_size", type=int, default=DEFAULT_CHUNK_SIZE,
+                        help="Number of annotations that are processed and tokenized at a time.")
+    args = parser.parse_args()
+
+    from transformers import BertTokenizerFast
+    from configs.task_configs import task_configs
+    from data.visionlanguage_datasets.vqa_dataset import VQADataset
+    from data.visionlanguage_datasets.snli_ve_dataset import SnliVEDataset
+    from data.visionlanguage_datasets.vcr_dataset import VCRDataset
+
+    # Same tokenizer as the task trainers, so that the cached input IDs are used as they are
+    tokenizer = BertTokenizerFast.from_pretrained('bert-base-uncased')
+    cache_kwargs = {'tokenizer': tokenizer, 'num_cache_workers': args.num_workers, 'cache_chunk_size': args.chunk_size}
+    for task_key in args.tasks:
+        data_dir = os.path.join(args.climb_data_dir, task_configs[task_key]['data_dir'])
+        for split in TASK_SPLITS[task_key]:
+            # Datasets only build their caches if they do not exist yet, or are stale
+            if task_key == 'vqa':
+                VQADataset(data_dir, None, split, **cache_kwargs)
+            elif task_key == 'snli-ve':
+                SnliVEDataset(data_dir, None, split, **cache_kwargs)
+            else:
+                for task_type in ['qa', 'qar']:
+                    VCRDataset(data_dir, split, task_type, **cache_kwargs)
+
+if __name__ == '__main__':
+    sys.path.insert(0, '.')
+    main()
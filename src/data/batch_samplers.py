@@ -0,0 +1,250 @@
+import math
+import logging
+import random
+from collections import defaultdict
+from typing import List, Dict
+
+import numpy as np
+import torch
+from torch.utils.data import Sampler
+
+from utils.image_utils import get_vilt_input_shape
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(
+        format='%(asctime)s - %(levelname)s - %(name)s - %(message)s',
+        datefmt='%m/%d/%Y %H:%M:%S',
+        level=logging.INFO)
+
+def split_into_batches(indices: List[int], batch_size: int, drop_last: bool) -> List[List[int]]:
+    '''
+    Cuts a list of example indices into consecutive batches of batch_size
+    '''
+    batches = [indices[i: i+batch_size] for i in range(0, len(indices), batch_size)]
+    if drop_last and len(batches) > 0 and len(batches[-1]) < batch_size:
+        batches = batches[:-1]
+    return batches
+
+
+def warn_ignored_batching_options(**options):
+    '''
+    Logs a warning if more than one batching option (given as keyword arguments, in order of precedence) is set, since only the first set option is used
+    '''
+
+    set_options = [name for name, value in options.items() if value]
+    if len(set_options) > 1:
+        logger.warning("Only one batching option can be used: batching with --{}, and ignoring {}".format(
+                        set_options[0], ', '.join(['--{}'.format(name) for name in set_options[1:]])))
+
+
+class ImageGroupedBatchSampler(Sampler):
+
+    def __init__(self, dataset, batch_size: int, group_size: int, drop_last: bool = False):
+
+        '''
+        Batch sampler that places examples sharing the same image next to each other in a batch,
+        so that each image is decoded and patch-embedded only once per batch
+
+        Every epoch, the examples of each image are shuffled and cut into groups of at most group_size examples.
+        The groups are then shuffled across all images, and consecutive groups are cut into batches.
+        group_size=1 is equivalent to regular shuffling, while larger groups trade randomness for image reuse
+
+        Args:
+        dataset: dataset that implements get_image_ids(), returning the image_id of every example
+        batch_size: number of examples per batch
+        group_size: maximum number of examples of the same image that are placed next to each other
+        drop_last: whether to drop the last incomplete batch
+        '''
+
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.group_size = group_size
+        self.drop_last = drop_last
+        assert group_size >= 1
+
+    def get_groups(self) -> List[List[int]]:
+        # Image ids are read every epoch, so that conversions like convert_to_low_shot are picked up
+        imageid2indices = defaultdict(list)
+        for index, image_id in enumerate(self.dataset.get_image_ids()):
+            imageid2indices[image_id].append(index)
+
+        groups = []
+        for indices in imageid2indices.values():
+            random.shuffle(indices)
+            groups.extend([indices[i: i+self.group_size] for i in range(0, len(indices), self.group_size)])
+        random.shuffle(groups)
+        return groups
+
+    def __iter__(self):
+        groups = self.get_groups()
+        indices = [index for group in groups for index in group]
+        for batch in split_into_batches(indices, self.batch_size, self.drop_last):
+            yield batch
+
+    def __len__(self):
+        if self.drop_last:
+            return len(self.dataset) // self.batch_size
+        return math.ceil(len(self.dataset) / self.batch_size)
+
+
+def count_padded_tokens(lengths: np.ndarray, batches: List[List[int]]) -> int:
+    '''
+    Returns the number of text tokens (including padding) of the given batches, when every text is padded to the longest text in its batch
+    '''
+    return sum([len(batch) * int(lengths[batch].max()) for batch in batches if len(batch) > 0])
+
+
+class LengthBucketedBatchSampler(Sampler):
+
+    def __init__(self, dataset, batch_size: int, bucket_size: int, drop_last: bool = False, max_length: int = None):
+
+        '''
+        Batch sampler that places examples with similar text lengths in the same batch,
+        so that the texts of a batch are padded to a shorter length
+
+        Every epoch, the examples are shuffled and cut into buckets of bucket_size batches.
+        The examples of each bucket are sorted by text length and cut into batches, and the batches of all buckets are shuffled.
+        bucket_size=1 is equivalent to regular shuffling, while larger buckets trade randomness for less padding.
+        The fraction of padding tokens, compared to random batches, is logged every epoch
+
+        Args:
+        dataset: dataset that implements get_text_lengths(), returning the number of text tokens of every example
+        batch_size: number of examples per batch
+        bucket_size: number of batches per bucket
+        drop_last: whether to drop the last incomplete batch
+        max_length: if given, texts are truncated to max_length tokens by the model
+        '''
+
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.bucket_size = bucket_size
+        self.drop_last = drop_last
+        self.max_length = max_length
+        assert bucket_size >= 1
+
+    def get_batches(self) -> List[List[int]]:
+        # Lengths are read every epoch, so that conversions like convert_to_low_shot are picked up
+        lengths = np.asarray(self.dataset.get_text_lengths())
+        if self.max_length is not None:
+            lengths = np.minimum(lengths, self.max_length)
+
+        indices = list(range(len(lengths)))
+        random.shuffle(indices)
+        random_batches = split_into_batches(indices, self.batch_size, self.drop_last)
+
+        batches = []
+        bucket_num_examples = self.batch_size * self.bucket_size
+        for i in range(0, len(indices), bucket_num_examples):
+            bucket = sorted(indices[i: i+bucket_num_examples], key=lambda index: lengths[index])
+            batches.extend(split_into_batches(bucket, self.batch_size, drop_last=False))
+        # Only the last bucket can end with an incomplete batch
+        if self.drop_last and len(batches) > 0 and len(batches[-1]) < self.batch_size:
+            batches = batches[:-1]
+        random.shuffle(batches)
+
+        num_tokens = sum([int(lengths[batch].sum()) for batch in batches if len(batch) > 0])
+        if num_tokens > 0:
+            bucketed_padding = 1 - num_tokens / count_padded_tokens(lengths, batches)
+            random_padding = 1 - sum([int(lengths[batch].sum()) for batch in random_batches if len(batch) > 0]) / count_padded_tokens(lengths, random_batches)
+            logger.info("Length-bucketed batches: {:.1%} of text tokens are padding, compared to {:.1%} with random batches".format(bucketed_padding, random_padding))
+        return batches
+
+    def __iter__(self):
+        for batch in self.get_batches():
+            yield batch
+
+    def __len__(self):
+        if self.drop_last:
+            return len(self.dataset) // self.batch_size
+        return math.ceil(len(self.dataset) / self.batch_size)
+
+
+def count_image_patches(shapes: np.ndarray, batches: List[List[int]], patch_size: int = 32) -> int:
+    '''
+    Returns the number of image patches (including padding) of the given batches, when every image is padded to the largest height and width in its batch
+    '''
+    return sum([len(batch) * int(shapes[batch, 0].max() // patch_size) * int(shapes[batch, 1].max() // patch_size) for batch in batches if len(batch) > 0])
+
+
+class AspectRatioBucketedBatchSampler(Sampler):
+
+    def __init__(self, dataset, batch_size: int, drop_last: bool = False):
+
+        '''
+        Batch sampler that places examples whose images have the same model input shape in the same batch,
+        so that the images of a batch are padded to a smaller shape, with fewer padded patch tokens
+
+        Every epoch, the examples of each input shape (see utils.image_utils.get_vilt_input_shape) are shuffled and cut into batches.
+        The remaining examples of all shapes (less than one batch per shape) are sorted by aspect ratio and cut into batches, and all batches are shuffled.
+        The number of image patches, compared to random batches, is logged every epoch
+
+        Args:
+        dataset: dataset that implements get_image_sizes(), returning the (width, height) of the image of every example, as it is passed to the model's processor
+        batch_size: number of examples per batch
+        drop_last: whether to drop the last incomplete batch
+        '''
+
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.drop_last = drop_last
+
+    def get_batches(self) -> List[List[int]]:
+        # Image sizes are read every epoch, so that conversions like convert_to_low_shot are picked up
+        shape2indices = defaultdict(list)
+        for index, image_size in enumerate(self.dataset.get_image_sizes()):
+            shape2indices[get_vilt_input_shape(image_size)].append(index)
+        shapes = np.zeros((sum([len(indices) for indices in shape2indices.values()]), 2), dtype=np.int64)
+        for shape, indices in shape2indices.items():
+            shapes[indices] = shape
+
+        batches, remaining = [], []
+        for indices in shape2indices.values():
+            random.shuffle(indices)
+            num_full = len(indices) // self.batch_size * self.batch_size
+            batches.extend(split_into_batches(indices[:num_full], self.batch_size, drop_last=False))
+            remaining.extend(indices[num_full:])
+        random.shuffle(remaining)
+        remaining.sort(key=lambda index: shapes[index, 0] / shapes[index, 1])
+        batches.extend(split_into_batches(remaining, self.batch_size, self.drop_last))
+        random.shuffle(batches)
+
+        if len(shapes) > 0:
+            random_order = list(range(len(shapes)))
+            random.shuffle(random_order)
+            random_batches = split_into_batches(random_order, self.batch_size, self.drop_last)
+            logger.info("Aspect-ratio bucketed batches: {} image patches, compared to {} with random batches ({} shapes)".format(
+                        count_image_patches(shapes, batches), count_image_patches(shapes, random_batches), len(shape2indices)))
+        return batches
+
+    def __iter__(self):
+        for batch in self.get_batches():
+            yield batch
+
+    def __len__(self):
+        if self.drop_last:
+            return len(self.dataset) // self.batch_size
+        return math.ceil(len(self.dataset) / self.batch_size)
+
+
+class ReplayBatchSampler(Sampler):
+
+    def __init__(self, memory_idxs: List[int], batch_size: int, seed: int = None):
+
+        '''
+        Endless batch sampler for experience replay, where every batch is sampled with replacement from the examples in a memory buffer
+
+        Args:
+        memory_idxs: dataset indices of the examples in the memory buffer
+        batch_size: number of examples per batch
+        seed: seed of the sampler's random generator. If not given, it is drawn from Python's random module, so that it follows the experiment seed
+        '''
+
+        self.memory_idxs = np.array(memory_idxs, dtype=np.int64)
+        self.batch_size = batch_size
+        self.seed = seed if seed is not None else random.getrandbits(63)
+        assert len(self.memory_idxs) > 0
+
+    def __iter__(self):
+        rng = np.random.default_rng(self.seed)
+        while True:
+            yield self.memory_idxs[rng.integers(len(self.memory_idxs), size=self.batch_size)].tolist()
@@ -0,0 +1,377 @@
+import os
+import json
+import shutil
+import hashlib
+import logging
+from typing import List, Dict, Iterable
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(
+        format='%(asctime)s - %(levelname)s - %(name)s - %(message)s',
+        datefmt='%m/%d/%Y %H:%M:%S',
+        level=logging.INFO)
+
+# Bump when the on-disk layout changes, so that old caches are rebuilt
+COLUMNAR_CACHE_VERSION = 1
+META_FILENAME = 'meta.json'
+
+'''
+Column types of a ColumnarTable schema:
+- 'int', 'float': one int64/float64 value per row
+- 'str': utf-8 bytes of all rows, with offsets
+- 'list<T>': ragged lists of values of type T (which can be nested, e.g. 'list<list<int>>'), stored as the values of all rows with offsets
+
+Every column is stored as one or more flat NumPy arrays:
+- <name> for int/float columns
+- <name>.bytes and <name>.offsets for str columns
+- <name>.offsets and the arrays of the child column <name>.items for list columns
+'''
+
+def get_child_type(column_type: str) -> str:
+    assert column_type.startswith('list<') and column_type.endswith('>'), "Unknown column type: {}".format(column_type)
+    return column_type[len('list<'): -1]
+
+def encode_column(values: List, column_type: str, name: str) -> Dict[str, np.ndarray]:
+    '''
+    Converts a list of Python values (one per row) into the flat NumPy arrays of a column
+    '''
+
+    if column_type == 'int':
+        return {name: np.array(values, dtype=np.int64)}
+    if column_type == 'float':
+        return {name: np.array(values, dtype=np.float64)}
+
+    offsets = np.zeros(len(values)+1, dtype=np.int64)
+    if column_type == 'str':
+        encoded_values = [v.encode('utf-8') for v in values]
+        offsets[1:] = np.cumsum([len(v) for v in encoded_values])
+        return {name + '.bytes': np.frombuffer(b''.join(encoded_values), dtype=np.uint8),
+                name + '.offsets': offsets}
+
+    offsets[1:] = np.cumsum([len(v) for v in values])
+    items = [item for v in values for item in v]
+    arrays = encode_column(items, get_child_type(column_type), name + '.items')
+    arrays[name + '.offsets'] = offsets
+    return arrays
+
+def decode_value(arrays: Dict[str, np.ndarray], column_type: str, name: str, i: int):
+    '''
+    Returns the Python value of row i of a column
+    '''
+
+    if column_type == 'int':
+        return int(arrays[name][i])
+    if column_type == 'float':
+        return float(arrays[name][i])
+
+    offsets = arrays[name + '.offsets']
+    start, end = int(offsets[i]), int(offsets[i+1])
+    if column_type == 'str':
+        return arrays[name + '.bytes'][start: end].tobytes().decode('utf-8')
+
+    child_type = get_child_type(column_type)
+    if child_type in ['int', 'float']:
+        return arrays[name + '.items'][start: end].tolist()
+    return [decode_value(arrays, child_type, name + '.items', j) for j in range(start, end)]
+
+def get_source_fingerprint(source_files: List[str]) -> str:
+    '''
+    Returns a fingerprint of the source annotation files (paths, sizes and modification times), used to detect stale caches
+    Returns None if some source files do not exist (e.g. only the cache was copied), in which case caches are not checked
+    '''
+
+    if not all(os.path.exists(fn) for fn in source_files):
+        return None
+
+    sha = hashlib.sha1()
+    for fn in source_files:
+        stat = os.stat(fn)
+        sha.update('{}:{}:{}'.format(os.path.abspath(fn), stat.st_size, stat.st_mtime_ns).encode('utf-8'))
+    return sha.hexdigest()
+
+def make_tmp_cache_dir(cache_dir: str) -> str:
+    '''
+    Creates an empty temporary directory next to cache_dir, that a cache is written to before being moved into place
+    '''
+
+    tmp_dir = '{}.{}.tmp'.format(cache_dir.rstrip('/'), os.getpid())
+    if os.path.isdir(tmp_dir):
+        shutil.rmtree(tmp_dir)
+    os.makedirs(tmp_dir)
+    return tmp_dir
+
+def replace_cache_dir(tmp_dir: str, cache_dir: str):
+    '''
+    Moves a completely written tmp_dir (see make_tmp_cache_dir) into place as cache_dir, deleting the old cache_dir
+    '''
+
+    if os.path.isdir(cache_dir):
+        shutil.rmtree(cache_dir)
+    os.replace(tmp_dir, cache_dir)
+
+def finalize_cache_dir(tmp_dir: str, cache_dir: str, schema: Dict[str, str], num_rows: int, array_shapes: Dict[str, List[int]], source_files: List[str] = None):
+    '''
+    Writes meta.json (version, schema and source fingerprint) into tmp_dir, and replaces cache_dir with it,
+    so that readers never see a partially written cache
+    '''
+
+    meta = {'version': COLUMNAR_CACHE_VERSION,
+            'schema': schema,
+            'num_rows': num_rows,
+            'source_fingerprint': get_source_fingerprint(source_files) if source_files is not None else None,
+            'arrays': array_shapes}
+    with open(os.path.join(tmp_dir, META_FILENAME), 'w') as f:
+        json.dump(meta, f)
+    replace_cache_dir(tmp_dir, cache_dir)
+
+
+class ColumnarTable:
+
+    def __init__(self, schema: Dict[str, str], arrays: Dict[str, np.ndarray], num_rows: int, row_index: np.ndarray = None):
+        '''
+        Table of annotations stored column-wise in flat NumPy arrays (which can be memory-mapped), instead of a list of dicts
+        Rows are returned as dicts, so a ColumnarTable can replace the list of examples of a dataset
+
+        Args:
+        schema: dictionary from column name to column type (see top of this file)
+        arrays: flat NumPy arrays of all columns
+        num_rows: number of rows in the arrays
+        row_index: if given, the table is a view that contains only these rows of the arrays (e.g. after low-shot sampling)
+        '''
+
+        self.schema = schema
+        self.arrays = arrays
+        self.num_rows = num_rows
+        self.row_index = row_index
+
+    @classmethod
+    def from_records(cls, records: List[Dict], schema: Dict[str, str]):
+        '''
+        Creates a table from a list of dicts, each of which contains a value for every column in schema
+        '''
+
+        return cls.from_columns({name: [r[name] for r in records] for name in schema}, schema)
+
+    @classmethod
+    def from_columns(cls, columns: Dict[str, List], schema: Dict[str, str]):
+        '''
+        Creates a table from a list of values (one per row) for every column in schema
+        '''
+
+        num_rows = len(next(iter(columns.values())))
+        arrays = {}
+        for name, column_type in schema.items():
+            assert len(columns[name]) == num_rows
+            arrays.update(encode_column(columns[name], column_type, name))
+        return cls(schema, arrays, num_rows)
+
+    @classmethod
+    def load(cls, cache_dir: str, schema: Dict[str, str] = None, source_files: List[str] = None):
+        '''
+        Opens a table saved with save(), memory-mapping its arrays
+
+        Returns None if there is no cache in cache_dir, or if the cache is stale:
+        it was written by another version of this code, with another schema, or from different source files
+        '''
+
+        meta_file = os.path.join(cache_dir, META_FILENAME)
+        if not os.path.exists(meta_file):
+            return None
+        meta = json.load(open(meta_file))
+        if meta['version'] != COLUMNAR_CACHE_VERSION or (schema is not None and meta['schema'] != schema):
+            logger.info("Columnar cache in {} has an old version or schema, rebuilding it".format(cache_dir))
+            return None
+        source_fingerprint = get_source_fingerprint(source_files) if source_files is not None else None
+        if source_fingerprint is not None and meta['source_fingerprint'] != source_fingerprint:
+            logger.info("Source files of columnar cache in {} have changed, rebuilding it".format(cache_dir))
+            return None
+
+        arrays = {}
+        for array_name, shape in meta['arrays'].items():
+            array_file = os.path.join(cache_dir, '{}.npy'.format(array_name))
+            # Empty arrays cannot be memory-mapped
+            mmap_mode = 'r' if np.prod(shape) > 0 else None
+            arrays[array_name] = np.load(array_file, mmap_mode=mmap_mode)
+        return cls(meta['schema'], arrays, meta['num_rows'])
+
+    def save(self, cache_dir: str, source_files: List[str] = None):
+        '''
+        Writes every array of the table to a .npy file in cache_dir, together with meta.json (version, schema and source fingerprint)
+        The cache is written to a temporary directory first, so that readers never see a partially written cache
+        '''
+
+        table = self.compact()
+        tmp_dir = make_tmp_cache_dir(cache_dir)
+        for array_name, array in table.arrays.items():
+            np.save(os.path.join(tmp_dir, '{}.npy'.format(array_name)), np.ascontiguousarray(array))
+        array_shapes = {array_name: list(array.shape) for array_name, array in table.arrays.items()}
+        finalize_cache_dir(tmp_dir, cache_dir, table.schema, table.num_rows, array_shapes, source_files)
+        logger.info("Saved columnar cache with {} rows to {}".format(table.num_rows, cache_dir))
+
+    def __len__(self):
+        return self.num_rows if self.row_index is None else len(self.row_index)
+
+    def get_array_row(self, i: int) -> int:
+        if i < 0:
+            i += len(self)
+        if i < 0 or i >= len(self):
+            raise IndexError("Row {} is out of range for table with {} rows".format(i, len(self)))
+        return i if self.row_index is None else int(self.row_index[i])
+
+    def __getitem__(self, i: int) -> Dict:
+        row = self.get_array_row(i)
+        return {name: decode_value(self.arrays, column_type, name, row) for name, column_type in self.schema.items()}
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def get_column(self, name: str) -> List:
+        '''
+        Returns the values of a column for all rows
+        '''
+
+        column_type = self.schema[name]
+        rows = range(self.num_rows) if self.row_index is None else self.row_index
+        if column_type in ['int', 'float']:
+            values = self.arrays[name]
+            return (values if self.row_index is None else values[self.row_index]).tolist()
+        if column_type == 'str':
+            # Decode the whole byte blob once, instead of converting every row to bytes separately
+            blob = self.arrays[name + '.bytes'].tobytes()
+            offsets = self.arrays[name + '.offsets'].tolist()
+            return [blob[offsets[row]: offsets[row+1]].decode('utf-8') for row in (rows if self.row_index is None else self.row_index.tolist())]
+        return [decode_value(self.arrays, column_type, name, int(row)) for row in rows]
+
+    def get_lengths(self, name: str) -> np.ndarray:
+        '''
+        Returns the length of the value of a str/list column, for all rows (without decoding the values)
+        '''
+
+        assert self.schema[name] not in ['int', 'float']
+        lengths = np.diff(self.arrays[name + '.offsets'])
+        return lengths if self.row_index is None else lengths[self.row_index]
+
+    def select(self, indices: Iterable[int]):
+        '''
+        Returns a view of the table with only the given rows (in the given order)
+        '''
+
+        indices = np.array([self.get_array_row(i) for i in indices], dtype=np.int64)
+        return ColumnarTable(self.schema, self.arrays, self.num_rows, indices)
+
+    def with_column(self, name: str, values: List, column_type: str = None):
+        '''
+        Returns a copy of the table in which a column is replaced by the given values (one per row of this table)
+        '''
+
+        table = self.compact()
+        column_type = column_type if column_type is not None else table.schema[name]
+        arrays = {k: v for k, v in table.arrays.items() if not (k == name or k.startswith(name + '.'))}
+        arrays.update(encode_column(values, column_type, name))
+        schema = dict(table.schema)
+        schema[name] = column_type
+        return ColumnarTable(schema, arrays, table.num_rows)
+
+    def compact(self):
+        '''
+        Returns a table whose arrays contain only the rows of this view
+        '''
+
+        if self.row_index is None:
+            return self
+        return ColumnarTable.from_records(list(self), self.schema)
+
+
+class ColumnarTableWriter:
+
+    def __init__(self, cache_dir: str, schema: Dict[str, str], source_files: List[str] = None):
+        '''
+        Writes a ColumnarTable to cache_dir incrementally, one chunk of rows at a time, so that the whole table is never held in memory
+        (e.g. while annotations are streamed and processed in chunks, see data.annotation_caches)
+
+        The flat arrays of every chunk are appended to raw files in a temporary directory, and close() converts them
+        into the same .npy files and meta.json as ColumnarTable.save(), which can be opened with ColumnarTable.load()
+
+        Args:
+        cache_dir: directory that the table is saved to
+        schema: dictionary from column name to column type (see top of this file)
+        source_files: source annotation files, whose fingerprint is stored in meta.json
+        '''
+
+        self.cache_dir = cache_dir
+        self.schema = schema
+        self.source_files = source_files
+        self.num_rows = 0
+        self.tmp_dir = make_tmp_cache_dir(cache_dir)
+
+        # Encoding no rows gives the names and dtypes of all arrays, and the leading 0 of every offsets array
+        empty_arrays = {}
+        for name, column_type in schema.items():
+            empty_arrays.update(encode_column([], column_type, name))
+        self.dtypes = {array_name: array.dtype for array_name, array in empty_arrays.items()}
+        self.lengths = {array_name: 0 for array_name in empty_arrays}
+        self.last_offsets = {array_name: 0 for array_name in empty_arrays if array_name.endswith('.offsets')}
+        self.files = {array_name: open(self.get_raw_file(array_name), 'wb') for array_name in empty_arrays}
+        for array_name, array in empty_arrays.items():
+            self.append_array(array_name, array)
+
+    def get_raw_file(self, array_name: str) -> str:
+        return os.path.join(self.tmp_dir, '{}.raw'.format(array_name))
+
+    def append_array(self, array_name: str, values: np.ndarray):
+        self.files[array_name].write(np.ascontiguousarray(values, dtype=self.dtypes[array_name]).tobytes())
+        self.lengths[array_name] += len(values)
+
+    def write_columns(self, columns: Dict[str, List]):
+        '''
+        Appends rows to the table, given as a list of values (one per row) for every column in schema
+        '''
+
+        num_rows = len(next(iter(columns.values())))
+        for name, column_type in self.schema.items():
+            assert len(columns[name]) == num_rows
+            for array_name, array in encode_column(columns[name], column_type, name).items():
+                if array_name.endswith('.offsets'):
+                    # Offsets of the chunk start at 0, and continue from the last offset that was already written
+                    array = array[1:] + self.last_offsets[array_name]
+                    if len(array) > 0:
+                        self.last_offsets[array_name] = int(array[-1])
+                self.append_array(array_name, array)
+        self.num_rows += num_rows
+
+    def close(self) -> ColumnarTable:
+        '''
+        Converts the raw files into .npy files, moves the cache into place and returns the memory-mapped table
+        '''
+
+        array_shapes = {}
+        for array_name, f in self.files.items():
+            f.close()
+            raw_file = self.get_raw_file(array_name)
+            num_values = self.lengths[array_name]
+            # np.save streams the memory-mapped values to the .npy file
+            values = np.memmap(raw_file, dtype=self.dtypes[array_name], mode='r', shape=(num_values,)) if num_values > 0 else np.zeros(0, dtype=self.dtypes[array_name])
+            np.save(os.path.join(self.tmp_dir, '{}.npy'.format(array_name)), values)
+            del values
+            os.remove(raw_file)
+            array_shapes[array_name] = [num_values]
+        finalize_cache_dir(self.tmp_dir, self.cache_dir, self.schema, self.num_rows, array_shapes, self.source_files)
+        logger.info("Saved columnar cache with {} rows to {}".format(self.num_rows, self.cache_dir))
+        return ColumnarTable.load(self.cache_dir)
+
+
+IMAGE_LABEL_SCHEMA = {'filename': 'str',
+                      'label': 'int'}
+
+def build_image_label_table(samples: List[List]) -> ColumnarTable:
+    '''
+    Converts a list of [filename, label] samples into a compact ColumnarTable, with a single filename byte blob (plus offsets) and an int64 label array
+
+    A list of Python objects is copied page by page into every forked DataLoader worker, because reading an object updates its reference count.
+    The table only consists of a few NumPy arrays that workers never write to, so its pages stay shared with the main process (copy-on-write)
+    '''
+
+    return ColumnarTable.from_columns({'filename': [s[0] for s in samples], 'label': [s[1] for s in samples]}, IMAGE_LABEL_SCHEMA)
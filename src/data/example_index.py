@@ -0,0 +1,73 @@
+import logging
+from typing import List, Dict, Tuple
+
+import torch
+from torch.utils.data import Dataset, DataLoader
+
+from data.parallel_loading import build_batched_dataloader
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(
+        format='%(asctime)s - %(levelname)s - %(name)s - %(message)s',
+        datefmt='%m/%d/%Y %H:%M:%S',
+        level=logging.INFO)
+
+class ExampleIndexedDataset(Dataset):
+
+    def __init__(self, dataset: Dataset):
+        '''
+        Wraps a dataset, so that every item is returned together with its dataset index
+        Used to look up per-example cached model outputs (e.g. ViltFrozenLayersCache) by index, instead of hashing the model inputs
+
+        Args:
+        dataset: the wrapped dataset - its other attributes (e.g. split) are accessible through the wrapper
+        '''
+
+        self.dataset = dataset
+
+    def __getattr__(self, name: str):
+        if name == 'dataset':
+            raise AttributeError(name)
+        return getattr(self.dataset, name)
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, index: int):
+        return index, self.dataset[index]
+
+    def __getitems__(self, indices: List[int]) -> List[Tuple[int, Dict]]:
+        return list(zip(indices, self.dataset.__getitems__(indices)))
+
+def example_indexed_collate(batch: List[Tuple[int, Dict]], collate_fn, namespace: str) -> Dict:
+    '''
+    Collates the items with collate_fn, and adds 'example_index': (namespace, LongTensor of the dataset indices of the batch's examples)
+    '''
+
+    collated_batch = collate_fn([item for _, item in batch])
+    collated_batch['example_index'] = (namespace, torch.LongTensor([index for index, _ in batch]))
+    return collated_batch
+
+def build_example_indexed_dataloader(dataloader: DataLoader, namespace: str) -> DataLoader:
+    '''
+    Returns a DataLoader with the same batches (and batch sampler, workers and collate function) as dataloader,
+    whose batches also contain the dataset indices of their examples, in batch['example_index']
+
+    Args:
+    dataloader: DataLoader with a batch sampler, or built by data.parallel_loading.build_batched_dataloader
+    namespace: identifies the dataset that the indices belong to (e.g. '<task_key>_<split>')
+    '''
+
+    collate_fn = dataloader.collate_fn
+    if dataloader.batch_sampler is None:
+        # The sampler yields the index lists of whole batches
+        return build_batched_dataloader(ExampleIndexedDataset(dataloader.dataset),
+                                        dataloader.sampler,
+                                        collate_fn=lambda batch: example_indexed_collate(batch, collate_fn, namespace),
+                                        num_workers=dataloader.num_workers,
+                                        pin_memory=dataloader.pin_memory)
+    return DataLoader(ExampleIndexedDataset(dataloader.dataset),
+                      batch_sampler=dataloader.batch_sampler,
+                      num_workers=dataloader.num_workers,
+                      pin_memory=dataloader.pin_memory,
+                      collate_fn=lambda batch: example_indexed_collate(batch, collate_fn, namespace))
@@ -0,0 +1,83 @@
+import os
+import glob
+import time
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict, Tuple, Callable
+
+from PIL import Image
+
+from data.columnar_cache import ColumnarTable, IMAGE_LABEL_SCHEMA
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(
+        format='%(asctime)s - %(levelname)s - %(name)s - %(message)s',
+        datefmt='%m/%d/%Y %H:%M:%S',
+        level=logging.INFO)
+
+# Manifests are stored in this folder inside each dataset's root directory
+MANIFESTS_DIRNAME = 'file_manifests'
+
+def load_file_manifest(manifest_dir: str, source_paths: List[str], schema: Dict[str, str], build_fn: Callable[[], Dict[str, List]]) -> ColumnarTable:
+    '''
+    Returns the file manifest (a memory-mapped ColumnarTable) stored in manifest_dir
+    If there is no manifest yet, or it is stale, the manifest is built with build_fn() and saved
+
+    Args:
+    manifest_dir: directory of the manifest
+    source_paths: files and directories that the manifest is created from. The manifest is rebuilt when their size or modification time changes
+                  (the modification time of a directory changes when files are added to or removed from it)
+    schema: column types of the manifest (see data.columnar_cache)
+    build_fn: function that scans the source paths, and returns a dictionary with the values of every column
+
+    Returns:
+    manifest: ColumnarTable, whose rows are in the order returned by build_fn
+    '''
+
+    manifest = ColumnarTable.load(manifest_dir, schema, source_paths)
+    if manifest is None:
+        start_time = time.time()
+        manifest = ColumnarTable.from_columns(build_fn(), schema)
+        manifest.save(manifest_dir, source_paths)
+        logger.info("Built file manifest with {} files in {:.1f}s".format(len(manifest), time.time()-start_time))
+    return manifest
+
+def load_class_directory_manifest(manifest_dir: str, image_dir: str, class_names: List[str], extension: str, archive=None) -> ColumnarTable:
+    '''
+    Manifest of an image directory with one sub-directory per class, with the filename and label (index of the class in class_names) of every image
+    Images are in the same order as glob.glob() over each class directory, so that seeded shuffling gives the same splits as scanning the directories
+    If archive (a data.tar_archive.TarArchiveReader) is given, the directories are listed in the tar archive instead (in sorted order)
+    '''
+
+    if archive is None:
+        source_paths = [image_dir] + [os.path.join(image_dir, dir_name) for dir_name in class_names]
+        glob_fn = lambda dir_path: glob.glob(os.path.join(dir_path, '*' + extension))
+    else:
+        source_paths = [archive.tar_path]
+        glob_fn = lambda dir_path: archive.glob(dir_path, extension)
+        manifest_dir = manifest_dir + '_tar'
+
+    def build_fn():
+        filenames, labels = [], []
+        for label, dir_name in enumerate(class_names):
+            class_filenames = glob_fn(os.path.join(image_dir, dir_name))
+            filenames.extend(class_filenames)
+            labels.extend([label]*len(class_filenames))
+        return {'filename': filenames, 'label': labels}
+
+    return load_file_manifest(manifest_dir, source_paths, IMAGE_LABEL_SCHEMA, build_fn)
+
+def read_image_sizes(filenames: List[str], num_threads: int = 16) -> Tuple[List[int], List[int]]:
+    '''
+    Returns the widths and heights of image files, reading only the image headers (in parallel threads, since this is I/O bound)
+    '''
+
+    def read_size(fn):
+        with Image.open(fn) as image:
+            return image.size
+
+    with ThreadPoolExecutor(max_workers=num_threads) as executor:
+        sizes = list(executor.map(read_size, filenames, chunksize=64))
+    widths = [s[0] for s in sizes]
+    heights = [s[1] for s in sizes]
+    return widths, heights
@@ -11,8 +11,10 @@ from tqdm import tqdm
 from collections import defaultdict
 import pickle as pkl
 import pdb
-from typing import List, Dict
+from typing import List, Dict, Tuple
 
+import numpy as np
+import torch
 from transformers import BertTokenizer
 
 from PIL import Image
@@ -21,9 +23,9 @@ from utils.vqa_utils import get_score, target_tensor
 
 from data.image_datasets.cocoimages_dataset import MSCOCOImagesDataset
 
-ALLOWED_VISUAL_INPUT_TYPES = ['raw',                    # A raw tensor of size (3, W, H)
+ALLOWED_VISUAL_INPUT_TYPES = ['raw',                    # A uint8 tensor of size (3, H, W), already re-sized to the model's input shape
                               'pil-image',              # A PIL.Image instance
-                              'fast-rcnn'               # A set of R features, each of dim H
+                              'fast-rcnn'               # A set of R region features, each of dim H (float16 array of size (R, H))
                               ]
 
 def image_collate(images: List, 
@@ -45,20 +47,95 @@ def image_collate(images: List,
         collated_images = images
 
     if visual_input_type == 'raw':
-        # Stacks individual raw image tensors to give (B, 3, W, H) tensor
-        collated_images = torch.stack(images, dim=0)
+        # Pads individual raw image tensors into a dictionary with a (B, 3, max(H), max(W)) uint8 tensor and the (B, 2) image sizes
+        collated_images = letterbox_collate(images)
 
     elif visual_input_type == 'fast-rcnn':
-        # Stack the image tensors, doing padding if necessary for the sequence of region features
-        # Each element is a tensor of shape [R_i, H], returns tensor of shape [B, max(R_i), H]
-        max_len = max([t.shape[0] for t in images])
-        image_tensors_padded = []
-        for i in range(len(images)):
-            padding_tensor = torch.zeros(max_len-images[i].shape[0], images[i].shape[1])
-            padded_tensor = torch.cat((images[i], padding_tensor), dim=0)
-            assert padded_tensor.shape[0] == max_len
-            image_tensors_padded.append(padded_tensor)
-        collated_images = torch.stack(image_tensors_padded, dim=0)        # Pads region features with 0 vectors to give (B, R, hv) tensor
+        # Pads the sequences of region features with 0 vectors into a dictionary with a (B, max(R_i), H) tensor and a (B, max(R_i)) mask
+        collated_images = region_features_collate(images)
 
     return collated_images
 
+
+def letterbox_collate(images: List[torch.Tensor]) -> Dict[str, torch.Tensor]:
+
+    """
+    Pads a list of B uint8 image tensors of different sizes into a single batch, with every image in the top-left corner
+
+    The batch is allocated once, and each image is copied into it (no per-image padding or float conversion),
+    so that workers send 1 byte per channel to the training process. Normalization and pixel_mask creation
+    are done by the model on the whole batch (see modeling.vilt.raw_images_to_pixel_inputs)
+
+    Args:
+    images: list of B uint8 tensors of size (3, H_i, W_i)
+
+    Returns:
+    raw_images: dictionary with pixel_values, a uint8 tensor of size (B, 3, max(H_i), max(W_i)) that is 0 outside the images,
+                and image_sizes, a LongTensor of size (B, 2) with the (H_i, W_i) of every image
+    """
+
+    image_sizes = torch.LongTensor([list(image.shape[-2:]) for image in images])
+    max_height, max_width = image_sizes.max(dim=0).values.tolist()
+    pixel_values = torch.zeros((len(images), 3, max_height, max_width), dtype=torch.uint8)
+    for i, image in enumerate(images):
+        pixel_values[i, :, :image.shape[-2], :image.shape[-1]] = image
+    return {'pixel_values': pixel_values, 'image_sizes': image_sizes}
+
+
+def region_features_collate(features: List) -> Dict[str, torch.Tensor]:
+
+    """
+    Pads a list of B region feature arrays with different numbers of regions into a single batch
+
+    The batch is allocated once, and the features of every image are copied into it (e.g. directly from the memory-mapped
+    RegionFeatureStore), instead of concatenating a padding tensor to every item. Features keep their dtype (float16 in the store)
+
+    Args:
+    features: list of B arrays/tensors of size (R_i, H)
+
+    Returns:
+    region_features: dictionary with region_features, a tensor of size (B, max(R_i), H) that is 0 for padded regions,
+                     and region_mask, a LongTensor of size (B, max(R_i)) that is 1 for the regions of every image
+    """
+
+    num_regions = np.array([len(f) for f in features], dtype=np.int64)
+    max_regions = max(int(num_regions.max()), 1)
+    feature_dim = features[0].shape[1]
+    if torch.is_tensor(features[0]):
+        region_features = torch.zeros((len(features), max_regions, feature_dim), dtype=features[0].dtype)
+        for i, f in enumerate(features):
+            region_features[i, :len(f)] = f
+    else:
+        # Numpy copies read-only memory maps without the warning of torch.from_numpy
+        batch_array = np.zeros((len(features), max_regions, feature_dim), dtype=features[0].dtype)
+        for i, f in enumerate(features):
+            batch_array[i, :len(f)] = f
+        region_features = torch.from_numpy(batch_array)
+    region_mask = torch.from_numpy((np.arange(max_regions)[None, :] < num_regions[:, None]).astype(np.int64))
+    return {'region_features': region_features, 'region_mask': region_mask}
+
+
+def deduplicate_images(images: List, 
+                       image_ids: List) -> Tuple[List, torch.LongTensor]:
+
+    """
+    Keeps only the first occurrence of every image in a batch, so that each image is processed once by the model
+
+    Args:
+    images: list of B images
+    image_ids: list of B image ids, one for each element of images
+
+    Returns:
+    unique_images: list of the U unique images, in order of first occurrence
+    image_index: LongTensor of size (B,), where image_index[i] is the position of images[i] in unique_images
+    """
+
+    imageid2position = {}
+    unique_images = []
+    image_index = []
+    for image, image_id in zip(images, image_ids):
+        if image_id not in imageid2position:
+            imageid2position[image_id] = len(unique_images)
+            unique_images.append(image)
+        image_index.append(imageid2position[image_id])
+    return unique_images, torch.LongTensor(image_index)
@@ -9,6 +9,7 @@ import base64
 from tqdm import tqdm
 from collections import defaultdict
 import pickle as pkl
+from typing import List
 
 import numpy as np
 import torch
@@ -17,17 +18,29 @@ from torchvision import transforms as T
 from torch.utils.data import Dataset
 
 from PIL import Image
-from utils.image_utils import resize_image
+from utils.image_utils import resize_image, load_resized_pil_image, get_resized_shape, get_vilt_input_array
+from data.image_datasets.image_shards import ImageShardCache, IMAGE_SHARDS_DIRNAME
+from data.image_datasets.region_features import RegionFeatureStore, REGION_FEATURES_DIRNAME
+from data.parallel_loading import load_unique_in_threads
+from data.file_manifest import MANIFESTS_DIRNAME, load_file_manifest, read_image_sizes
+
+COCO_IMAGES_MANIFEST_SCHEMA = {'image_id': 'int',
+                               'filename': 'str',
+                               'width': 'int',
+                               'height': 'int'}
+
 
 class MSCOCOImagesDataset(Dataset):
 
-    def __init__(self, coco_dir: str, visual_input_type: str, image_size=(384,640)):
+    def __init__(self, coco_dir: str, visual_input_type: str, image_size=(384,640), use_image_shards: bool = False):
 
         '''
         Initializes an MSCOCOImagesDataset instance that handles image-side processing for VQA and other tasks that use MS-COCO images
         coco_dir: directory that contains MS-COCO data (images within 'images' folder)
         visual_input_type: format of visual input to model
         image_size: tuple indicating size of image input to model
+        use_image_shards: if True, pre-decoded images are read from the 'image_shards' folder (built with data.image_datasets.image_shards)
+        Region features for the 'fast-rcnn' visual_input_type are read from the 'region_features' folder (built with data.image_datasets.region_features)
         '''
 
         self.images_dir = os.path.join(coco_dir, 'images')          # Images across all 2017 splits stored in same directory
@@ -36,23 +49,47 @@ class MSCOCOImagesDataset(Dataset):
         self.visual_input_type = visual_input_type
         assert visual_input_type in ['pil-image', 'raw', 'fast-rcnn']
 
-        image_filenames = os.listdir(self.images_dir)
-        self.imageid2filename = {}
-        for fn in image_filenames:
-            fn = fn.split('_')[-1]
-            image_id = int(fn.strip('.jpg'))
-            self.imageid2filename[image_id] = os.path.join(self.images_dir, fn)
+        # Image IDs, filenames and sizes are read from a persistent manifest, instead of listing the images directory
+        manifest_dir = os.path.join(coco_dir, MANIFESTS_DIRNAME, 'coco_images')
+        manifest = load_file_manifest(manifest_dir, [self.images_dir], COCO_IMAGES_MANIFEST_SCHEMA, self.build_manifest_columns)
+        image_ids = manifest.get_column('image_id')
+        self.imageid2filename = dict(zip(image_ids, manifest.get_column('filename')))
+        self.imageid2size = dict(zip(image_ids, zip(manifest.get_column('width'), manifest.get_column('height'))))
         self.imageids = list(set(list(self.imageid2filename.keys())))
 
-        self.raw_transform = T.Compose([
-            T.Resize(image_size),
-            T.ToTensor(),                                 # [0, 1]
-            T.Normalize((0.5, 0.5, 0.5), (0.5, 0.5, 0.5)) # [-1, 1]
-        ])
-
         #self.pil_transform = T.Resize(image_size)
         self.pil_transform = T.Resize(size=384, max_size=640)
 
+        self.last_decoded_image = (None, None)
+        self.image_shards = None
+        if use_image_shards:
+            shards_dir = os.path.join(coco_dir, IMAGE_SHARDS_DIRNAME)
+            assert ImageShardCache.exists(shards_dir), "Image shards not found in {}, build them with data.image_datasets.image_shards".format(shards_dir)
+            self.image_shards = ImageShardCache(shards_dir)
+
+        self.region_features = None
+        if visual_input_type == 'fast-rcnn':
+            features_dir = os.path.join(coco_dir, REGION_FEATURES_DIRNAME)
+            assert RegionFeatureStore.exists(features_dir), "Region features not found in {}, build them with data.image_datasets.region_features".format(features_dir)
+            self.region_features = RegionFeatureStore(features_dir)
+
+    def build_manifest_columns(self):
+
+        '''
+        Lists the images directory, and reads the size of every image from its header
+        '''
+
+        image_ids, filenames = [], []
+        for fn in os.listdir(self.images_dir):
+            fn = fn.split('_')[-1]
+            image_ids.append(int(fn.strip('.jpg')))
+            filenames.append(os.path.join(self.images_dir, fn))
+        widths, heights = read_image_sizes(filenames)
+        return {'image_id': image_ids,
+                'filename': filenames,
+                'width': widths,
+                'height': heights}
+
     def get_image_data(self, image_id: str):
 
         '''
@@ -66,35 +103,70 @@ class MSCOCOImagesDataset(Dataset):
             return self.get_raw_image_tensor(image_id)
 
         elif self.visual_input_type == 'fast-rcnn':
-            raise NotImplementedError("Have not implemented Fast-RCNN feature inputs for MS-COCO images!")
+            return self.get_region_features(image_id)
 
     def get_pil_image(self, image_id: str) -> Image:
         '''
         Loads image corresponding to image_id, re-sizes and returns PIL.Image object
+        If image shards are used, returns a zero-copy (H, W, 3) uint8 array of the already re-sized image instead (ViltProcessor accepts both)
         '''
 
-        assert image_id in self.imageid2filename.keys()
-        image_fn = self.imageid2filename[image_id]
-        image = Image.open(image_fn)
-        image = image.convert('RGB')
-        if min(list(image.size)) > 384:
-            image = self.pil_transform(image)
+        if self.image_shards is not None:
+            return self.image_shards.get_image_array(image_id)
+        # Examples of the same image are often loaded one after another (e.g. with ImageGroupedBatchSampler),
+        # so the last decoded image is kept and re-used (read once, since get_images_data() calls this from several threads)
+        last_image_id, image = self.last_decoded_image
+        if last_image_id != image_id:
+            image = self.decode_pil_image(image_id)
+            self.last_decoded_image = (image_id, image)
         return image
 
-    def get_raw_image_tensor(self, image_id: str) -> torch.Tensor:
+    def get_image_size(self, image_id: int):
         '''
-        Loads image corresponding to image_id, re-sizes, and returns tensor of size (3, W, H)
+        Returns the (width, height) of the image returned by get_pil_image (after re-sizing), without loading the image
+        '''
+
+        if self.image_shards is not None:
+            height, width = self.image_shards.get_image_size(image_id)
+            return width, height
+        image_size = self.imageid2size[image_id]
+        return get_resized_shape(image_size, 384, 640) if min(image_size) > 384 else image_size
+
+    def get_images_data(self, image_ids: List) -> List:
+        '''
+        Returns the image data of several images (e.g. of a batch), like get_image_data()
+        Every distinct image is loaded once, and the files are read and decoded concurrently in a thread pool
+        '''
+
+        id2data = load_unique_in_threads(self.get_image_data, image_ids)
+        return [id2data[image_id] for image_id in image_ids]
+
+    def decode_pil_image(self, image_id: str) -> Image:
+        '''
+        Decodes image corresponding to image_id from its file, re-sizes and returns PIL.Image object
         '''
 
         assert image_id in self.imageid2filename.keys()
         image_fn = self.imageid2filename[image_id]
-        image = Image.open(image_fn)
-        image = image.convert('RGB')
+        image = load_resized_pil_image(image_fn, short_side=384, max_size=640)
+        return image
 
-        image_tensor = self.raw_transform(image)
+    def get_region_features(self, image_id: int) -> np.ndarray:
+        '''
+        Returns a zero-copy (R, H) float16 view of the region features of the image corresponding to image_id
+        Features of a batch are padded with data.image_collation.region_features_collate
+        '''
+
+        return self.region_features.get_features(image_id)
+
+    def get_raw_image_tensor(self, image_id: str) -> torch.Tensor:
+        '''
+        Loads image corresponding to image_id, re-sizes it to its ViLT input shape, and returns uint8 tensor of size (3, H, W)
+        Images of a batch are padded with data.image_collation.letterbox_collate, and normalized by the model
+        '''
 
-        image.close()
-        return image_tensor         # (B, 3, W, H)
+        image = self.get_pil_image(image_id)
+        return torch.from_numpy(get_vilt_input_array(image))
 
 if __name__ == '__main__':
 
@@ -0,0 +1,190 @@
+import os
+import sys
+import json
+import logging
+import argparse
+from tqdm import tqdm
+
+import numpy as np
+import torch
+from torch.utils.data import Dataset
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(
+        format='%(asctime)s - %(levelname)s - %(name)s - %(message)s',
+        datefmt='%m/%d/%Y %H:%M:%S',
+        level=logging.INFO)
+
+SHARD_INDEX_DTYPE = np.dtype([('image_id', np.int64),
+                              ('shard', np.int32),
+                              ('offset', np.int64),
+                              ('height', np.int32),
+                              ('width', np.int32)])
+DEFAULT_SHARD_SIZE = 1 << 30        # Bytes of pixel data per shard file (1 GB)
+IMAGE_SHARDS_DIRNAME = 'image_shards'
+
+def shard_filename(shards_dir: str, shard_num: int) -> str:
+    return os.path.join(shards_dir, 'shard_{:04d}.bin'.format(shard_num))
+
+class ImageShardCache:
+
+    def __init__(self, shards_dir: str):
+
+        '''
+        Read-only view over a directory of pre-decoded, pre-resized images written by build_image_shards
+        Every image is stored once as a contiguous (H, W, 3) uint8 array inside a memory-mapped shard file,
+        and index.npy maps each image_id to its (shard, offset, height, width)
+
+        shards_dir: directory containing meta.json, index.npy and the shard_XXXX.bin files
+        '''
+
+        self.shards_dir = shards_dir
+        self.meta = json.load(open(os.path.join(shards_dir, 'meta.json')))
+        self.num_shards = self.meta['num_shards']
+
+        # Index is sorted by image_id, so lookups are a binary search instead of a Python dict per image
+        self.index = np.load(os.path.join(shards_dir, 'index.npy'))
+        self.image_ids = self.index['image_id']
+        self._shards = {}
+
+        logger.info("Loaded image shard cache from {}, with {} images in {} shards".format(shards_dir, len(self.index), self.num_shards))
+
+    @staticmethod
+    def exists(shards_dir: str) -> bool:
+        # meta.json is written last by build_image_shards, so it marks a completed build
+        return os.path.exists(os.path.join(shards_dir, 'meta.json'))
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, image_id: int) -> bool:
+        row = np.searchsorted(self.image_ids, image_id)
+        return row < len(self.image_ids) and self.image_ids[row] == image_id
+
+    def __getstate__(self):
+        # Memory maps are re-opened inside each DataLoader worker instead of being pickled
+        state = self.__dict__.copy()
+        state['_shards'] = {}
+        return state
+
+    def get_shard(self, shard_num: int) -> np.memmap:
+        if shard_num not in self._shards:
+            self._shards[shard_num] = np.memmap(shard_filename(self.shards_dir, shard_num), dtype=np.uint8, mode='r')
+        return self._shards[shard_num]
+
+    def get_image_size(self, image_id: int):
+        '''
+        Returns (height, width) of the stored image, without touching the pixel data
+        '''
+        row = self.index[np.searchsorted(self.image_ids, image_id)]
+        return int(row['height']), int(row['width'])
+
+    def get_image_array(self, image_id: int) -> np.ndarray:
+        '''
+        Returns a zero-copy (H, W, 3) uint8 view of the stored image
+        '''
+
+        row = np.searchsorted(self.image_ids, image_id)
+        assert row < len(self.image_ids) and self.image_ids[row] == image_id, "Image {} not found in {}".format(image_id, self.shards_dir)
+        entry = self.index[row]
+        height, width, offset = int(entry['height']), int(entry['width']), int(entry['offset'])
+        shard = self.get_shard(int(entry['shard']))
+        return shard[offset: offset + height*width*3].reshape(height, width, 3)
+
+
+class _DecodedImagesDataset(Dataset):
+
+    '''
+    Decodes every image of an images dataset (e.g. MSCOCOImagesDataset) through its regular PIL path,
+    so that DataLoader workers can be used to parallelize the shard build
+    '''
+
+    def __init__(self, images_dataset, image_ids):
+        self.images_dataset = images_dataset
+        self.image_ids = image_ids
+
+    def __len__(self):
+        return len(self.image_ids)
+
+    def __getitem__(self, index: int):
+        image_id = self.image_ids[index]
+        image = self.images_dataset.decode_pil_image(image_id)
+        return image_id, np.asarray(image, dtype=np.uint8)
+
+def _identity(x):
+    return x
+
+def build_image_shards(images_dataset, shards_dir: str, shard_size: int = DEFAULT_SHARD_SIZE, num_workers: int = 8):
+
+    '''
+    Writes every image of images_dataset once, already decoded and resized to the ViLT input shape, into shards_dir
+
+    images_dataset: instance of MSCOCOImagesDataset/Flickr30KImagesDataset, whose decode_pil_image is used for decoding
+    shards_dir: output directory
+    shard_size: approximate number of bytes per shard file
+    num_workers: number of DataLoader workers used for decoding
+    '''
+
+    if not os.path.isdir(shards_dir):
+        os.makedirs(shards_dir)
+
+    image_ids = sorted(images_dataset.imageids)
+    loader = torch.utils.data.DataLoader(_DecodedImagesDataset(images_dataset, image_ids),
+                                         batch_size=None,
+                                         num_workers=num_workers,
+                                         collate_fn=_identity)
+
+    index = np.zeros(len(image_ids), dtype=SHARD_INDEX_DTYPE)
+    shard_num, offset = 0, 0
+    shard_file = open(shard_filename(shards_dir, shard_num), 'wb')
+    for i, (image_id, image_arr) in enumerate(tqdm(loader, desc='Writing image shards to {}'.format(shards_dir))):
+        if offset > 0 and offset + image_arr.nbytes > shard_size:
+            shard_file.close()
+            shard_num += 1
+            offset = 0
+            shard_file = open(shard_filename(shards_dir, shard_num), 'wb')
+
+        assert image_arr.ndim == 3 and image_arr.shape[2] == 3
+        shard_file.write(np.ascontiguousarray(image_arr).tobytes())
+        index[i] = (image_id, shard_num, offset, image_arr.shape[0], image_arr.shape[1])
+        offset += image_arr.nbytes
+    shard_file.close()
+
+    np.save(os.path.join(shards_dir, 'index.npy'), index)
+    meta = {'num_images': len(index),
+            'num_shards': shard_num + 1,
+            'images_dir': images_dataset.images_dir}
+    json.dump(meta, open(os.path.join(shards_dir, 'meta.json'), 'w'))
+    logger.info("Wrote {} images into {} shards in {}".format(len(index), shard_num + 1, shards_dir))
+
+
+def main():
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--images_source", type=str, required=True, choices=['ms-coco', 'flickr30k'],
+                        help="Images dataset to build the shards for.")
+    parser.add_argument("--climb_data_dir", type=str, required=True,
+                        help="Directory where all the CLiMB data is stored")
+    parser.add_argument("--shard_size", type=int, default=DEFAULT_SHARD_SIZE,
+                        help="Approximate number of bytes per shard file.")
+    parser.add_argument("--num_workers", type=int, default=8,
+                        help="Number of workers used for decoding images")
+    args = parser.parse_args()
+
+    if args.images_source == 'ms-coco':
+        from data.image_datasets.cocoimages_dataset import MSCOCOImagesDataset
+        images_dir = os.path.join(args.climb_data_dir, 'ms-coco/')
+        images_dataset = MSCOCOImagesDataset(images_dir, visual_input_type='pil-image')
+    else:
+        from data.image_datasets.flickr30kimages_dataset import Flickr30KImagesDataset
+        images_dir = os.path.join(args.climb_data_dir, 'flickr30k/')
+        images_dataset = Flickr30KImagesDataset(images_dir, visual_input_type='pil-image')
+
+    build_image_shards(images_dataset,
+                       shards_dir=os.path.join(images_dir, IMAGE_SHARDS_DIRNAME),
+                       shard_size=args.shard_size,
+                       num_workers=args.num_workers)
+
+if __name__ == '__main__':
+    sys.path.insert(0, '.')
+    main()
@@ -0,0 +1,223 @@
+import os
+import sys
+import csv
+import json
+import glob
+import base64
+import shutil
+import logging
+import argparse
+from tqdm import tqdm
+from typing import Iterator, List, Tuple
+
+import numpy as np
+
+from data.columnar_cache import make_tmp_cache_dir, replace_cache_dir
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(
+        format='%(asctime)s - %(levelname)s - %(name)s - %(message)s',
+        datefmt='%m/%d/%Y %H:%M:%S',
+        level=logging.INFO)
+
+REGION_INDEX_DTYPE = np.dtype([('image_id', np.int64),
+                               ('offset', np.int64),
+                               ('num_regions', np.int32)])
+REGION_FEATURES_DTYPE = np.float16
+REGION_FEATURES_DIRNAME = 'region_features'
+
+# Column names of the Faster R-CNN (bottom-up attention) feature TSV files, as released for the original model and for LXMERT
+BOTTOM_UP_TSV_FIELDNAMES = ['image_id', 'image_w', 'image_h', 'num_boxes', 'boxes', 'features']
+LXMERT_TSV_FIELDNAMES = ['img_id', 'img_h', 'img_w', 'objects_id', 'objects_conf', 'attrs_id', 'attrs_conf', 'num_boxes', 'boxes', 'features']
+
+def features_filename(features_dir: str) -> str:
+    return os.path.join(features_dir, 'features.bin')
+
+def parse_image_id(image_name: str) -> int:
+    '''
+    Returns the integer image id of an MS-COCO (e.g. COCO_train2014_000000123456) or Flickr30K (e.g. 1000092795.jpg) image name
+    '''
+    return int(os.path.splitext(os.path.basename(str(image_name)))[0].split('_')[-1])
+
+
+class RegionFeatureStore:
+
+    def __init__(self, features_dir: str):
+
+        '''
+        Read-only view over the region features of a set of images, written by build_region_feature_store
+        The [R_i, H] float16 features of all images are stored one after another in a single memory-mapped file (features.bin),
+        and index.npy maps each image_id to the (offset, num_regions) of its rows, so features are never loaded into RAM as a whole
+
+        features_dir: directory containing meta.json, index.npy and features.bin
+        '''
+
+        self.features_dir = features_dir
+        self.meta = json.load(open(os.path.join(features_dir, 'meta.json')))
+        self.feature_dim = self.meta['feature_dim']
+
+        # Index is sorted by image_id, so lookups are a binary search instead of a Python dict per image
+        self.index = np.load(os.path.join(features_dir, 'index.npy'))
+        self.image_ids = self.index['image_id']
+        self._features = None
+
+        logger.info("Loaded region features from {}, for {} images with {} regions".format(features_dir, len(self.index), self.meta['num_regions']))
+
+    @staticmethod
+    def exists(features_dir: str) -> bool:
+        # build_region_feature_store moves the store into place only once it is complete, with meta.json
+        return os.path.exists(os.path.join(features_dir, 'meta.json'))
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, image_id: int) -> bool:
+        row = np.searchsorted(self.image_ids, image_id)
+        return row < len(self.image_ids) and self.image_ids[row] == image_id
+
+    def __getstate__(self):
+        # The memory map is re-opened inside each DataLoader worker instead of being pickled
+        state = self.__dict__.copy()
+        state['_features'] = None
+        return state
+
+    def get_features_memmap(self) -> np.memmap:
+        if self._features is None:
+            self._features = np.memmap(features_filename(self.features_dir), dtype=REGION_FEATURES_DTYPE, mode='r',
+                                       shape=(self.meta['num_regions'], self.feature_dim))
+        return self._features
+
+    def get_num_regions(self, image_id: int) -> int:
+        '''
+        Returns the number of regions of an image, without touching the features
+        '''
+        return int(self.index[np.searchsorted(self.image_ids, image_id)]['num_regions'])
+
+    def get_features(self, image_id: int) -> np.ndarray:
+        '''
+        Returns a zero-copy (R, H) float16 view of the region features of an image
+        '''
+
+        row = np.searchsorted(self.image_ids, image_id)
+        assert row < len(self.image_ids) and self.image_ids[row] == image_id, "Image {} not found in {}".format(image_id, self.features_dir)
+        entry = self.index[row]
+        offset, num_regions = int(entry['offset']), int(entry['num_regions'])
+        return self.get_features_memmap()[offset: offset + num_regions]
+
+
+def read_region_features_tsv(tsv_path: str) -> Iterator[Tuple[int, np.ndarray]]:
+
+    '''
+    Yields the (image_id, (num_boxes, H) float32 features) of every image in a Faster R-CNN feature TSV file
+    Both the original bottom-up attention format and the LXMERT format (with object and attribute predictions) are read
+    '''
+
+    csv.field_size_limit(sys.maxsize)
+    with open(tsv_path) as f:
+        for row in csv.reader(f, delimiter='\t'):
+            if len(row) == len(LXMERT_TSV_FIELDNAMES):
+                item = dict(zip(LXMERT_TSV_FIELDNAMES, row))
+                image_name = item['img_id']
+            else:
+                assert len(row) == len(BOTTOM_UP_TSV_FIELDNAMES), "Unknown region feature format in {}".format(tsv_path)
+                item = dict(zip(BOTTOM_UP_TSV_FIELDNAMES, row))
+                image_name = item['image_id']
+            features = np.frombuffer(base64.b64decode(item['features']), dtype=np.float32)
+            yield parse_image_id(image_name), features.reshape(int(item['num_boxes']), -1)
+
+def read_region_features_npz(npz_dir: str) -> Iterator[Tuple[int, np.ndarray]]:
+
+    '''
+    Yields the (image_id, (num_boxes, H) features) of every image in a directory of per-image .npz files,
+    as written by the PyTorch bottom-up attention feature extractors (features stored under the key 'x')
+    '''
+
+    for fn in sorted(glob.glob(os.path.join(npz_dir, '*.npz'))):
+        yield parse_image_id(fn), np.load(fn)['x']
+
+def build_region_feature_store(region_features: Iterator[Tuple[int, np.ndarray]], features_dir: str, image_ids: List[int] = None):
+
+    '''
+    Writes the region features of every image once, as float16, into a region feature store in features_dir
+    The store is written to a temporary directory first and then replaces features_dir, so that readers never see a partially written store
+
+    region_features: iterator over (image_id, (R_i, H) features array) pairs
+    features_dir: output directory
+    image_ids: if given, features of other images are skipped (e.g. the images of the MS-COCO/Flickr30K dataset)
+    '''
+
+    tmp_dir = make_tmp_cache_dir(features_dir)
+    keep_ids = set(image_ids) if image_ids is not None else None
+
+    entries = []
+    seen_ids = set()
+    offset, feature_dim = 0, None
+    with open(features_filename(tmp_dir), 'wb') as features_file:
+        for image_id, features in tqdm(region_features, desc='Writing region features to {}'.format(features_dir)):
+            if image_id in seen_ids or (keep_ids is not None and image_id not in keep_ids):
+                continue
+            assert features.ndim == 2
+            if feature_dim is None:
+                feature_dim = features.shape[1]
+            assert features.shape[1] == feature_dim, "Image {} has features of size {}, expected {}".format(image_id, features.shape[1], feature_dim)
+
+            features_file.write(np.ascontiguousarray(features, dtype=REGION_FEATURES_DTYPE).tobytes())
+            entries.append((image_id, offset, len(features)))
+            seen_ids.add(image_id)
+            offset += len(features)
+
+    if len(entries) == 0:
+        shutil.rmtree(tmp_dir)
+        raise ValueError("No region features to write into {}{}".format(
+            features_dir, ' (none of the input images are in image_ids)' if keep_ids is not None else ''))
+
+    index = np.array(entries, dtype=REGION_INDEX_DTYPE)
+    index = index[np.argsort(index['image_id'], kind='stable')]
+    np.save(os.path.join(tmp_dir, 'index.npy'), index)
+    meta = {'num_images': len(index),
+            'num_regions': offset,
+            'feature_dim': feature_dim,
+            'dtype': np.dtype(REGION_FEATURES_DTYPE).name}
+    with open(os.path.join(tmp_dir, 'meta.json'), 'w') as f:
+        json.dump(meta, f)
+    replace_cache_dir(tmp_dir, features_dir)
+    if keep_ids is not None and len(index) < len(keep_ids):
+        logger.warning("Region features are missing for {} of the {} images".format(len(keep_ids) - len(index), len(keep_ids)))
+    logger.info("Wrote {} regions of {} images into {}".format(offset, len(index), features_dir))
+
+
+def main():
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--images_source", type=str, required=True, choices=['ms-coco', 'flickr30k'],
+                        help="Images dataset to build the region feature store for.")
+    parser.add_argument("--climb_data_dir", type=str, required=True,
+                        help="Directory where all the CLiMB data is stored")
+    parser.add_argument("--tsv_files", type=str, nargs='+', default=None,
+                        help="Faster R-CNN region feature TSV files (bottom-up attention or LXMERT format).")
+    parser.add_argument("--npz_dir", type=str, default=None,
+                        help="Directory of per-image .npz region feature files, used instead of --tsv_files.")
+    args = parser.parse_args()
+    assert (args.tsv_files is None) != (args.npz_dir is None), "Give exactly one of --tsv_files and --npz_dir"
+
+    if args.images_source == 'ms-coco':
+        from data.image_datasets.cocoimages_dataset import MSCOCOImagesDataset
+        images_dir = os.path.join(args.climb_data_dir, 'ms-coco/')
+        images_dataset = MSCOCOImagesDataset(images_dir, visual_input_type='pil-image')
+    else:
+        from data.image_datasets.flickr30kimages_dataset import Flickr30KImagesDataset
+        images_dir = os.path.join(args.climb_data_dir, 'flickr30k/')
+        images_dataset = Flickr30KImagesDataset(images_dir, visual_input_type='pil-image')
+
+    if args.tsv_files is not None:
+        region_features = (item for tsv_path in args.tsv_files for item in read_region_features_tsv(tsv_path))
+    else:
+        region_features = read_region_features_npz(args.npz_dir)
+
+    build_region_feature_store(region_features,
+                               features_dir=os.path.join(images_dir, REGION_FEATURES_DIRNAME),
+                               image_ids=images_dataset.imageids)
+
+if __name__ == '__main__':
+    sys.path.insert(0, '.')
+    main()
@@ -8,6 +8,8 @@ import torch
 import transformers
 from torch.utils.data import DataLoader, TensorDataset, Dataset
 from data.language_datasets.text_processors import *
+from data.text_collation import count_text_tokens
+from data.batch_samplers import LengthBucketedBatchSampler
 
 transformers.logging.set_verbosity_error()
 
@@ -17,7 +19,7 @@ logger.setLevel(logging.DEBUG)
 
 
 class LanguageDataset(Dataset):
-    def __init__(self, processor, data_dir, split, task_name, n_shot=None, seed=None):
+    def __init__(self, processor, data_dir, split, task_name, n_shot=None, seed=None, tokenizer=None):
         """
         Initiate the Dataset for language-only tasks - loads all the sentences and the corresponding labels into self.data
 
@@ -26,9 +28,12 @@ class LanguageDataset(Dataset):
         task_name: the name of the language-only task
         n_shot: n-shot per class for classification tasks; number of examples for multiple-choice tasks
         seed: random seed for low-shot subsampling
+        tokenizer: tokenizer of the backbone model, used to count the text tokens of every example
         """
 
         self.task_name = task_name
+        self.tokenizer = tokenizer
+        self.text_lengths = None
 
         if split == 'train':
             data = processor.get_train_examples(data_dir) # type: list
@@ -56,6 +61,20 @@ class LanguageDataset(Dataset):
     def __len__(self):
         return self.n_examples
 
+    def get_text_lengths(self):
+        '''
+        Returns the number of text tokens of every example, or of its longest choice for multiple-choice tasks (used by LengthBucketedBatchSampler)
+        '''
+        if self.text_lengths is None:
+            if self.task_name in ['sst2', 'imdb']:
+                text_key = 'sentence' if self.task_name == 'sst2' else 'text'
+                self.text_lengths = count_text_tokens([example[text_key] for example in self.data], self.tokenizer)
+            else:
+                choice_lengths = count_text_tokens([text for example in self.data for text in example['merged_text']], self.tokenizer)
+                choice_starts = np.cumsum([0] + [len(example['merged_text']) for example in self.data[:-1]])
+                self.text_lengths = np.maximum.reduceat(choice_lengths, choice_starts)
+        return self.text_lengths
+
     def __getitem__(self, index):
         example = self.data[index]
         if self.task_name == 'sst2': 
@@ -66,7 +85,7 @@ class LanguageDataset(Dataset):
             return example['text_a'], example['text_b'], example["label"]
 
 
-def get_data_loader(tokenizer, task_name, split, max_len, batch_size, num_workers, data_dir=None, n_shot=None, seed=None):
+def get_data_loader(tokenizer, task_name, split, max_len, batch_size, num_workers, data_dir=None, n_shot=None, seed=None, length_bucket_size=0):
     """
     Retrun a torch.utils.data.DataLoader for the dataset
 
@@ -79,6 +98,7 @@ def get_data_loader(tokenizer, task_name, split, max_len, batch_size, num_worker
     data_dir: path containing the dataset
     n_shot: n-shot per class for classification tasks; number of examples for multiple-choice tasks
     seed: random seed for low-shot subsampling
+    length_bucket_size: if > 0, training batches contain texts of similar lengths, sampled from buckets of length_bucket_size batches
     """
 
     task_name = task_name.lower()
@@ -86,9 +106,16 @@ def get_data_loader(tokenizer, task_name, split, max_len, batch_size, num_worker
         'imdb': IMDBProcessor, 'sst2': GLUEProcessor} 
     processor = processor_map[task_name]()
 
-    dataset = LanguageDataset(processor, data_dir, split, task_name, n_shot, seed)
+    dataset = LanguageDataset(processor, data_dir, split, task_name, n_shot, seed, tokenizer)
 
     # build dataloader
+    if split == 'train' and length_bucket_size > 0:
+        logger.info("Batching texts of similar lengths, from buckets of {} batches".format(length_bucket_size))
+        return DataLoader(
+            dataset,
+            batch_sampler=LengthBucketedBatchSampler(dataset, batch_size, length_bucket_size, max_length=max_len),
+            num_workers=num_workers,
+        )
     dataloader = DataLoader(
         dataset, 
         shuffle=(split=='train'), 
@@ -0,0 +1,111 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict, Callable, Iterable
+
+from torch.utils.data import Dataset, DataLoader, Sampler, BatchSampler, RandomSampler, SequentialSampler
+
+# Number of threads that read and decode the files of a batch in each DataLoader worker.
+# File reads (e.g. from NFS) and PIL decoding release the GIL, so they overlap across threads
+DEFAULT_NUM_IO_THREADS = 8
+
+_thread_pools = {}
+
+def get_thread_pool(num_threads: int = DEFAULT_NUM_IO_THREADS) -> ThreadPoolExecutor:
+    '''
+    Returns the thread pool of the current process
+    Pools are kept per process ID, because DataLoader workers are forked and the threads of the parent's pool do not exist in a worker
+    '''
+
+    key = (os.getpid(), num_threads)
+    if key not in _thread_pools:
+        _thread_pools[key] = ThreadPoolExecutor(max_workers=num_threads)
+    return _thread_pools[key]
+
+def map_in_threads(fn: Callable, items: Iterable, num_threads: int = DEFAULT_NUM_IO_THREADS) -> List:
+    '''
+    Returns [fn(x) for x in items], where the calls run concurrently in a bounded thread pool
+    '''
+
+    items = list(items)
+    if len(items) <= 1 or num_threads <= 1:
+        return [fn(x) for x in items]
+    return list(get_thread_pool(num_threads).map(fn, items))
+
+def load_unique_in_threads(load_fn: Callable, keys: Iterable, num_threads: int = DEFAULT_NUM_IO_THREADS) -> Dict:
+    '''
+    Loads every distinct key once (e.g. the images shared by several examples of a batch) concurrently, and returns a dictionary from key to load_fn(key)
+    '''
+
+    unique_keys = list(dict.fromkeys(keys))
+    return dict(zip(unique_keys, map_in_threads(load_fn, unique_keys, num_threads)))
+
+def get_default_batch_sampler(dataset: Dataset, batch_size: int, shuffle: bool) -> BatchSampler:
+    '''
+    Returns the batch sampler that DataLoader(dataset, batch_size=batch_size, shuffle=shuffle) would use
+    '''
+
+    sampler = RandomSampler(dataset) if shuffle else SequentialSampler(dataset)
+    return BatchSampler(sampler, batch_size, drop_last=False)
+
+class BatchIndexedDataset(Dataset):
+
+    def __init__(self, dataset: Dataset):
+        '''
+        Wraps a dataset, so that indexing with the index list of a whole batch returns dataset.__getitems__(indices)
+        Used by build_batched_dataloader - the other attributes of the dataset (e.g. split) are accessible through the wrapper
+
+        Args:
+        dataset: map-style dataset that implements __getitems__
+        '''
+
+        self.dataset = dataset
+
+    def __getattr__(self, name: str):
+        if name == 'dataset':
+            raise AttributeError(name)
+        return getattr(self.dataset, name)
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, indices: List[int]) -> List:
+        return self.dataset.__getitems__(indices)
+
+def build_batched_dataloader(dataset: Dataset, batch_sampler: Sampler, collate_fn: Callable, num_workers: int, **kwargs) -> DataLoader:
+    '''
+    Returns a DataLoader that loads every batch of batch_sampler with a single dataset.__getitems__(indices) call
+    (e.g. to load the images of a batch concurrently in a thread pool)
+
+    The DataLoader of the pinned torch version (1.10) calls dataset[i] for every index of a batch, and never calls __getitems__.
+    With batch_sampler as the sampler and automatic batching disabled (batch_size=None), it passes the index list of every batch to
+    dataset[...] instead - the dataset is wrapped in a BatchIndexedDataset, which dispatches the list to __getitems__.
+    collate_fn still receives the list of items of the batch. Use get_batch_size() to get the batch size of the returned DataLoader
+
+    Args:
+    dataset: map-style dataset that implements __getitems__, or the dataset of a DataLoader returned by this function
+    batch_sampler: sampler of index lists, e.g. the samplers in data.batch_samplers or get_default_batch_sampler()
+    collate_fn: collates the list of items of a batch
+    num_workers: number of DataLoader worker processes
+    kwargs: other DataLoader arguments (e.g. prefetch_factor)
+    '''
+
+    if not isinstance(dataset, BatchIndexedDataset):
+        dataset = BatchIndexedDataset(dataset)
+    return DataLoader(dataset,
+                      sampler=batch_sampler,
+                      batch_size=None,
+                      num_workers=num_workers,
+                      collate_fn=collate_fn,
+                      **kwargs)
+
+def get_batch_size(dataloader: DataLoader) -> int:
+    '''
+    Returns the batch size of dataloader - for DataLoaders with a batch sampler (including those returned by build_batched_dataloader),
+    dataloader.batch_size is None, and the batch size is read from the batch sampler
+    '''
+
+    if dataloader.batch_size is not None:
+        return dataloader.batch_size
+    if dataloader.batch_sampler is not None:
+        return dataloader.batch_sampler.batch_size
+    return dataloader.sampler.batch_size
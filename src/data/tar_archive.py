@@ -0,0 +1,268 @@
+import io
+import os
+import random
+import itertools
+import tarfile
+import logging
+from typing import List, Dict, Callable
+
+import numpy as np
+import torch
+from torch.utils.data import IterableDataset, get_worker_info
+
+from data.columnar_cache import ColumnarTable
+from data.file_manifest import MANIFESTS_DIRNAME, load_file_manifest
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(
+        format='%(asctime)s - %(levelname)s - %(name)s - %(message)s',
+        datefmt='%m/%d/%Y %H:%M:%S',
+        level=logging.INFO)
+
+TAR_INDEX_SCHEMA = {'name': 'str',
+                    'offset': 'int',
+                    'size': 'int'}
+
+def build_tar_index_columns(tar_path: str) -> Dict[str, List]:
+    '''
+    Reads the member headers of an uncompressed tar archive, and returns the name, data offset and size of every file in it
+    '''
+
+    names, offsets, sizes = [], [], []
+    # Compressed archives (e.g. .tar.gz) cannot be read at random offsets, and have to be decompressed (e.g. with gunzip) first
+    with tarfile.open(tar_path, 'r:') as tar:
+        for member in tar:
+            if member.isfile():
+                names.append(member.name)
+                offsets.append(member.offset_data)
+                sizes.append(member.size)
+            # Otherwise tarfile keeps the header of every member in memory
+            tar.members = []
+    return {'name': names, 'offset': offsets, 'size': sizes}
+
+
+class TarArchiveReader:
+
+    def __init__(self, tar_path: str, root_dir: str, archive_root: str = ''):
+        '''
+        Reads the files of a dataset directly from its (uncompressed) tar archive, without extracting it
+        The offsets of all files in the archive are stored in an index (a file manifest, see data.file_manifest), which is built once
+
+        Args:
+        tar_path: path of the tar archive
+        root_dir: dataset directory that the archive would be extracted to. Files are requested with their path in this directory (e.g. <root_dir>/train/<class>/<image>)
+        archive_root: directory inside the archive that corresponds to root_dir (e.g. 'places365_standard' for places365standard_easyformat.tar)
+        '''
+
+        self.tar_path = tar_path
+        self.root_dir = root_dir
+        self.archive_root = archive_root.strip('/')
+
+        index_dir = os.path.join(root_dir, MANIFESTS_DIRNAME, 'tar_index_{}'.format(os.path.basename(tar_path)))
+        index = load_file_manifest(index_dir, [tar_path], TAR_INDEX_SCHEMA, lambda: build_tar_index_columns(tar_path))
+
+        # Member names are kept sorted in a single bytes array, so that they are looked up with a binary search
+        # and shared by forked DataLoader workers (unlike a dictionary with millions of strings)
+        names = np.array([self.normalize_name(name).encode('utf-8') for name in index.get_column('name')])
+        order = np.argsort(names, kind='stable')
+        self.names = names[order]
+        self.offsets = np.asarray(index.arrays['offset'])[order]
+        self.sizes = np.asarray(index.arrays['size'])[order]
+        logger.info("Opened tar archive {} with {} files".format(tar_path, len(self.names)))
+
+        self._fd = None
+        self._fd_pid = None
+
+    def __getstate__(self):
+        # File descriptors are re-opened inside each process instead of being pickled
+        state = self.__dict__.copy()
+        state['_fd'], state['_fd_pid'] = None, None
+        return state
+
+    def normalize_name(self, name: str) -> str:
+        '''
+        Returns the path of an archive member relative to archive_root
+        '''
+
+        name = name[2:] if name.startswith('./') else name
+        if self.archive_root and name.startswith(self.archive_root + '/'):
+            name = name[len(self.archive_root)+1:]
+        return name
+
+    def get_member_name(self, filename: str) -> bytes:
+        return os.path.relpath(filename, self.root_dir).replace(os.sep, '/').encode('utf-8')
+
+    def get_row(self, filename: str) -> int:
+        name = self.get_member_name(filename)
+        row = np.searchsorted(self.names, name)
+        if row >= len(self.names) or self.names[row] != name:
+            raise FileNotFoundError("{} not found in tar archive {}".format(filename, self.tar_path))
+        return int(row)
+
+    def get_offset(self, filename: str) -> int:
+        return int(self.offsets[self.get_row(filename)])
+
+    def get_fd(self) -> int:
+        # DataLoader workers are forked, so every process opens its own file descriptor
+        if self._fd_pid != os.getpid():
+            self._fd = os.open(self.tar_path, os.O_RDONLY)
+            self._fd_pid = os.getpid()
+        return self._fd
+
+    def read(self, filename: str) -> bytes:
+        '''
+        Returns the content of a file in the archive (os.pread is safe to use from several threads)
+        '''
+
+        row = self.get_row(filename)
+        return os.pread(self.get_fd(), int(self.sizes[row]), int(self.offsets[row]))
+
+    def open(self, filename: str) -> io.BytesIO:
+        return io.BytesIO(self.read(filename))
+
+    def get_directory_names(self, dir_path: str) -> List[bytes]:
+        prefix = self.get_member_name(dir_path).rstrip(b'/') + b'/'
+        start = np.searchsorted(self.names, prefix)
+        end = np.searchsorted(self.names, prefix + b'\xff')
+        return [name[len(prefix):] for name in self.names[start: end].tolist()]
+
+    def listdir(self, dir_path: str) -> List[str]:
+        '''
+        Returns the sorted names of the files and sub-directories of a directory in the archive, like sorted(os.listdir())
+        '''
+
+        return sorted(set(name.split(b'/')[0].decode('utf-8') for name in self.get_directory_names(dir_path)))
+
+    def glob(self, dir_path: str, extension: str) -> List[str]:
+        '''
+        Returns the sorted filenames of the files with the given extension in a directory of the archive, like glob.glob(os.path.join(dir_path, '*' + extension))
+        '''
+
+        names = [name.decode('utf-8') for name in self.get_directory_names(dir_path) if b'/' not in name]
+        return [os.path.join(dir_path, name) for name in names if name.endswith(extension)]
+
+
+def open_dataset_archive(args, data_dir: str) -> TarArchiveReader:
+    '''
+    Returns the TarArchiveReader of a vision dataset if args.image_archive is given, otherwise None (images are read from the extracted files)
+    '''
+
+    if args.image_archive is None:
+        assert not args.stream_train_images, "--stream_train_images requires --image_archive"
+        return None
+    return TarArchiveReader(args.image_archive, data_dir, args.image_archive_root)
+
+def open_image_file(filename: str, archive: TarArchiveReader = None):
+    '''
+    Returns the path of an image file, or a file object with its content if the images are read from a tar archive
+    '''
+
+    return filename if archive is None else archive.open(filename)
+
+
+class TarStreamingDataset(IterableDataset):
+
+    def __init__(self, 
+                 archive: TarArchiveReader, 
+                 samples: ColumnarTable, 
+                 load_fn: Callable, 
+                 shuffle: bool = True, 
+                 shuffle_buffer_size: int = 1000, 
+                 shard_size: int = 1000, 
+                 num_open_shards: int = 16):
+        '''
+        Streams the samples of an image classification dataset from its tar archive, with sequential reads instead of random per-file reads
+
+        The samples (e.g. the n-shot training set returned by get_train_val_split) are sorted by their position in the archive and grouped into shards of consecutive files.
+        Archives usually store the images of a class together, so a shard holds only one or a few classes.
+        In every epoch, the shards are shuffled and assigned round-robin to the DataLoader workers. Every worker reads num_open_shards of its shards at a time,
+        interleaving their samples round-robin (each shard is still read sequentially), and passes them through a shuffle buffer,
+        so that batches mix images from many shards
+
+        Args:
+        archive: TarArchiveReader of the dataset
+        samples: ColumnarTable with the filename and label of every sample
+        load_fn: function that creates the image from a file object (e.g. the dataset's load_image)
+        shuffle: if True, shards and samples are shuffled, with a different order in every epoch
+        shuffle_buffer_size: number of (undecoded) samples kept in each worker's shuffle buffer
+        shard_size: number of samples per shard
+        num_open_shards: number of shards that every worker interleaves (if shuffle is True)
+        '''
+
+        self.archive = archive
+        self.samples = samples
+        self.load_fn = load_fn
+        self.shuffle = shuffle
+        self.shuffle_buffer_size = shuffle_buffer_size
+        self.num_open_shards = num_open_shards if shuffle else 1
+
+        offsets = np.array([archive.get_offset(fn) for fn in samples.get_column('filename')], dtype=np.int64)
+        order = np.argsort(offsets, kind='stable')
+        self.shards = [order[i: i+shard_size] for i in range(0, len(order), shard_size)]
+        logger.info("Streaming {} samples in {} shards from {}".format(len(samples), len(self.shards), archive.tar_path))
+        if shuffle and shuffle_buffer_size < shard_size:
+            logger.warning("The shuffle buffer ({} samples) is smaller than a shard ({} samples), so every batch only mixes samples of the {} shards "
+                           "that its worker interleaves, which may hold few classes - use a larger shuffle buffer or more open shards".format(
+                            shuffle_buffer_size, shard_size, self.num_open_shards))
+
+    def __len__(self):
+        return len(self.samples)
+
+    def read_shard(self, shard):
+        for i in shard:
+            example = self.samples[int(i)]
+            yield self.archive.read(example['filename']), example['label']
+
+    def interleave_shards(self, shard_nums: List[int]):
+        '''
+        Yields the samples of the shards, reading num_open_shards shards at a time and alternating between them round-robin
+        An exhausted shard is replaced with the next shard
+        '''
+
+        shard_nums = iter(shard_nums)
+        readers = [self.read_shard(self.shards[n]) for n in itertools.islice(shard_nums, self.num_open_shards)]
+        i = 0
+        while len(readers) > 0:
+            i %= len(readers)
+            sample = next(readers[i], None)
+            if sample is None:
+                next_shard_num = next(shard_nums, None)
+                if next_shard_num is None:
+                    readers.pop(i)
+                else:
+                    readers[i] = self.read_shard(self.shards[next_shard_num])
+                continue
+            yield sample
+            i += 1
+
+    def __iter__(self):
+        worker_info = get_worker_info()
+        if worker_info is None:
+            worker_id, num_workers = 0, 1
+            seed = int(torch.empty((), dtype=torch.int64).random_().item())
+        else:
+            # worker_info.seed is base_seed + worker id, where base_seed changes in every epoch and is the same for all workers,
+            # so that all workers shuffle the shards in the same order and read disjoint shards
+            worker_id, num_workers = worker_info.id, worker_info.num_workers
+            seed = worker_info.seed - worker_info.id
+        rng = random.Random(seed)
+
+        shard_order = list(range(len(self.shards)))
+        if self.shuffle:
+            rng.shuffle(shard_order)
+
+        buffer = []
+        for data, label in self.interleave_shards(shard_order[worker_id::num_workers]):
+            if not self.shuffle:
+                yield self.load_fn(io.BytesIO(data)), label
+                continue
+            buffer.append((data, label))
+            if len(buffer) >= self.shuffle_buffer_size:
+                j = rng.randrange(len(buffer))
+                buffer[j], buffer[-1] = buffer[-1], buffer[j]
+                data, label = buffer.pop()
+                yield self.load_fn(io.BytesIO(data)), label
+
+        rng.shuffle(buffer)
+        for data, label in buffer:
+            yield self.load_fn(io.BytesIO(data)), label
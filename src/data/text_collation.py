@@ -0,0 +1,90 @@
+
+import logging
+from typing import List, Dict
+
+import numpy as np
+import torch
+
+logger = logging.getLogger(__name__)
+
+def tokenize_texts(tokenizer, texts: List[str]) -> List[List[int]]:
+
+    """
+    Converts texts into input IDs (without special tokens), in a single batched tokenizer call
+
+    Args:
+    tokenizer: BertTokenizer/BertTokenizerFast instance
+    texts: list of text strings
+
+    Returns:
+    input_ids: list of input IDs for each text, same as tokenizer.convert_tokens_to_ids(tokenizer.tokenize(text))
+    """
+
+    return tokenizer(texts, add_special_tokens=False)['input_ids']
+
+def get_special_token_ids(tokenizer) -> Dict[str, int]:
+
+    """
+    Returns the ids of the tokenizer's [PAD], [CLS] and [SEP] tokens, which collate_text_encodings adds to pre-tokenized texts
+
+    Args:
+    tokenizer: BertTokenizer/BertTokenizerFast instance (e.g. the model's processor.tokenizer)
+    """
+
+    return {'pad_token_id': tokenizer.pad_token_id,
+            'cls_token_id': tokenizer.cls_token_id,
+            'sep_token_id': tokenizer.sep_token_id}
+
+def collate_text_encodings(input_ids: List[List[int]],
+                           max_text_length: int,
+                           special_token_ids: Dict[str, int]) -> Dict:
+
+    """
+    Creates the text tensors that ViLT's processor would create for pre-tokenized texts:
+    [CLS] and [SEP] tokens are added, texts are truncated to max_text_length tokens (including special tokens) and padded to the longest text
+
+    Args:
+    input_ids: list of B input IDs (without special tokens)
+    max_text_length: maximum number of text tokens of the model
+    special_token_ids: ids of the tokenizer's special tokens (see get_special_token_ids)
+
+    Returns:
+    text_encodings: dictionary with input_ids, attention_mask and token_type_ids LongTensors of size (B, max_len)
+    """
+
+    cls_token_id, sep_token_id = special_token_ids['cls_token_id'], special_token_ids['sep_token_id']
+    input_ids = [[cls_token_id] + ids[:max_text_length-2] + [sep_token_id] for ids in input_ids]
+    max_len = max([len(ids) for ids in input_ids])
+    input_ids_padded = torch.full((len(input_ids), max_len), special_token_ids['pad_token_id'], dtype=torch.long)
+    attention_mask = torch.zeros(len(input_ids), max_len, dtype=torch.long)
+    for i, ids in enumerate(input_ids):
+        input_ids_padded[i, :len(ids)] = torch.tensor(ids, dtype=torch.long)
+        attention_mask[i, :len(ids)] = 1
+    return {'input_ids': input_ids_padded,
+            'attention_mask': attention_mask,
+            'token_type_ids': torch.zeros_like(input_ids_padded)}
+
+_length_tokenizer = None
+
+def count_text_tokens(texts: List[str], tokenizer=None) -> np.ndarray:
+
+    """
+    Returns the number of tokens of each text, including the [CLS] and [SEP] tokens (used to batch texts of similar lengths together)
+
+    Args:
+    texts: list of text strings
+    tokenizer: BertTokenizer/BertTokenizerFast instance. If not given, ViLT's bert-base-uncased tokenizer is loaded once
+
+    Returns:
+    lengths: int64 array with the number of tokens of every text
+    """
+
+    global _length_tokenizer
+    if tokenizer is None:
+        if _length_tokenizer is None:
+            from transformers import BertTokenizerFast
+            _length_tokenizer = BertTokenizerFast.from_pretrained('bert-base-uncased')
+        tokenizer = _length_tokenizer
+    if len(texts) == 0:
+        return np.zeros(0, dtype=np.int64)
+    return np.array([len(ids) + 2 for ids in tokenize_texts(tokenizer, texts)], dtype=np.int64)
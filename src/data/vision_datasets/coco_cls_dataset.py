@@ -18,17 +18,23 @@ from torch.utils.data import Dataset
 from PIL import Image
 from pycocotools.coco import COCO
 
+from utils.image_utils import load_resized_pil_image
+from data.image_datasets.image_shards import ImageShardCache, IMAGE_SHARDS_DIRNAME
+from data.columnar_cache import ColumnarTable
+from data.parallel_loading import map_in_threads, build_batched_dataloader, get_default_batch_sampler
+
 logger = logging.getLogger(__name__)
 logging.basicConfig(
         format='%(asctime)s - %(levelname)s - %(name)s - %(message)s',
         datefmt='%m/%d/%Y %H:%M:%S',
         level=logging.INFO)
 
-
+COCO_CLS_DATA_SCHEMA = {'filename': 'str',
+                        'class_ids': 'list<int>'}
 
 class CocoClsDataset(Dataset):
 
-    def __init__(self, data_dir, mode, n_shot=None, subsample_seed=None):
+    def __init__(self, data_dir, mode, n_shot=None, subsample_seed=None, use_image_shards=False):
         """
         Initiate the Dataset - loads all the image filenames and the corresponding labels into self.dataset
 
@@ -36,6 +42,7 @@ class CocoClsDataset(Dataset):
         mode: either train/val/test
         n_shot (float): ratio for low-shot subsampling
         subsampled_seed: random seed for low-shot subsampling
+        use_image_shards: read pre-decoded images from the MS-COCO image shards instead of the image files
         """
 
         self.data_dir = data_dir
@@ -49,6 +56,13 @@ class CocoClsDataset(Dataset):
         self.fn_mode = remap_mode[mode] 
         self.annot_file = os.path.join(data_dir, 'detections', 'annotations', f'instances_{self.fn_mode}2017.json')
 
+        # Shards are shared with MSCOCOImagesDataset, which uses the same resizing as pil_transform
+        self.image_shards = None
+        if use_image_shards:
+            shards_dir = os.path.join(data_dir, IMAGE_SHARDS_DIRNAME)
+            assert ImageShardCache.exists(shards_dir), "Image shards not found in {}, build them with data.image_datasets.image_shards".format(shards_dir)
+            self.image_shards = ImageShardCache(shards_dir)
+
         self.preprocess()
 
 
@@ -56,29 +70,30 @@ class CocoClsDataset(Dataset):
         """
         Split the validation set from the original training set and do low-shot subsampling
 
-        dataset: the original training set
+        dataset: the original training set (ColumnarTable)
         val_ratio: the ratio to split the validation set
         """
 
-        train_dataset, val_dataset = [], []
         # shuffle before train/val split
+        # (shuffling row indices gives the same order as shuffling the list of examples)
+        indices = list(range(len(dataset)))
         random.seed(2022)
-        random.shuffle(dataset)
+        random.shuffle(indices)
         n_val = int(len(dataset)*val_ratio)
 
         if self.mode == 'val': 
-            val_dataset = dataset[: n_val]
-            return val_dataset
+            val_indices = indices[: n_val]
+            return dataset.select(val_indices)
 
-        train_dataset = dataset[n_val: ]
+        train_indices = indices[n_val: ]
         #subsample the training set with different seeds
         random.seed(self.subsample_seed)
-        random.shuffle(train_dataset)
+        random.shuffle(train_indices)
         n_train = int(self.n_shot * len(dataset))
-        assert n_train < len(train_dataset)
-        train_dataset = train_dataset[: n_train]
+        assert n_train < len(train_indices)
+        train_indices = train_indices[: n_train]
 
-        return train_dataset
+        return dataset.select(train_indices)
 
 
     def preprocess(self):
@@ -88,12 +103,17 @@ class CocoClsDataset(Dataset):
         We formulate the task as a multi-label object classification task
         """
 
-        cached_fn = os.path.join(self.data_dir, f'cached_{self.fn_mode}.pkl')
-        try:
-            with open(cached_fn, 'rb') as f:
-                dataset = pickle.load(f)
+        cached_fn = os.path.join(self.data_dir, f'cached_{self.fn_mode}')
+        dataset = ColumnarTable.load(cached_fn, COCO_CLS_DATA_SCHEMA, [self.annot_file])
+        if dataset is None and os.path.exists(cached_fn + '.pkl') and not os.path.exists(self.annot_file):
+            # Convert the old pickled cache, if the annotations are not available
+            with open(cached_fn + '.pkl', 'rb') as f:
+                dataset = [{'filename': img_fn, 'class_ids': class_ids} for img_fn, class_ids in pickle.load(f)]
+            dataset = ColumnarTable.from_records(dataset, COCO_CLS_DATA_SCHEMA)
+            dataset.save(cached_fn, [self.annot_file])
+        elif dataset is not None:
             logger.info(f"Loaded cached file from {cached_fn}!")
-        except FileNotFoundError:
+        else:
             coco = COCO(self.annot_file)
             cat_ids = sorted(list(coco.catToImgs.keys()))
             cat2cls = {cat_i: i for i, cat_i in enumerate(cat_ids)}
@@ -110,10 +130,10 @@ class CocoClsDataset(Dataset):
             for img_i in sorted_img_ids:
                 img_fn = os.path.join(self.images_dir, "{:012d}.jpg".format(img_i))
                 class_ids = img2classes[img_i] # list
-                dataset.append([img_fn, class_ids])
+                dataset.append({'filename': img_fn, 'class_ids': class_ids})
 
-            with open(cached_fn, 'wb') as f:
-                pickle.dump(dataset, f)
+            dataset = ColumnarTable.from_records(dataset, COCO_CLS_DATA_SCHEMA)
+            dataset.save(cached_fn, [self.annot_file])
             logger.info(f"Dumped cached file to {cached_fn}!")
 
         if self.mode == 'test':
@@ -127,28 +147,39 @@ class CocoClsDataset(Dataset):
 
     def __getitem__(self, i):
         labels = torch.zeros(80, dtype=torch.float)
-        filename, class_ids = self.dataset[i]
+        example = self.dataset[i]
+        filename, class_ids = example['filename'], example['class_ids']
         labels[class_ids] = 1
-        image = Image.open(filename)
-        image = image.convert('RGB')
-        if min(list(image.size)) > 384:
-            image = self.pil_transform(image)
+        if self.image_shards is not None:
+            image_id = int(os.path.basename(filename).split('.')[0])
+            return self.image_shards.get_image_array(image_id), labels
+        image = load_resized_pil_image(filename, short_side=384, max_size=640)
 
         return image, labels
 
+    def __getitems__(self, indices):
+        # Batched version of __getitem__, called with the index list of a batch: the images of a batch are read and decoded concurrently in a thread pool
+        return map_in_threads(self.__getitem__, indices)
+
     def __len__(self):
         return self.num_images
 
 
-def batch_collate(batch):
+def batch_collate(batch, batch_encoder=None):
     pil_objs, labels = zip(*batch)
     raw_texts = ['This is an image.' for _ in range(len(labels))]
-    return {'raw_texts': raw_texts, 
-            'images': pil_objs, 
-            'labels': torch.stack(labels)}
+    collated_batch = {'raw_texts': raw_texts, 
+                      'images': pil_objs, 
+                      'labels': torch.stack(labels)}
+
+    if batch_encoder is not None:
+        # Only tensors are sent back to the main process
+        collated_batch['encodings'] = batch_encoder(pil_objs, raw_texts)
+        collated_batch['images'] = None
+    return collated_batch
 
 
-def get_data_loader(args, data_dir, split, n_shot=None, subsampled_seed=None):
+def get_data_loader(args, data_dir, split, n_shot=None, subsampled_seed=None, batch_encoder=None):
     """
     Retrun a torch.utils.data.DataLoader for the dataset
 
@@ -157,19 +188,18 @@ def get_data_loader(args, data_dir, split, n_shot=None, subsampled_seed=None):
     split: either train/val/test split
     n_shot (float): ratio for low-shot subsampling
     subsampled_seed: random seed for low-shot subsampling
+    batch_encoder: model's ViltBatchEncoder - if given, model input tensors are created in the DataLoader workers
     """
 
     logger.info(f"Creating COCO-classification {split} dataloader")
 
-    dataset = CocoClsDataset(data_dir, split, n_shot, subsampled_seed)
+    dataset = CocoClsDataset(data_dir, split, n_shot, subsampled_seed, use_image_shards=args.use_image_shards)
     batch_size = args.batch_size if split == 'train' else 128
-    dataloader = torch.utils.data.DataLoader(
+    dataloader = build_batched_dataloader(
         dataset,
-        num_workers = args.num_workers,
-        batch_size = batch_size,
-        shuffle = (split=='train'),
-        collate_fn = lambda x: batch_collate(x)
-        )
+        get_default_batch_sampler(dataset, batch_size, (split=='train')),
+        collate_fn=lambda x: batch_collate(x, batch_encoder),
+        num_workers=args.num_workers)
     return dataloader
 
 if __name__ == '__main__':
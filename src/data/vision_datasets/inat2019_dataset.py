@@ -17,16 +17,26 @@ from torchvision import transforms as T
 from torch.utils.data import Dataset
 from PIL import Image
 
+from utils.image_utils import load_resized_pil_image
+from data.columnar_cache import build_image_label_table
+from data.parallel_loading import map_in_threads, build_batched_dataloader, get_default_batch_sampler
+from data.tar_archive import TarStreamingDataset, open_dataset_archive, open_image_file
+from data.file_manifest import MANIFESTS_DIRNAME, load_file_manifest
+
 logger = logging.getLogger(__name__)
 logging.basicConfig(
         format='%(asctime)s - %(levelname)s - %(name)s - %(message)s',
         datefmt='%m/%d/%Y %H:%M:%S',
         level=logging.INFO)
 
+INAT_MANIFEST_SCHEMA = {'filename': 'str',
+                        'label': 'int',
+                        'width': 'int',
+                        'height': 'int'}
 
 class iNat2019Dataset(Dataset):
 
-    def __init__(self, data_dir, mode, n_shot=None, subsample_seed=None):
+    def __init__(self, data_dir, mode, n_shot=None, subsample_seed=None, archive=None):
         """
         Initiate the Dataset - loads all the image filenames and the corresponding labels into self.dataset
 
@@ -34,8 +44,10 @@ class iNat2019Dataset(Dataset):
         mode: either train/val/test
         n_shot: n-shot per class
         subsampled_seed: random seed for low-shot subsampling
+        archive: if given, images are read from this data.tar_archive.TarArchiveReader instead of the extracted files
         """
 
+        self.archive = archive
         self.data_dir = data_dir
         self.mode = mode
         self.n_shot = n_shot
@@ -44,6 +56,7 @@ class iNat2019Dataset(Dataset):
 
         remap_mode = {'train':'train', 'val':'train', 'test':'val'}
         self.annot_file = os.path.join(data_dir, f'{remap_mode[mode]}2019.json')
+        self.manifest_dir = os.path.join(data_dir, MANIFESTS_DIRNAME, f'inat2019_{remap_mode[mode]}')
 
         self.preprocess()
 
@@ -84,62 +97,87 @@ class iNat2019Dataset(Dataset):
             return val_dataset
             
 
-    def preprocess(self):
+    def build_manifest_columns(self):
         """
-        Preprocess train/val/test sets, where we split the val set from the training set
-        and use the origianl val set as the test set
-        Balance each class in the training set and validation set when doing low-shot sampling
+        Reads the filenames, labels and sizes of all images from the annotation file
         """
 
         with open(self.annot_file) as f:
             ann_data = json.load(f)
 
-        all_img_fns = [a['file_name'] for a in ann_data['images']]
+        all_img_fns = [os.path.join(self.data_dir, a['file_name']) for a in ann_data['images']]
         all_labels = [a['category_id'] for a in ann_data['annotations']]
-
         assert len(all_img_fns) == len(all_labels)
+
+        return {'filename': all_img_fns,
+                'label': all_labels,
+                'width': [a['width'] for a in ann_data['images']],
+                'height': [a['height'] for a in ann_data['images']]}
+
+
+    def preprocess(self):
+        """
+        Preprocess train/val/test sets, where we split the val set from the training set
+        and use the origianl val set as the test set
+        Balance each class in the training set and validation set when doing low-shot sampling
+        """
+
+        # The annotation JSON is only parsed when the manifest of filenames, labels and image sizes is built
+        manifest = load_file_manifest(self.manifest_dir, [self.annot_file], INAT_MANIFEST_SCHEMA, self.build_manifest_columns)
+        all_img_fns = manifest.get_column('filename')
+        all_labels = manifest.get_column('label')
+
         assert len(set(all_labels)) == 1010
 
         if self.mode == 'test':
-            self.dataset = []
-            for label, fn in zip(all_labels, all_img_fns):
-                fn = os.path.join(self.data_dir, fn)
-                self.dataset.append([fn, label])
+            self.dataset = [[fn, label] for label, fn in zip(all_labels, all_img_fns)]
 
         else: # train & val are split from the original training set
             dataset = [[] for _ in range(1010)]
             for label, fn in zip(all_labels, all_img_fns):
-                fn = os.path.join(self.data_dir, fn)
                 dataset[label].append([fn, label])
 
             self.dataset = self.get_train_val_split(dataset)
 
+        # Compact table of filenames and labels, which forked DataLoader workers share instead of copying
+        self.dataset = build_image_label_table(self.dataset)
         self.num_images = len(self.dataset)
         logger.info(f'# {self.num_images} images in {self.mode} set')
 
 
     def __getitem__(self, index):
-        filename, label = self.dataset[index]
-        image = Image.open(filename)
-        image = image.convert('RGB')
-        if min(list(image.size)) > 384:
-            image = self.pil_transform(image)
+        example = self.dataset[index]
+        filename, label = example['filename'], example['label']
+        image = self.load_image(open_image_file(filename, self.archive))
 
         return image, label
 
+    def load_image(self, image_file):
+        return load_resized_pil_image(image_file, short_side=384, max_size=640)
+
+    def __getitems__(self, indices):
+        # Batched version of __getitem__, called with the index list of a batch: the images of a batch are read and decoded concurrently in a thread pool
+        return map_in_threads(self.__getitem__, indices)
+
     def __len__(self):
         return self.num_images
 
 
-def batch_collate(batch):
+def batch_collate(batch, batch_encoder=None):
     pil_objs, labels = zip(*batch)
     raw_texts = ['This is an image.' for _ in range(len(labels))]
-    return {'raw_texts': raw_texts, 
-            'images': pil_objs, 
-            'labels': torch.LongTensor(labels)}    
+    collated_batch = {'raw_texts': raw_texts, 
+                      'images': pil_objs, 
+                      'labels': torch.LongTensor(labels)}
+
+    if batch_encoder is not None:
+        # Only tensors are sent back to the main process
+        collated_batch['encodings'] = batch_encoder(pil_objs, raw_texts)
+        collated_batch['images'] = None
+    return collated_batch
 
 
-def get_data_loader(args, data_dir, split, n_shot=None, subsampled_seed=None):
+def get_data_loader(args, data_dir, split, n_shot=None, subsampled_seed=None, batch_encoder=None):
     """
     Retrun a torch.utils.data.DataLoader for the dataset
 
@@ -148,17 +186,30 @@ def get_data_loader(args, data_dir, split, n_shot=None, subsampled_seed=None):
     split: either train/val/test split
     n_shot: n-shot per class
     subsampled_seed: random seed for low-shot subsampling
+    batch_encoder: model's ViltBatchEncoder - if given, model input tensors are created in the DataLoader workers
     """
 
     logger.info(f"Creating iNat2019Dataset {split} dataloader")
 
-    dataset = iNat2019Dataset(data_dir, split, n_shot, subsampled_seed)
+    archive = open_dataset_archive(args, data_dir)
+    dataset = iNat2019Dataset(data_dir, split, n_shot, subsampled_seed, archive=archive)
+    streaming = (split == 'train' and args.stream_train_images)
+    if streaming:
+        # Training images are read sequentially from the tar archive, instead of randomly
+        dataset = TarStreamingDataset(archive, dataset.dataset, dataset.load_image,
+                                      shuffle_buffer_size=args.shuffle_buffer_size, num_open_shards=args.stream_open_shards)
     batch_size = args.batch_size if split == 'train' else 128
-    dataloader = torch.utils.data.DataLoader(
+    if streaming:
+        dataloader = torch.utils.data.DataLoader(
+            dataset,
+            num_workers = args.num_workers,
+            batch_size = batch_size,
+            collate_fn = lambda x: batch_collate(x, batch_encoder)
+            )
+        return dataloader
+    dataloader = build_batched_dataloader(
         dataset,
-        num_workers = args.num_workers,
-        batch_size = batch_size,
-        shuffle = (split=='train'),
-        collate_fn = lambda x: batch_collate(x)
-        )
+        get_default_batch_sampler(dataset, batch_size, (split=='train')),
+        collate_fn=lambda x: batch_collate(x, batch_encoder),
+        num_workers=args.num_workers)
     return dataloader
@@ -17,6 +17,11 @@ from torchvision import transforms as T
 from torch.utils.data import Dataset
 from PIL import Image
 
+from data.columnar_cache import build_image_label_table
+from data.parallel_loading import map_in_threads, build_batched_dataloader, get_default_batch_sampler
+from data.tar_archive import TarStreamingDataset, open_dataset_archive, open_image_file
+from data.file_manifest import MANIFESTS_DIRNAME, load_class_directory_manifest
+
 logger = logging.getLogger(__name__)
 logging.basicConfig(
         format='%(asctime)s - %(levelname)s - %(name)s - %(message)s',
@@ -26,7 +31,7 @@ logging.basicConfig(
 
 class Places365Dataset(Dataset):
 
-    def __init__(self, data_dir, mode, n_shot=None, subsample_seed=None):
+    def __init__(self, data_dir, mode, n_shot=None, subsample_seed=None, archive=None):
         """
         Initiate the Dataset - loads all the image filenames and the corresponding labels into self.dataset
 
@@ -34,10 +39,13 @@ class Places365Dataset(Dataset):
         mode: either train/val/test
         n_shot: n-shot per class
         subsampled_seed: random seed for low-shot subsampling
+        archive: if given, images are read from this data.tar_archive.TarArchiveReader instead of the extracted files
         """
 
+        self.archive = archive
         remap_mode = {'train':'train', 'val':'train', 'test':'val'}
         self.image_dir = os.path.join(data_dir, remap_mode[mode])
+        self.manifest_dir = os.path.join(data_dir, MANIFESTS_DIRNAME, 'places365_{}'.format(remap_mode[mode]))
         self.mode = mode
         self.n_shot = n_shot
         self.subsample_seed = subsample_seed
@@ -83,52 +91,65 @@ class Places365Dataset(Dataset):
         and use the origianl val set as the test set
         Balance each class in the training set and validation set when doing low-shot sampling
         """
-        all_classes = sorted(os.listdir(self.image_dir))
+        all_classes = sorted(os.listdir(self.image_dir)) if self.archive is None else self.archive.listdir(self.image_dir)
         assert len(all_classes) == 365
 
+        # Filenames and labels are read from a persistent manifest, instead of globbing every class directory
+        manifest = load_class_directory_manifest(self.manifest_dir, self.image_dir, all_classes, '.jpg', self.archive)
+        samples = [[fn, label] for fn, label in zip(manifest.get_column('filename'), manifest.get_column('label'))]
+
         if self.mode == 'test':
-            self.dataset = []
-            for label, dir_name in enumerate(all_classes):
-                filenames = glob.glob(os.path.join(self.image_dir, dir_name, '*.jpg'))
-                for fn in filenames:
-                    self.dataset.append([fn, label])
+            self.dataset = samples
 
         else:
             dataset = [[] for _ in range(len(all_classes))]
-            n_imgs = 0
-            for label, dir_name in enumerate(all_classes):
-                filenames = glob.glob(os.path.join(self.image_dir, dir_name, '*.jpg'))
-                for fn in filenames:
-                    dataset[label].append([fn, label])
-                    n_imgs += 1
+            for sample in samples:
+                dataset[sample[1]].append(sample)
 
             self.dataset = self.get_train_val_split(dataset)
 
+        # Compact table of filenames and labels, which forked DataLoader workers share instead of copying
+        self.dataset = build_image_label_table(self.dataset)
         self.num_images = len(self.dataset)
         logger.info(f'# {self.num_images} images in {self.mode} set')
 
 
     def __getitem__(self, index):
-        filename, label = self.dataset[index]
-        image = Image.open(filename)
+        example = self.dataset[index]
+        filename, label = example['filename'], example['label']
+        image = self.load_image(open_image_file(filename, self.archive))
+
+        return image, label
+
+    def load_image(self, image_file):
+        image = Image.open(image_file)
         image = image.convert('RGB')
         # Note: all images in Places365-256 are 256x256 => no need to resize
+        return image
 
-        return image, label
+    def __getitems__(self, indices):
+        # Batched version of __getitem__, called with the index list of a batch: the images of a batch are read and decoded concurrently in a thread pool
+        return map_in_threads(self.__getitem__, indices)
 
     def __len__(self):
         return self.num_images
 
 
-def batch_collate(batch):
+def batch_collate(batch, batch_encoder=None):
     pil_objs, labels = zip(*batch)
     raw_texts = ['This is an image.' for _ in range(len(labels))]
-    return {'raw_texts': raw_texts, 
-            'images': pil_objs, 
-            'labels': torch.LongTensor(labels)}    
+    collated_batch = {'raw_texts': raw_texts, 
+                      'images': pil_objs, 
+                      'labels': torch.LongTensor(labels)}
+
+    if batch_encoder is not None:
+        # Only tensors are sent back to the main process
+        collated_batch['encodings'] = batch_encoder(pil_objs, raw_texts)
+        collated_batch['images'] = None
+    return collated_batch
 
 
-def get_data_loader(args, data_dir, split, n_shot=None, subsampled_seed=None):
+def get_data_loader(args, data_dir, split, n_shot=None, subsampled_seed=None, batch_encoder=None):
     """
     Retrun a torch.utils.data.DataLoader for the dataset
 
@@ -137,17 +158,30 @@ def get_data_loader(args, data_dir, split, n_shot=None, subsampled_seed=None):
     split: either train/val/test split
     n_shot: n-shot per class
     subsampled_seed: random seed for low-shot subsampling
+    batch_encoder: model's ViltBatchEncoder - if given, model input tensors are created in the DataLoader workers
     """
 
     logger.info(f"Creating Places365 {split} dataloader")
 
-    dataset = Places365Dataset(data_dir, split, n_shot, subsampled_seed)
+    archive = open_dataset_archive(args, data_dir)
+    dataset = Places365Dataset(data_dir, split, n_shot, subsampled_seed, archive=archive)
+    streaming = (split == 'train' and args.stream_train_images)
+    if streaming:
+        # Training images are read sequentially from the tar archive, instead of randomly
+        dataset = TarStreamingDataset(archive, dataset.dataset, dataset.load_image,
+                                      shuffle_buffer_size=args.shuffle_buffer_size, num_open_shards=args.stream_open_shards)
     batch_size = args.batch_size if split == 'train' else 128
-    dataloader = torch.utils.data.DataLoader(
+    if streaming:
+        dataloader = torch.utils.data.DataLoader(
+            dataset,
+            num_workers = args.num_workers,
+            batch_size = batch_size,
+            collate_fn = lambda x: batch_collate(x, batch_encoder)
+            )
+        return dataloader
+    dataloader = build_batched_dataloader(
         dataset,
-        num_workers = args.num_workers,
-        batch_size = batch_size,
-        shuffle = (split=='train'),
-        collate_fn = lambda x: batch_collate(x)
-        )
+        get_default_batch_sampler(dataset, batch_size, (split=='train')),
+        collate_fn=lambda x: batch_collate(x, batch_encoder),
+        num_workers=args.num_workers)
     return dataloader
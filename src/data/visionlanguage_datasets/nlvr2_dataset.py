@@ -5,6 +5,7 @@ import json
 import jsonlines
 import logging
 import glob
+import itertools
 from tqdm import tqdm
 import pickle
 import pdb
@@ -19,13 +20,23 @@ import random
 from PIL import Image
 from torchvision import transforms as T
 
+from utils.image_utils import load_resized_pil_image
+from data.columnar_cache import ColumnarTable
+from data.text_collation import count_text_tokens
+from data.batch_samplers import LengthBucketedBatchSampler
+from data.parallel_loading import load_unique_in_threads, build_batched_dataloader, get_default_batch_sampler
+
 logger = logging.getLogger(__name__)
 logging.basicConfig(
         format='%(asctime)s - %(levelname)s - %(name)s - %(message)s',
         datefmt='%m/%d/%Y %H:%M:%S',
         level=logging.INFO)
 
-
+NLVR2_DATA_SCHEMA = {'id': 'str',
+                     'image_id_0': 'str',
+                     'image_id_1': 'str',
+                     'sentence': 'str',
+                     'labels': 'int'}
 
 class NLVR2Dataset(Dataset):
 
@@ -43,7 +54,7 @@ class NLVR2Dataset(Dataset):
         split: either train/val/test split
 
         Returns:
-        Loads all annotations into self.data, where each item is a single NLVR2 input
+        Loads all annotations into self.data (a memory-mapped ColumnarTable), where each item is a single NLVR2 input
         """
 
         self.data_dir = data_dir
@@ -55,13 +66,17 @@ class NLVR2Dataset(Dataset):
         self.image_dir = os.path.join(data_dir, 'images', _split)
 
         # Load if cached data exist
-        self.cached_data_file = os.path.join(data_dir, 'cached_nlvr2_data', f'{_split}.pkl')
-        if os.path.exists(self.cached_data_file):
-            with open(self.cached_data_file, 'rb') as f:
-                self.data = pickle.load(open(self.cached_data_file, 'rb'))
-        else:
-            annotations_file = os.path.join(data_dir, 'data', f'{_split}.json')
-
+        self.cached_data_file = os.path.join(data_dir, 'cached_nlvr2_data', f'{_split}')
+        annotations_file = os.path.join(data_dir, 'data', f'{_split}.json')
+        self.source_files = [annotations_file]
+        pickled_data_file = self.cached_data_file + '.pkl'
+        self.data = ColumnarTable.load(self.cached_data_file, NLVR2_DATA_SCHEMA, self.source_files)
+        if self.data is None and os.path.exists(pickled_data_file) and not os.path.exists(annotations_file):
+            # Convert the old pickled cache, if the annotations are not available
+            with open(pickled_data_file, 'rb') as f:
+                self.data = ColumnarTable.from_records(pickle.load(f), NLVR2_DATA_SCHEMA)
+            self.data.save(self.cached_data_file, self.source_files)
+        elif self.data is None:
             self.data = []
             # https://github.com/facebookresearch/vilbert-multi-task/blob/main/vilbert/datasets/nlvr2_dataset.py
             with jsonlines.open(annotations_file) as reader:
@@ -79,23 +94,42 @@ class NLVR2Dataset(Dataset):
                     example["labels"] = 0 if str(annotation["label"]) == "False" else 1
                     self.data.append(example)
 
-            with open(self.cached_data_file, 'wb') as f:
-                pickle.dump(self.data, f)
+            self.data = ColumnarTable.from_records(self.data, NLVR2_DATA_SCHEMA)
+            self.data.save(self.cached_data_file, self.source_files)
 
         self.n_examples = len(self.data)
         logger.info("Loaded NLVRv2 {} dataset, with {} examples".format(split, self.n_examples))
         self.pil_transform = T.Resize(size=384, max_size=640)
+        self.text_lengths = None
 
     def get_pil_image(self, image_fn):
-        image = Image.open(image_fn)
-        image = image.convert('RGB')
-        if min(list(image.size)) > 384:
-            image = self.pil_transform(image)
+        image = load_resized_pil_image(image_fn, short_side=384, max_size=640)
         return image
 
     def __len__(self):
         return self.n_examples
 
+    def get_text_lengths(self) -> np.ndarray:
+        '''
+        Returns the number of text tokens of every example in self.data (used by LengthBucketedBatchSampler)
+        Sentences are tokenized once, and again only if self.data is replaced (e.g. by convert_to_low_shot)
+        '''
+        if self.text_lengths is None or self.text_lengths[0] is not self.data:
+            self.text_lengths = (self.data, count_text_tokens(self.data.get_column('sentence')))
+        return self.text_lengths[1]
+
+    def get_example_ids(self) -> List[str]:
+        '''
+        Returns the identifier of every example in self.data (used to key cached encoder features to the examples)
+        '''
+        return self.data.get_column('id')
+
+    def get_target(self, index: int) -> Dict:
+        '''
+        Returns only the targets of an example, without loading its images (used when training on cached encoder features)
+        '''
+        return {'labels': self.data[index]['labels']}
+
     def __getitem__(self, index: int):
 
         """
@@ -115,6 +149,27 @@ class NLVR2Dataset(Dataset):
                 'image': image, 
                 'label': example["labels"]}
 
+    def __getitems__(self, indices: List[int]) -> List[Dict]:
+
+        """
+        Batched version of __getitem__, called with all indices of a batch by DataLoaders from data.parallel_loading.build_batched_dataloader
+        Both images of every example are read and decoded concurrently in a thread pool (each distinct image once)
+
+        Args:
+        indices : indices of elements in self.data to return as data instances
+
+        Returns:
+        list of dictionaries, same as [self[i] for i in indices]
+        """
+
+        examples = [self.data[i] for i in indices]
+        image_fns = [example[key] for example in examples for key in ["image_id_0", "image_id_1"]]
+        fn2image = load_unique_in_threads(self.get_pil_image, image_fns)
+
+        return [{'text': example["sentence"], 
+                 'image': [fn2image[example["image_id_0"]], fn2image[example["image_id_1"]]], 
+                 'label': example["labels"]} for example in examples]
+
     def convert_to_low_shot(self, num_shots_per_class: int):
         """
         Args:
@@ -123,18 +178,20 @@ class NLVR2Dataset(Dataset):
 
         assert self.split == 'train'
         logger.info("Converting NLVR2 train split into low-shot dataset, with {} examples per class...".format(num_shots_per_class))
-        new_data = []
+        all_labels = self.data.get_column('labels')
+        low_shot_indices = []
         for i in range(self.num_labels):
-            i_examples = [d for d in self.data if d['labels'] == i]
-            low_shot_examples = random.sample(i_examples, num_shots_per_class)
-            new_data.extend(low_shot_examples)
-        self.data = new_data
+            # Same sample as random.sample(examples_with_label_i, num_shots_per_class)
+            i_indices = [j for j, label in enumerate(all_labels) if label == i]
+            low_shot_indices.extend(random.sample(i_indices, num_shots_per_class))
+        self.data = self.data.select(low_shot_indices)
         self.n_examples = len(self.data)
 
         logger.info("Converted into low-shot dataset, with {} examples".format(self.n_examples))
 
 def nlvr2_batch_collate(batch: List[Dict], 
-                        visual_input_type: str):
+                        visual_input_type: str,
+                        batch_encoder=None):
 
     """
     Collates each model input for all batch items into a single model input (e.g. converts a list of input_ids into a matrix of size (batch_size, max_len))
@@ -142,6 +199,7 @@ def nlvr2_batch_collate(batch: List[Dict],
     Args:
     batch - list of batch items, each item being a dictionary returned by Dataset's __getitem__ method
     visual_input_type: string which specifies the type of visual input
+    batch_encoder: model's ViltBatchEncoder - if given, model input tensors are created in the DataLoader workers
 
     Returns:
     Dictionary containing batched inputs and outputs
@@ -152,14 +210,23 @@ def nlvr2_batch_collate(batch: List[Dict],
     pil_objs = [x['image'] for x in batch]
     labels = [x['label'] for x in batch]
 
-    return {'raw_texts': texts, 
-            'images': pil_objs, 
-            'labels': torch.LongTensor(labels)}
+    collated_batch = {'raw_texts': texts, 
+                      'images': pil_objs, 
+                      'labels': torch.LongTensor(labels)}
+
+    if batch_encoder is not None:
+        # Images of all examples are flattened, in the same order as ViltContinualLearner.forward_multi_images
+        flat_images_list = list(itertools.chain(*pil_objs))
+        collated_batch['encodings'] = batch_encoder(flat_images_list, texts)
+        collated_batch['images'] = None
+    return collated_batch
 
 def build_nlvr2_dataloader(args, 
                            data_dir: str, 
                            split: str, 
                            visual_input_type: str,
+                           batch_encoder=None,
+                           length_bucket_size: int = 0,
                            **kwargs) -> torch.utils.data.DataLoader:
 
     """
@@ -169,6 +236,8 @@ def build_nlvr2_dataloader(args,
     data_dir : path containing NLVR questions and annotations.
     split: either train/val split
     visual_input_type: format of visual input to model
+    batch_encoder: model's ViltBatchEncoder - if given, model input tensors are created in the DataLoader workers
+    length_bucket_size: if > 0, training batches contain sentences of similar lengths, sampled from buckets of length_bucket_size batches
 
     Returns:
     DataLoader object
@@ -180,13 +249,16 @@ def build_nlvr2_dataloader(args,
         raise NotImplementedError("Have not implemented other inputs for NLVR2 images!")
 
     dataset = NLVR2Dataset(data_dir, split, **kwargs)
-    dataloader = torch.utils.data.DataLoader(
+    if split == 'train' and length_bucket_size > 0:
+        logger.info("Batching sentences of similar lengths, from buckets of {} batches".format(length_bucket_size))
+        batch_sampler = LengthBucketedBatchSampler(dataset, int(args.batch_size/2), length_bucket_size)
+    else:
+        batch_sampler = get_default_batch_sampler(dataset, int(args.batch_size/2), (split=='train'))
+    dataloader = build_batched_dataloader(
         dataset,
-        num_workers = args.num_workers,
-        batch_size = int(args.batch_size/2),
-        shuffle = (split=='train'),
-        collate_fn = lambda x: nlvr2_batch_collate(x, visual_input_type)
-        )
+        batch_sampler,
+        collate_fn=lambda x: nlvr2_batch_collate(x, visual_input_type, batch_encoder),
+        num_workers=args.num_workers)
     return dataloader
 
     
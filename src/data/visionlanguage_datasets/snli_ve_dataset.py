@@ -11,7 +11,7 @@ from collections import defaultdict
 import pickle as pkl
 import pdb
 import jsonlines
-from typing import List, Dict
+from typing import List, Dict, Tuple, Iterator
 
 import numpy as np
 import torch
@@ -23,7 +23,12 @@ from PIL import Image
 from utils.image_utils import resize_image
 
 from data.image_datasets.flickr30kimages_dataset import Flickr30KImagesDataset
-from data.image_collation import image_collate
+from data.image_collation import image_collate, deduplicate_images
+from data.text_collation import tokenize_texts, collate_text_encodings
+from data.columnar_cache import ColumnarTable
+from data.annotation_caches import build_annotation_cache, DEFAULT_CHUNK_SIZE
+from data.batch_samplers import ImageGroupedBatchSampler, LengthBucketedBatchSampler, AspectRatioBucketedBatchSampler, warn_ignored_batching_options
+from data.parallel_loading import build_batched_dataloader, get_default_batch_sampler
 
 logger = logging.getLogger(__name__)
 logging.basicConfig(
@@ -31,6 +36,35 @@ logging.basicConfig(
         datefmt='%m/%d/%Y %H:%M:%S',
         level=logging.INFO)
 
+SNLI_VE_DATA_SCHEMA = {'image_id': 'int',
+                       'hypothesis': 'str',
+                       'hypothesis_input_ids': 'list<int>',
+                       'label': 'int'}
+
+def iter_snli_ve_examples(annotations_file: str) -> Iterator[Tuple]:
+
+    '''
+    Streams the annotations of an SNLI-VE split, and yields the (Flickr30K image id, hypothesis, gold label) of every line
+    '''
+
+    with jsonlines.open(annotations_file) as json_lines:
+        for line in json_lines:
+            yield int(line['Flickr30K_ID']), str(line['sentence2']), line['gold_label']
+
+def process_snli_ve_examples(examples: List[Tuple], tokenizer, cat2label: Dict[str, int]) -> Dict[str, List]:
+
+    '''
+    Converts a chunk of examples from iter_snli_ve_examples into the columns of SNLI_VE_DATA_SCHEMA
+    Hypotheses are tokenized in a single batch (input IDs are empty if no tokenizer is given)
+    '''
+
+    hypotheses = [example[1] for example in examples]
+    return {'image_id': [example[0] for example in examples],
+            'hypothesis': hypotheses,
+            'hypothesis_input_ids': tokenize_texts(tokenizer, hypotheses) if tokenizer is not None else [[] for _ in examples],
+            'label': [cat2label[example[2]] for example in examples]}
+
+
 class SnliVEDataset(Dataset):
 
     def __init__(self, 
@@ -48,10 +82,10 @@ class SnliVEDataset(Dataset):
         data_dir : path containing SNLI-VE hypotheses and annotations.
         images_dataset : instance of Flickr30KImagesDataset, that is used to retrieve the Flickr30K image for each question
         split: either train/val split
-
+        kwargs: tokenizer (optional), and num_cache_workers/cache_chunk_size used when the cache is built (see data.annotation_caches)
 
         Returns:
-        Loads all annotations into self.data, where each item is a single SNLI-VE pair
+        Loads all annotations into self.data (a memory-mapped ColumnarTable), where each item is a single SNLI-VE pair
         """
 
         self.data_dir = data_dir
@@ -65,36 +99,67 @@ class SnliVEDataset(Dataset):
         self.cat2label = {cat: i for i, cat in enumerate(self.categories)}
         self.num_labels = len(self.categories)
 
-        self.cached_data_file = os.path.join(data_dir, 'cached_ve_data', 'snli-ve_{}.pkl'.format(split))
-        if os.path.exists(self.cached_data_file):
-            self.data = pkl.load(open(self.cached_data_file, 'rb'))
-        else:
-            self.data = []
-            json_lines = jsonlines.open(self.annotations_file)
-            for line in tqdm(json_lines):
-                image_id = int(line['Flickr30K_ID'])
-                hypothesis = str(line['sentence2'])
-                gold_label = self.cat2label[line['gold_label']]
-
-                if self.tokenizer is not None:
-                    tokens = self.tokenizer.tokenize(hypothesis)
-                    input_ids = self.tokenizer.convert_tokens_to_ids(tokens)
-                else:
-                    input_ids = []
-
-                doc = {'image_id': image_id,
-                        'hypothesis': hypothesis,
-                        'hypothesis_input_ids': input_ids,
-                        'label': gold_label}
-                self.data.append(doc)
-
-            pkl.dump(self.data, open(self.cached_data_file, 'wb'))
+        self.cached_data_file = os.path.join(data_dir, 'cached_ve_data', 'snli-ve_{}'.format(split))
+        self.source_files = [self.annotations_file]
+        pickled_data_file = self.cached_data_file + '.pkl'
+        self.data = ColumnarTable.load(self.cached_data_file, SNLI_VE_DATA_SCHEMA, self.source_files)
+        if self.data is None and os.path.exists(pickled_data_file) and not os.path.exists(self.annotations_file):
+            # Convert the old pickled cache, if the annotations are not available
+            self.data = ColumnarTable.from_records(pkl.load(open(pickled_data_file, 'rb')), SNLI_VE_DATA_SCHEMA)
+            self.data.save(self.cached_data_file, self.source_files)
+        elif self.data is None:
+            # Annotations are streamed from the JSONL file, and processed and written to the cache in chunks
+            self.data = build_annotation_cache(self.cached_data_file, SNLI_VE_DATA_SCHEMA, self.source_files,
+                                               examples=iter_snli_ve_examples(self.annotations_file),
+                                               process_fn=process_snli_ve_examples,
+                                               context={'tokenizer': self.tokenizer, 'cat2label': self.cat2label},
+                                               num_workers=kwargs.get('num_cache_workers', 0),
+                                               chunk_size=kwargs.get('cache_chunk_size', DEFAULT_CHUNK_SIZE))
+
+        if self.tokenizer is not None and (self.data.get_lengths('hypothesis_input_ids') == 0).any():
+            # Cached data was created without a tokenizer - tokenize all hypotheses once, and update the cache
+            logger.info("Tokenizing SNLI-VE {} hypotheses".format(self.split))
+            all_input_ids = tokenize_texts(self.tokenizer, self.data.get_column('hypothesis'))
+            self.data = self.data.with_column('hypothesis_input_ids', all_input_ids)
+            self.data.save(self.cached_data_file, self.source_files)
+            self.data = ColumnarTable.load(self.cached_data_file)
 
         logger.info("Loaded SNLI-VE {} dataset, with {} examples".format(self.split, len(self.data)))
 
     def __len__(self):
         return len(self.data)
 
+    def get_image_ids(self) -> List[int]:
+        '''
+        Returns the image_id of every example in self.data (used by ImageGroupedBatchSampler)
+        '''
+        return self.data.get_column('image_id')
+
+    def get_image_sizes(self) -> List:
+        '''
+        Returns the (width, height) of the image of every example in self.data, as it is passed to the model (used by AspectRatioBucketedBatchSampler)
+        '''
+        return [self.images_dataset.get_image_size(image_id) for image_id in self.get_image_ids()]
+
+    def get_text_lengths(self) -> np.ndarray:
+        '''
+        Returns the number of text tokens (including [CLS] and [SEP]) of every example in self.data (used by LengthBucketedBatchSampler)
+        '''
+        return self.data.get_lengths('hypothesis_input_ids') + 2
+
+    def get_example_ids(self) -> List[str]:
+        '''
+        Returns the (image_id, hypothesis) pair of every example in self.data (used to key cached encoder features to the examples)
+        (SNLI-VE annotations have no example ids)
+        '''
+        return ['{}\t{}'.format(image_id, hypothesis) for image_id, hypothesis in zip(self.get_image_ids(), self.data.get_column('hypothesis'))]
+
+    def get_target(self, index: int) -> Dict:
+        '''
+        Returns only the targets of an example, without loading its image (used when training on cached encoder features)
+        '''
+        return {'labels': self.data[index]['label']}
+
     def __getitem__(self, index: int):
 
         """
@@ -107,20 +172,46 @@ class SnliVEDataset(Dataset):
 
         example = self.data[index]
 
+        # Get the image tensor from ImageDataset
+        image = self.images_dataset.get_image_data(example['image_id'])
+        return self.make_item(example, image)
+
+    def __getitems__(self, indices: List[int]) -> List[Dict]:
+
+        """
+        Batched version of __getitem__, called with all indices of a batch by DataLoaders from data.parallel_loading.build_batched_dataloader
+        The images of the batch are loaded once each, concurrently in a thread pool
+
+        Args:
+        indices : indices of elements in self.data to return as data instances
+
+        Returns:
+        list of dictionaries, same as [self[i] for i in indices]
+        """
+
+        examples = [self.data[i] for i in indices]
+        images = self.images_dataset.get_images_data([example['image_id'] for example in examples])
+        return [self.make_item(example, image) for example, image in zip(examples, images)]
+
+    def make_item(self, example: Dict, image) -> Dict:
+
+        """
+        Creates the data instance of an example, given its loaded image
+        """
+
         # Tokenize the input hypothesis 
         hypothesis = example['hypothesis']
         input_ids = example['hypothesis_input_ids']
 
-        # Get the image tensor from ImageDataset
         image_id = example['image_id']
-        image = self.images_dataset.get_image_data(image_id)
 
         label = example['label']
 
         return {'hypothesis': hypothesis, 
                 'input_ids': input_ids, 
                 'image': image, 
-                'label': label
+                'label': label,
+                'image_id': image_id
                 }
 
 
@@ -132,18 +223,23 @@ class SnliVEDataset(Dataset):
 
         assert self.split == 'train'
         logger.info("Converting SNLI-VE train split into low-shot dataset, with {} examples per class...".format(num_shots_per_class))
-        new_data = []
+        all_labels = self.data.get_column('label')
+        low_shot_indices = []
         for i in range(self.num_labels):
-            i_examples = [d for d in self.data if d['label'] == i]
-            low_shot_examples = random.sample(i_examples, num_shots_per_class)
-            new_data.extend(low_shot_examples)
-        self.data = new_data
+            # Same sample as random.sample(examples_with_label_i, num_shots_per_class)
+            i_indices = [j for j, label in enumerate(all_labels) if label == i]
+            low_shot_indices.extend(random.sample(i_indices, num_shots_per_class))
+        self.data = self.data.select(low_shot_indices)
         self.n_examples = len(self.data)
         logger.info("Converted into low-shot dataset, with {} examples".format(self.n_examples))
 
 
 def snlive_batch_collate(batch: List[Dict], 
-                        visual_input_type: str):
+                        visual_input_type: str,
+                        batch_encoder=None,
+                        dedup_images: bool = False,
+                        max_text_length: int = 0,
+                        special_token_ids: Dict[str, int] = None):
 
     """
     Collates each model input for all batch items into a single model input (e.g. converts a list of input_ids into a matrix of size (batch_size, max_len))
@@ -151,6 +247,11 @@ def snlive_batch_collate(batch: List[Dict],
     Args:
     batch - list of batch items, each item being a dictionary returned by Dataset's __getitem__ method
     visual_input_type: string which specifies the type of visual input
+    batch_encoder: model's ViltBatchEncoder - if given, model input tensors are created in the DataLoader workers
+    dedup_images: if True, every unique image in the batch is kept only once, and image_index maps each hypothesis to its image
+    max_text_length: if > 0 and hypotheses were tokenized by the dataset, model-ready text tensors (with special tokens, truncated to max_text_length)
+                     are created from the hypothesis input IDs, so that the model does not tokenize the hypotheses again
+    special_token_ids: ids of the tokenizer's special tokens, added to the input IDs when max_text_length > 0 (see data.text_collation.get_special_token_ids)
 
     Returns:
     Dictionary containing batched inputs and outputs
@@ -181,19 +282,38 @@ def snlive_batch_collate(batch: List[Dict],
 
     # Depending on the visual_input_type variable, process the images accordingly
     images = [x['image'] for x in batch]
+    image_index = None
+    if dedup_images:
+        images, image_index = deduplicate_images(images, [x['image_id'] for x in batch])
     images = image_collate(images, visual_input_type)
 
-    return {'raw_texts': hypotheses,
-            'input_ids': input_ids,
-            'attn_mask': attn_mask,
-            'images': images,
-            'labels': labels}
+    collated_batch = {'raw_texts': hypotheses,
+                      'input_ids': input_ids,
+                      'attn_mask': attn_mask,
+                      'images': images,
+                      'labels': labels}
+    if image_index is not None:
+        collated_batch['image_index'] = image_index
+    if max_text_length > 0 and all(len(x['input_ids']) > 0 for x in batch):
+        collated_batch['text_encodings'] = collate_text_encodings([x['input_ids'] for x in batch], max_text_length, special_token_ids)
+
+    if batch_encoder is not None:
+        # Only tensors are sent back to the main process
+        collated_batch['encodings'] = batch_encoder(images, hypotheses)
+        collated_batch['images'] = None
+    return collated_batch
 
 def build_snli_ve_dataloader(args, 
                              data_dir: str, 
                              images_dataset: Flickr30KImagesDataset, 
                              split: str, 
                              visual_input_type: str,
+                             batch_encoder=None,
+                             image_group_size: int = 0,
+                             length_bucket_size: int = 0,
+                             aspect_ratio_buckets: bool = False,
+                             max_text_length: int = 0,
+                             special_token_ids: Dict[str, int] = None,
                              **kwargs) -> torch.utils.data.DataLoader:
 
     """
@@ -205,6 +325,15 @@ def build_snli_ve_dataloader(args,
     images_dataset : instance of Flickr30KImagesDataset, that is used to retrieve the Flickr30K image for each question
     split: either train/val split
     visual_input_type: format of visual input to model
+    batch_encoder: model's ViltBatchEncoder - if given, model input tensors are created in the DataLoader workers
+    image_group_size: if > 0, training batches place up to image_group_size hypotheses of the same image next to each other,
+                      and every batch contains each unique image only once
+    length_bucket_size: if > 0 (and image_group_size is 0), training batches contain hypotheses of similar lengths,
+                        sampled from buckets of length_bucket_size batches
+    aspect_ratio_buckets: if True (and image_group_size and length_bucket_size are 0), the images of each training batch have the same model input shape
+    max_text_length: if > 0, hypotheses tokenized by the dataset (requires tokenizer in kwargs) are passed to the model as
+                     ready text tensors, truncated to max_text_length tokens (the model encoder's max_text_length)
+    special_token_ids: ids of the [PAD], [CLS] and [SEP] tokens of the tokenizer in kwargs (see data.text_collation.get_special_token_ids)
 
     Returns:
     DataLoader object
@@ -213,17 +342,31 @@ def build_snli_ve_dataloader(args,
 
     batch_size = args.batch_size
     shuffle = True if split == 'train' else False
+    dedup_images = image_group_size > 0
 
     logger.info("Creating SNLI-VE {} dataloader with batch size of {}".format(split, batch_size))
 
     dataset = SnliVEDataset(data_dir, images_dataset, split, **kwargs)
-    dataloader = torch.utils.data.DataLoader(
+    batch_sampler = None
+    if split == 'train':
+        warn_ignored_batching_options(image_group_size=image_group_size, length_bucket_size=length_bucket_size, aspect_ratio_buckets=aspect_ratio_buckets)
+        if image_group_size > 0:
+            logger.info("Grouping up to {} hypotheses of the same image in each batch".format(image_group_size))
+            batch_sampler = ImageGroupedBatchSampler(dataset, batch_size, image_group_size)
+        elif length_bucket_size > 0:
+            logger.info("Batching hypotheses of similar lengths, from buckets of {} batches".format(length_bucket_size))
+            batch_sampler = LengthBucketedBatchSampler(dataset, batch_size, length_bucket_size, max_length=max_text_length or None)
+        elif aspect_ratio_buckets:
+            logger.info("Batching hypotheses whose images have the same input shape")
+            batch_sampler = AspectRatioBucketedBatchSampler(dataset, batch_size)
+    if batch_sampler is None:
+        batch_sampler = get_default_batch_sampler(dataset, batch_size, shuffle)
+
+    dataloader = build_batched_dataloader(
         dataset,
-        num_workers=args.num_workers,
-        batch_size=batch_size,
-        shuffle=shuffle,
-        collate_fn=lambda x: snlive_batch_collate(x, visual_input_type))
-
+        batch_sampler,
+        collate_fn=lambda x: snlive_batch_collate(x, visual_input_type, batch_encoder, dedup_images, max_text_length, special_token_ids),
+        num_workers=args.num_workers)
     return dataloader
 
 if __name__ == '__main__':
@@ -5,13 +5,14 @@ import json
 import logging
 import random
 import glob
+import itertools
 import base64
 from tqdm import tqdm
 from collections import defaultdict
 import pickle as pkl
 import pdb
 import jsonlines
-from typing import List, Dict
+from typing import List, Dict, Iterator
 
 import numpy as np
 import torch
@@ -21,7 +22,14 @@ from torch.utils.data import Dataset
 
 from PIL import Image
 
+from utils.image_utils import load_resized_pil_image, get_resized_shape
 from data.image_collation import image_collate
+from data.columnar_cache import ColumnarTable
+from data.annotation_caches import build_annotation_cache, DEFAULT_CHUNK_SIZE
+from data.text_collation import tokenize_texts, count_text_tokens
+from data.batch_samplers import LengthBucketedBatchSampler, AspectRatioBucketedBatchSampler, warn_ignored_batching_options
+from data.file_manifest import read_image_sizes
+from data.parallel_loading import map_in_threads, build_batched_dataloader, get_default_batch_sampler
 
 logger = logging.getLogger(__name__)
 logging.basicConfig(
@@ -36,6 +44,13 @@ GENDER_NEUTRAL_NAMES = ['Casey', 'Riley', 'Jessie', 'Jackie', 'Avery', 'Jaime',
                         'Robin', 'Rory', 'Bellamy', 'Salem', 'Sutton', 'Gray', 'Shae', 'Kyle', 'Alex', 'Ryan',
                         'Cameron', 'Dakota']
 
+VCR_DATA_SCHEMA = {'image_path': 'str',
+                   'texts': 'list<str>',
+                   'input_ids': 'list<list<int>>',
+                   'label': 'int',
+                   'image_width': 'int',
+                   'image_height': 'int'}
+
 
 def process_list(mytext, objects):
     ## Read file with the name of the color per object
@@ -61,6 +76,58 @@ def process_list(mytext, objects):
     #print('text: ', text)
     return text
 
+def iter_jsonl(annotations_file: str) -> Iterator[Dict]:
+    with jsonlines.open(annotations_file) as json_lines:
+        for line in json_lines:
+            yield line
+
+def process_vcr_examples(lines: List[Dict], tokenizer, data_dir: str, split: str, task_type: str) -> Dict[str, List]:
+
+    '''
+    Converts a chunk of VCR annotation lines into the columns of VCR_DATA_SCHEMA
+    The choice texts of all lines are tokenized in a single batch (input IDs are empty if no tokenizer is given),
+    and the image sizes are read from the image headers
+    '''
+
+    columns = {name: [] for name in VCR_DATA_SCHEMA}
+    for line in lines:
+        image_path = os.path.join('drawn_images/bbox/' + str(split) + '/' + str(task_type)+ '/' + str(line['annot_id']) +'.jpg')  ## train-0, train-1, train-2
+        multichoice_texts = []
+        objects = line['objects']   ### objects
+
+        question = process_list(line['question'], objects)  ### question
+        if(task_type == 'qa'):
+            ### answers:     question + ' [SEP] ' + answer
+            for answer in line['answer_choices']:
+                answer1 = process_list(answer, objects)
+                text = question + ' [SEP] ' + answer1
+                multichoice_texts.append(text)
+            label = int(line['answer_label']) ##number
+
+        else:
+            ### rationales:  question + '[SEP]' + answer + '[SEP]' + rationale
+            answer  = process_list( line['answer_choices'][int(line['answer_label'])], objects)
+            for rationale in line['rationale_choices']:
+                rationale1 = process_list(rationale, objects)
+                text = question + ' [SEP] ' + answer + ' [SEP] ' + rationale1
+                multichoice_texts.append(text)
+            label = int(line['rationale_label']) ##number
+
+        columns['image_path'].append(image_path)
+        columns['texts'].append(multichoice_texts)
+        columns['label'].append(label)
+
+    if tokenizer is not None:
+        num_choices = [len(texts) for texts in columns['texts']]
+        all_input_ids = tokenize_texts(tokenizer, [text for texts in columns['texts'] for text in texts])
+        starts = np.cumsum([0] + num_choices)
+        columns['input_ids'] = [all_input_ids[starts[i]: starts[i+1]] for i in range(len(num_choices))]
+    else:
+        columns['input_ids'] = [[] for _ in lines]
+    columns['image_width'], columns['image_height'] = read_image_sizes([os.path.join(data_dir, image_path) for image_path in columns['image_path']])
+    return columns
+
+
 class VCRDataset(Dataset):
 
     def __init__(self, 
@@ -78,9 +145,10 @@ class VCRDataset(Dataset):
         data_dir : path containing VCR questions and annotations
         split: either train/val/test split
         task_type: either 'qa' or 'qar', depending on if we do Q->A or QA->R
+        kwargs: tokenizer (optional), and num_cache_workers/cache_chunk_size used when the cache is built (see data.annotation_caches)
 
         Returns:
-        Loads all annotations into self.data, where each item is a single VCR input
+        Loads all annotations into self.data (a memory-mapped ColumnarTable), where each item is a single VCR input
         """
 
         self.data_dir = data_dir
@@ -93,56 +161,71 @@ class VCRDataset(Dataset):
 
         self.annotations_file = os.path.join(data_dir, 'annotation/{}.jsonl'.format(split))
 
-        self.cached_data_file = os.path.join(data_dir, 'cached_vcr_data', 'vcr_'+ str(task_type) + '_' + '{}.pkl'.format(split))
-        if os.path.exists(self.cached_data_file):
-            self.data = pkl.load(open(self.cached_data_file, 'rb'))
-        else:
-            self.data = []
-            json_lines = jsonlines.open(self.annotations_file)
-            count = 0
-            for line in tqdm(json_lines):
-                
-                image_path = os.path.join('drawn_images/bbox/' + str(split) + '/' + str(task_type)+ '/' + str(line['annot_id']) +'.jpg')  ## train-0, train-1, train-2
-                multichoice_texts = []
-                objects = line['objects']   ### objects
-                
-                question = process_list(line['question'], objects)  ### question
-                if(task_type == 'qa'):
-                    ### answers:     question + ' [SEP] ' + answer
-                    for answer in line['answer_choices']:                        
-                        answer1 = process_list(answer, objects)
-                        text = question + ' [SEP] ' + answer1
-                        multichoice_texts.append(text)
-                    label = int(line['answer_label']) ##number
-
-                else:
-                    ### rationales:  question + '[SEP]' + answer + '[SEP]' + rationale
-                    answer  = process_list( line['answer_choices'][int(line['answer_label'])], objects)
-                    for rationale in line['rationale_choices']:
-                        rationale1 = process_list(rationale, objects)
-                        text = question + ' [SEP] ' + answer + ' [SEP] ' + rationale1
-                        multichoice_texts.append(text)
-                    label = int(line['rationale_label']) ##number
-
-                if self.tokenizer is not None:
-                    multichoice_tokens = [self.tokenizer.tokenize(text) for text in multichoice_texts]
-                    multichoice_input_ids = [self.tokenizer.convert_tokens_to_ids(t) for t in multichoice_tokens]
-                else:
-                    multichoice_input_ids = []
-
-                doc = {'image_path': image_path,
-                        'texts': multichoice_texts,
-                        'input_ids': multichoice_input_ids,
-                        'label': label}
-                self.data.append(doc)
-                
-            pkl.dump(self.data, open(self.cached_data_file, 'wb'))
+        self.cached_data_file = os.path.join(data_dir, 'cached_vcr_data', 'vcr_'+ str(task_type) + '_' + '{}'.format(split))
+        self.source_files = [self.annotations_file]
+        pickled_data_file = self.cached_data_file + '.pkl'
+        self.data = ColumnarTable.load(self.cached_data_file, VCR_DATA_SCHEMA, self.source_files)
+        if self.data is None and os.path.exists(pickled_data_file) and not os.path.exists(self.annotations_file):
+            # Convert the old pickled cache, if the annotations are not available
+            self.data = ColumnarTable.from_records(self.add_image_sizes(pkl.load(open(pickled_data_file, 'rb'))), VCR_DATA_SCHEMA)
+            self.data.save(self.cached_data_file, self.source_files)
+        elif self.data is None:
+            # Annotations are streamed from the JSONL file, and processed and written to the cache in chunks
+            self.data = build_annotation_cache(self.cached_data_file, VCR_DATA_SCHEMA, self.source_files,
+                                               examples=iter_jsonl(self.annotations_file),
+                                               process_fn=process_vcr_examples,
+                                               context={'tokenizer': self.tokenizer, 'data_dir': self.data_dir, 'split': split, 'task_type': task_type},
+                                               num_workers=kwargs.get('num_cache_workers', 0),
+                                               chunk_size=kwargs.get('cache_chunk_size', DEFAULT_CHUNK_SIZE))
         self.n_examples = len(self.data)
         logger.info("Loaded VCR-{} {} dataset, with {} examples".format(self.task_type, self.split, len(self.data)))
+        self.text_lengths = None
 
     def __len__(self):
         return self.n_examples
 
+    def add_image_sizes(self, records: List[Dict]) -> List[Dict]:
+        '''
+        Adds the width and height of the image of every example (read from the image headers) to the records of the cache
+        '''
+        widths, heights = read_image_sizes([os.path.join(self.data_dir, record['image_path']) for record in records])
+        for record, width, height in zip(records, widths, heights):
+            record['image_width'], record['image_height'] = width, height
+        return records
+
+    def get_image_sizes(self) -> List:
+        '''
+        Returns the (width, height) of the image of every example in self.data, as it is passed to the model (used by AspectRatioBucketedBatchSampler)
+        '''
+        image_sizes = zip(self.data.get_column('image_width'), self.data.get_column('image_height'))
+        return [get_resized_shape(image_size, 384, 640) if min(image_size) > 384 else image_size for image_size in image_sizes]
+
+    def get_text_lengths(self) -> np.ndarray:
+        '''
+        Returns the number of text tokens of the longest choice of every example in self.data (used by LengthBucketedBatchSampler)
+        Texts are tokenized once, and again only if self.data is replaced (e.g. by convert_to_low_shot)
+        '''
+        if self.text_lengths is None or self.text_lengths[0] is not self.data:
+            num_choices = self.data.get_lengths('texts')
+            choice_lengths = count_text_tokens([text for texts in self.data.get_column('texts') for text in texts])
+            choice_starts = np.concatenate([[0], np.cumsum(num_choices)[:-1]])
+            lengths = np.maximum.reduceat(choice_lengths, choice_starts) if len(choice_lengths) > 0 else np.zeros(len(self.data), dtype=np.int64)
+            self.text_lengths = (self.data, lengths)
+        return self.text_lengths[1]
+
+    def get_example_ids(self) -> List[str]:
+        '''
+        Returns the image path of every example in self.data, which is named after the example's annot_id, split and task type
+        (used to key cached encoder features to the examples)
+        '''
+        return self.data.get_column('image_path')
+
+    def get_target(self, index: int) -> Dict:
+        '''
+        Returns only the targets of an example, without loading its image (used when training on cached encoder features)
+        '''
+        return {'labels': self.data[index]['label']}
+
     def __getitem__(self, index: int):
 
         """
@@ -156,11 +239,7 @@ class VCRDataset(Dataset):
         example = self.data[index]
         
         image_fn     = os.path.join(self.data_dir, example['image_path'])
-        pil_transform = T.Resize(size=384, max_size=640)
-        image = Image.open(image_fn)
-        image = image.convert('RGB')
-        if min(list(image.size)) > 384:
-            image = pil_transform(image)
+        image = load_resized_pil_image(image_fn, short_side=384, max_size=640)
 
         texts    = example['texts']
         label   = example['label']
@@ -170,6 +249,21 @@ class VCRDataset(Dataset):
                  'label': label
                  }
 
+    def __getitems__(self, indices: List[int]) -> List[Dict]:
+
+        """
+        Batched version of __getitem__, called with all indices of a batch by DataLoaders from data.parallel_loading.build_batched_dataloader
+        The images of the batch are read and decoded concurrently in a thread pool
+
+        Args:
+        indices : indices of elements in self.data to return as data instances
+
+        Returns:
+        list of dictionaries, same as [self[i] for i in indices]
+        """
+
+        return map_in_threads(self.__getitem__, indices)
+
     def convert_to_low_shot(self, low_shot_percentage: float):
         """
         Args:
@@ -180,14 +274,16 @@ class VCRDataset(Dataset):
         logger.info("Converting VCR train split into low-shot dataset, with {:.2f}% training samples...".format(low_shot_percentage*100.0))
         n_low_shot_examples = int(low_shot_percentage*self.n_examples)
 
-        new_data = random.sample(self.data, n_low_shot_examples)
-        self.data = new_data
+        # Same sample as random.sample(list_of_examples, n_low_shot_examples)
+        low_shot_indices = random.sample(range(len(self.data)), n_low_shot_examples)
+        self.data = self.data.select(low_shot_indices)
         self.n_examples = len(self.data)
 
         logger.info("Converted into low-shot dataset, with {} examples".format(self.n_examples))
 
 def vcr_batch_collate(batch: List[Dict], 
-                      visual_input_type: str):
+                      visual_input_type: str,
+                      batch_encoder=None):
 
     """
     Collates each model input for all batch items into a single model input (e.g. converts a list of input_ids into a matrix of size (batch_size, max_len))
@@ -195,6 +291,7 @@ def vcr_batch_collate(batch: List[Dict],
     Args:
     batch - list of batch items, each item being a dictionary returned by Dataset's __getitem__ method
     visual_input_type: string which specifies the type of visual input
+    batch_encoder: model's ViltBatchEncoder - if given, model input tensors are created in the DataLoader workers
 
     Returns:
     Dictionary containing batched inputs and outputs
@@ -205,15 +302,26 @@ def vcr_batch_collate(batch: List[Dict],
     pil_objs = [x['image'] for x in batch]
     labels = [x['label'] for x in batch]
 
-    return {'raw_texts': texts,
-            'images': pil_objs,
-            'labels': torch.LongTensor(labels)}
+    collated_batch = {'raw_texts': texts,
+                      'images': pil_objs,
+                      'labels': torch.LongTensor(labels)}
+
+    if batch_encoder is not None:
+        # Choices of all examples are flattened, in the same order as ViltContinualLearner.forward_multi_choice
+        texts_list = list(itertools.chain(*texts))
+        collated_batch['encodings'] = batch_encoder(pil_objs, texts_list)
+        collated_batch['images'] = None
+    return collated_batch
 
 def build_vcr_dataloader(args, 
                          data_dir: str, 
                          split: str, 
                          task_type: str, 
                          visual_input_type: str,
+                         batch_encoder=None,
+                         batch_size_divisor: int = 4,
+                         length_bucket_size: int = 0,
+                         aspect_ratio_buckets: bool = False,
                          **kwargs) -> torch.utils.data.DataLoader:
 
     """
@@ -224,12 +332,16 @@ def build_vcr_dataloader(args,
     split: either train/val split
     task_type: either 'qa' or 'qar', depending on if we do Q->A or QA->R
     visual_input_type: format of visual input to model
+    batch_encoder: model's ViltBatchEncoder - if given, model input tensors are created in the DataLoader workers
+    batch_size_divisor: each batch contains batch_size/batch_size_divisor examples, since every example has multiple choices
+    length_bucket_size: if > 0, training batches contain examples of similar text lengths, sampled from buckets of length_bucket_size batches
+    aspect_ratio_buckets: if True (and length_bucket_size is 0), the images of each training batch have the same model input shape
 
     Returns:
     DataLoader object
     """
 
-    batch_size = int(args.batch_size/4)
+    batch_size = int(args.batch_size/batch_size_divisor)
     shuffle = True if split == 'train' else False
 
     assert visual_input_type == 'pil-image'     # VCR not supported for other visual inputs yet!
@@ -237,13 +349,23 @@ def build_vcr_dataloader(args,
     logger.info("Creating VCR {} dataloader with batch size of {}".format(split, batch_size))
 
     dataset = VCRDataset(data_dir, split, task_type, **kwargs)
-    
-    dataloader = torch.utils.data.DataLoader(
+    batch_sampler = None
+    if split == 'train':
+        warn_ignored_batching_options(length_bucket_size=length_bucket_size, aspect_ratio_buckets=aspect_ratio_buckets)
+        if length_bucket_size > 0:
+            logger.info("Batching examples of similar text lengths, from buckets of {} batches".format(length_bucket_size))
+            batch_sampler = LengthBucketedBatchSampler(dataset, batch_size, length_bucket_size)
+        elif aspect_ratio_buckets:
+            logger.info("Batching examples whose images have the same input shape")
+            batch_sampler = AspectRatioBucketedBatchSampler(dataset, batch_size)
+    if batch_sampler is None:
+        batch_sampler = get_default_batch_sampler(dataset, batch_size, shuffle)
+
+    dataloader = build_batched_dataloader(
         dataset,
-        num_workers=args.num_workers,
-        batch_size=batch_size,
-        shuffle=shuffle,
-        collate_fn=lambda x: vcr_batch_collate(x, visual_input_type))
+        batch_sampler,
+        collate_fn=lambda x: vcr_batch_collate(x, visual_input_type, batch_encoder),
+        num_workers=args.num_workers)
     return dataloader
 
     
@@ -11,7 +11,7 @@ from tqdm import tqdm
 from collections import defaultdict
 import pickle as pkl
 import pdb
-from typing import List, Dict
+from typing import List, Dict, Tuple, Iterator
 
 import numpy as np
 import torch
@@ -21,10 +21,15 @@ from torch.utils.data import Dataset
 
 from PIL import Image
 from utils.image_utils import resize_image
-from utils.vqa_utils import get_score, target_tensor
+from utils.vqa_utils import get_score, target_tensor, batch_target_tensor
 
 from data.image_datasets.cocoimages_dataset import MSCOCOImagesDataset
-from data.image_collation import image_collate
+from data.image_collation import image_collate, deduplicate_images
+from data.text_collation import tokenize_texts, collate_text_encodings
+from data.columnar_cache import ColumnarTable
+from data.annotation_caches import iter_json_array, build_annotation_cache, DEFAULT_CHUNK_SIZE
+from data.batch_samplers import ImageGroupedBatchSampler, LengthBucketedBatchSampler, AspectRatioBucketedBatchSampler, warn_ignored_batching_options
+from data.parallel_loading import build_batched_dataloader, get_default_batch_sampler
 
 logger = logging.getLogger(__name__)
 logging.basicConfig(
@@ -32,6 +37,80 @@ logging.basicConfig(
         datefmt='%m/%d/%Y %H:%M:%S',
         level=logging.INFO)
 
+VQA_DATA_SCHEMA = {'question_id': 'int',
+                   'image_id': 'int',
+                   'question': 'str',
+                   'question_input_ids': 'list<int>',
+                   'correct_answer': 'str',
+                   'labels': 'list<int>',
+                   'answers': 'list<str>',
+                   'scores': 'list<float>'}
+
+def iter_vqa_examples(questions_file: str, annotations_file: str) -> Iterator[Tuple]:
+
+    '''
+    Streams the annotations of a VQAv2 split, and yields the (question_id, image_id, question, correct_answer, answers) of every annotation
+    Questions are stored in the same order as the annotations, so they are matched while both files are streamed,
+    and only questions that are out of order are kept in memory
+    '''
+
+    questions = iter_json_array(questions_file, 'questions')
+    qid2qdata = {}
+    for anno in iter_json_array(annotations_file, 'annotations'):
+        qid = anno['question_id']
+        while qid not in qid2qdata:
+            qdata = next(questions, None)
+            assert qdata is not None, "Question {} not found in {}".format(qid, questions_file)
+            qid2qdata[qdata['question_id']] = qdata
+
+        # Retrieve the question for this annotation
+        qdata = qid2qdata.pop(qid)
+        assert qdata['image_id'] == anno['image_id']
+        yield qid, anno['image_id'], qdata['question'], anno['multiple_choice_answer'], [a['answer'] for a in anno['answers']]
+
+def process_vqa_examples(examples: List[Tuple], tokenizer, ans2label: Dict[str, int]) -> Dict[str, List]:
+
+    '''
+    Converts a chunk of examples from iter_vqa_examples into the columns of VQA_DATA_SCHEMA
+    Questions are tokenized in a single batch (input IDs are empty if no tokenizer is given), and every crowdsourced answer
+    in ans2label is mapped to its label and score
+    '''
+
+    columns = {name: [] for name in VQA_DATA_SCHEMA}
+    questions = [example[2] for example in examples]
+    all_input_ids = tokenize_texts(tokenizer, questions) if tokenizer is not None else [[] for _ in examples]
+    for (qid, image_id, question, correct_answer, all_answers), input_ids in zip(examples, all_input_ids):
+        # Map from each crowdsourced answer to occurrences in annotation
+        answer_count = defaultdict(int)
+        for ans in all_answers:
+            answer_count[ans] += 1
+
+        # Get label and score (0.3/0.6/1) corresponding to each crowdsourced answer
+        labels = []
+        scores = []
+        answers = []
+        for answer in answer_count:
+            if answer not in ans2label:
+                continue
+            labels.append(ans2label[answer])
+            score = get_score(answer_count[answer])
+            scores.append(score)
+            answers.append(answer)
+
+        # Store pre-processed example
+        example = {'question_id': qid,
+                   'image_id': image_id,
+                   'question': question,
+                   'question_input_ids': input_ids,
+                   'correct_answer': correct_answer,
+                   'labels': labels,
+                   'answers': answers,
+                   'scores': scores}
+        for name, value in example.items():
+            columns[name].append(value)
+    return columns
+
+
 class VQADataset(Dataset):
 
     def __init__(self, 
@@ -49,9 +128,10 @@ class VQADataset(Dataset):
         data_dir : path containing VQA questions and annotations. Also contains mapping from each answer in set of possible answers to a numerical label
         images_dataset : instance of MSCOCOImagesDataset, that is used to retrieve the MS-COCO image for each question
         split: either train/val split
+        kwargs: tokenizer (optional), and num_cache_workers/cache_chunk_size used when the cache is built (see data.annotation_caches)
 
         Returns:
-        Loads all annotations into self.data, where each item is a single VQA pair
+        Loads all annotations into self.data (a memory-mapped ColumnarTable), where each item is a single VQA pair
         """
 
         self.images_dataset = images_dataset
@@ -69,65 +149,31 @@ class VQADataset(Dataset):
         self.num_labels = len(self.label2ans)
         self.num_answers = len(self.ans2label)
 
-        self.cached_data_file = os.path.join(data_dir, 'cached_vqa_data', 'vqa_{}.pkl'.format(split))
-        if os.path.exists(self.cached_data_file):
-            # Load cached data
-            self.data = pkl.load(open(self.cached_data_file, 'rb'))
-
-        else:
-            # Create map from question id to question
-            questions = json.load(open(self.questions_file))['questions']
-            qid2qdata = {x['question_id']: x for x in questions}
-
-            # Create data for each annotation
-            annotations = json.load(open(self.annotations_file))['annotations']
-            self.data = []
-            for anno in annotations:
-                qid = anno['question_id']
-                correct_answer = anno['multiple_choice_answer']
-                image_id = anno['image_id']
-
-                # Retrieve the question for this annotation
-                qdata = qid2qdata[qid]
-                assert qdata['image_id'] == image_id
-                question = qdata['question']
-                if self.tokenizer is not None:
-                    tokens = self.tokenizer.tokenize(question)
-                    input_ids = self.tokenizer.convert_tokens_to_ids(tokens)
-                else:
-                    tokens = []
-                    input_ids = []
-
-                # Map from each crowdsourced answer to occurrences in annotation
-                answers = [a['answer'] for a in anno['answers']]
-                answer_count = defaultdict(int)
-                for ans in answers:
-                    answer_count[ans] += 1
-
-                # Get label and score (0.3/0.6/1) corresponding to each crowdsourced answer
-                labels = []
-                scores = []
-                answers = []
-                for answer in answer_count:
-                    if answer not in self.ans2label:
-                        continue
-                    labels.append(self.ans2label[answer])
-                    score = get_score(answer_count[answer])
-                    scores.append(score)
-                    answers.append(answer)
-
-                # Store pre-processed example
-                example = {'question_id': qid,
-                            'image_id': image_id,
-                            'question': question,
-                            'question_input_ids': input_ids,
-                            'correct_answer': correct_answer,
-                            'labels': labels,
-                            'answers': answers,
-                            'scores': scores}
-                self.data.append(example)
-
-            pkl.dump(self.data, open(self.cached_data_file, 'wb'))
+        self.cached_data_file = os.path.join(data_dir, 'cached_vqa_data', 'vqa_{}'.format(split))
+        self.source_files = [self.annotations_file, self.questions_file, self.ans2label_file]
+        pickled_data_file = self.cached_data_file + '.pkl'
+        self.data = ColumnarTable.load(self.cached_data_file, VQA_DATA_SCHEMA, self.source_files)
+        if self.data is None and os.path.exists(pickled_data_file) and not os.path.exists(self.questions_file):
+            # Convert the old pickled cache, if the annotations are not available
+            self.data = ColumnarTable.from_records(pkl.load(open(pickled_data_file, 'rb')), VQA_DATA_SCHEMA)
+            self.data.save(self.cached_data_file, self.source_files)
+
+        elif self.data is None:
+            # Annotations are streamed from the JSON files, and processed and written to the cache in chunks
+            self.data = build_annotation_cache(self.cached_data_file, VQA_DATA_SCHEMA, self.source_files,
+                                               examples=iter_vqa_examples(self.questions_file, self.annotations_file),
+                                               process_fn=process_vqa_examples,
+                                               context={'tokenizer': self.tokenizer, 'ans2label': self.ans2label},
+                                               num_workers=kwargs.get('num_cache_workers', 0),
+                                               chunk_size=kwargs.get('cache_chunk_size', DEFAULT_CHUNK_SIZE))
+
+        if self.tokenizer is not None and (self.data.get_lengths('question_input_ids') == 0).any():
+            # Cached data was created without a tokenizer - tokenize all questions once, and update the cache
+            logger.info("Tokenizing VQAv2 {} questions".format(self.split))
+            all_input_ids = tokenize_texts(self.tokenizer, self.data.get_column('question'))
+            self.data = self.data.with_column('question_input_ids', all_input_ids)
+            self.data.save(self.cached_data_file, self.source_files)
+            self.data = ColumnarTable.load(self.cached_data_file)
 
         self.n_examples = len(self.data)
 
@@ -136,6 +182,38 @@ class VQADataset(Dataset):
     def __len__(self):
         return len(self.data)
 
+    def get_image_ids(self) -> List[int]:
+        '''
+        Returns the image_id of every example in self.data (used by ImageGroupedBatchSampler)
+        '''
+        return self.data.get_column('image_id')
+
+    def get_image_sizes(self) -> List:
+        '''
+        Returns the (width, height) of the image of every example in self.data, as it is passed to the model (used by AspectRatioBucketedBatchSampler)
+        '''
+        return [self.images_dataset.get_image_size(image_id) for image_id in self.get_image_ids()]
+
+    def get_text_lengths(self) -> np.ndarray:
+        '''
+        Returns the number of text tokens (including [CLS] and [SEP]) of every example in self.data (used by LengthBucketedBatchSampler)
+        '''
+        return self.data.get_lengths('question_input_ids') + 2
+
+    def get_example_ids(self) -> List[int]:
+        '''
+        Returns the question_id of every example in self.data (used to key cached encoder features to the examples)
+        '''
+        return self.data.get_column('question_id')
+
+    def get_target(self, index: int) -> Dict:
+        '''
+        Returns only the targets of an example, without loading its image (used when training on cached encoder features)
+        '''
+        example = self.data[index]
+        return {'labels': example['labels'],
+                'target_scores': target_tensor(self.num_labels, example['labels'], example['scores'])}
+
     def __getitem__(self, index: int):
 
         """
@@ -148,26 +226,53 @@ class VQADataset(Dataset):
         """
 
         example = self.data[index]
+
+        # Get the image tensor from ImageDataset
+        image = self.images_dataset.get_image_data(example['image_id'])
+        return self.make_item(example, image)
+
+    def __getitems__(self, indices: List[int]) -> List[Dict]:
+
+        """
+        Batched version of __getitem__, called with all indices of a batch by DataLoaders from data.parallel_loading.build_batched_dataloader
+        The images of the batch are loaded once each, concurrently in a thread pool
+
+        Args:
+        indices : indices of elements in self.data to return as data instances
+
+        Returns:
+        list of dictionaries, same as [self[i] for i in indices]
+        """
+
+        examples = [self.data[i] for i in indices]
+        images = self.images_dataset.get_images_data([example['image_id'] for example in examples])
+        return [self.make_item(example, image) for example, image in zip(examples, images)]
+
+    def make_item(self, example: Dict, image) -> Dict:
+
+        """
+        Creates the data instance of an example, given its loaded image
+        """
+
         question_id = example['question_id']
 
         # Tokenize the input question 
         question = example['question']
         input_ids = example['question_input_ids']
 
-        # Get the image tensor from ImageDataset
         image_id = example['image_id']
-        image = self.images_dataset.get_image_data(image_id)
 
+        # Targets are kept sparse (a few labels and scores per question), and densified once per batch by vqa_batch_collate
         labels = example['labels']
         scores = example['scores']
-        target_scores = target_tensor(self.num_labels, labels, scores)
 
         return {'question': question, 
                 'input_ids': input_ids, 
                 'image': image, 
                 'labels': labels, 
-                'target_scores': target_scores, 
-                'question_id': question_id
+                'scores': scores, 
+                'question_id': question_id,
+                'image_id': image_id
                 }
 
     def convert_to_low_shot(self, low_shot_percentage: float):
@@ -180,14 +285,20 @@ class VQADataset(Dataset):
         logger.info("Converting VQA train split into low-shot dataset, with {:.2f}% training samples...".format(low_shot_percentage*100.0))
         n_low_shot_examples = int(low_shot_percentage*self.n_examples)
 
-        new_data = random.sample(self.data, n_low_shot_examples)
-        self.data = new_data
+        # Same sample as random.sample(list_of_examples, n_low_shot_examples)
+        low_shot_indices = random.sample(range(len(self.data)), n_low_shot_examples)
+        self.data = self.data.select(low_shot_indices)
         self.n_examples = len(self.data)
 
         logger.info("Converted into low-shot dataset, with {} examples".format(self.n_examples))
 
 def vqa_batch_collate(batch: List[Dict], 
-                      visual_input_type: str):
+                      visual_input_type: str,
+                      batch_encoder=None,
+                      dedup_images: bool = False,
+                      max_text_length: int = 0,
+                      special_token_ids: Dict[str, int] = None,
+                      num_labels: int = None):
 
     """
     Collates each model input for all batch items into a single model input (e.g. converts a list of input_ids into a matrix of size (batch_size, max_len))
@@ -195,6 +306,12 @@ def vqa_batch_collate(batch: List[Dict],
     Args:
     batch - list of batch items, each item being a dictionary returned by Dataset's __getitem__ method
     visual_input_type: string which specifies the type of visual input
+    batch_encoder: model's ViltBatchEncoder - if given, model input tensors are created in the DataLoader workers
+    dedup_images: if True, every unique image in the batch is kept only once, and image_index maps each question to its image
+    max_text_length: if > 0 and questions were tokenized by the dataset, model-ready text tensors (with special tokens, truncated to max_text_length)
+                     are created from the question input IDs, so that the model does not tokenize the questions again
+    special_token_ids: ids of the tokenizer's special tokens, added to the input IDs when max_text_length > 0 (see data.text_collation.get_special_token_ids)
+    num_labels: number of answer labels, the size of the target scores of every question
 
     Returns:
     Dictionary containing batched inputs and outputs
@@ -217,27 +334,45 @@ def vqa_batch_collate(batch: List[Dict],
     input_ids = torch.tensor(input_ids_padded, dtype=torch.long)
     attn_mask = torch.tensor(attn_masks, dtype=torch.long)
 
-    # Stack the target tensors
+    # Scatter the sparse labels and scores of all questions into the (batch_size, num_labels) target tensor
     batch_labels = [x['labels'] for x in batch]
-    batch_scores = [x['target_scores'] for x in batch]
-    batch_scores = torch.stack(batch_scores, dim=0)
+    batch_scores = batch_target_tensor(num_labels, batch_labels, [x['scores'] for x in batch])
 
     # Depending on the visual_input_type variable, process the images accordingly
     images = [x['image'] for x in batch]
+    image_index = None
+    if dedup_images:
+        images, image_index = deduplicate_images(images, [x['image_id'] for x in batch])
     images = image_collate(images, visual_input_type)
 
-    return {'raw_texts': questions,
-            'input_ids': input_ids,
-            'attn_mask': attn_mask,
-            'images': images,
-            'target_scores': batch_scores,
-            'labels': batch_labels}
+    collated_batch = {'raw_texts': questions,
+                      'input_ids': input_ids,
+                      'attn_mask': attn_mask,
+                      'images': images,
+                      'target_scores': batch_scores,
+                      'labels': batch_labels}
+    if image_index is not None:
+        collated_batch['image_index'] = image_index
+    if max_text_length > 0 and all(len(x['input_ids']) > 0 for x in batch):
+        collated_batch['text_encodings'] = collate_text_encodings([x['input_ids'] for x in batch], max_text_length, special_token_ids)
+
+    if batch_encoder is not None:
+        # Only tensors are sent back to the main process
+        collated_batch['encodings'] = batch_encoder(images, questions)
+        collated_batch['images'] = None
+    return collated_batch
 
 def build_vqa_dataloader(args, 
                          data_dir: str, 
                          images_dataset: MSCOCOImagesDataset, 
                          split: str, 
                          visual_input_type: str,
+                         batch_encoder=None,
+                         image_group_size: int = 0,
+                         length_bucket_size: int = 0,
+                         aspect_ratio_buckets: bool = False,
+                         max_text_length: int = 0,
+                         special_token_ids: Dict[str, int] = None,
                          **kwargs) -> torch.utils.data.DataLoader:
 
     """
@@ -248,6 +383,15 @@ def build_vqa_dataloader(args,
     images_dataset : instance of MSCOCOImagesDataset, that is used to retrieve the MS-COCO image for each question
     split: either train/val split
     visual_input_type: format of visual input to model
+    batch_encoder: model's ViltBatchEncoder - if given, model input tensors are created in the DataLoader workers
+    image_group_size: if > 0, training batches place up to image_group_size questions of the same image next to each other,
+                      and every batch contains each unique image only once
+    length_bucket_size: if > 0 (and image_group_size is 0), training batches contain questions of similar lengths,
+                        sampled from buckets of length_bucket_size batches
+    aspect_ratio_buckets: if True (and image_group_size and length_bucket_size are 0), the images of each training batch have the same model input shape
+    max_text_length: if > 0, questions tokenized by the dataset (requires tokenizer in kwargs) are passed to the model as
+                     ready text tensors, truncated to max_text_length tokens (the model encoder's max_text_length)
+    special_token_ids: ids of the [PAD], [CLS] and [SEP] tokens of the tokenizer in kwargs (see data.text_collation.get_special_token_ids)
 
     Returns:
     DataLoader object
@@ -255,17 +399,32 @@ def build_vqa_dataloader(args,
 
     batch_size = args.batch_size
     shuffle = True if split == 'train' else False
+    dedup_images = image_group_size > 0
 
     logger.info("Creating VQAv2 {} dataloader with batch size of {}".format(split, batch_size))
 
     dataset = VQADataset(data_dir, images_dataset, split, **kwargs)
     num_labels = dataset.num_labels
-    dataloader = torch.utils.data.DataLoader(
+    batch_sampler = None
+    if split == 'train':
+        warn_ignored_batching_options(image_group_size=image_group_size, length_bucket_size=length_bucket_size, aspect_ratio_buckets=aspect_ratio_buckets)
+        if image_group_size > 0:
+            logger.info("Grouping up to {} questions of the same image in each batch".format(image_group_size))
+            batch_sampler = ImageGroupedBatchSampler(dataset, batch_size, image_group_size)
+        elif length_bucket_size > 0:
+            logger.info("Batching questions of similar lengths, from buckets of {} batches".format(length_bucket_size))
+            batch_sampler = LengthBucketedBatchSampler(dataset, batch_size, length_bucket_size, max_length=max_text_length or None)
+        elif aspect_ratio_buckets:
+            logger.info("Batching questions whose images have the same input shape")
+            batch_sampler = AspectRatioBucketedBatchSampler(dataset, batch_size)
+    if batch_sampler is None:
+        batch_sampler = get_default_batch_sampler(dataset, batch_size, shuffle)
+
+    dataloader = build_batched_dataloader(
         dataset,
-        num_workers=args.num_workers,
-        batch_size=batch_size,
-        shuffle=shuffle,
-        collate_fn=lambda x: vqa_batch_collate(x, visual_input_type))
+        batch_sampler,
+        collate_fn=lambda x: vqa_batch_collate(x, visual_input_type, batch_encoder, dedup_images, max_text_length, special_token_ids, num_labels),
+        num_workers=args.num_workers)
     return dataloader
 
 if __name__ == '__main__':
@@ -12,6 +12,7 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 from torch.optim import AdamW
+from torch.utils.data import DataLoader
 
 from transformers import BertConfig, BertTokenizer, BertModel
 from transformers import ViltConfig, ViltProcessor, ViltModel
@@ -19,6 +20,8 @@ from transformers import BertTokenizerFast
 from transformers import logging as transformers_logging
 
 from modeling.continual_learner import EncoderWrapper, ContinualLearner
+from data.example_index import build_example_indexed_dataloader
+from utils.tensor_cache import ShardedRowStore, example_ids_digest, state_dict_hash
 
 logger = logging.getLogger(__name__)
 logging.basicConfig(
@@ -27,6 +30,438 @@ logging.basicConfig(
         level=logging.INFO)
 transformers_logging.set_verbosity_error()
 
+class ViltBatchEncoder:
+
+    def __init__(self, processor: ViltProcessor, max_text_length: int):
+        '''
+        Runs the ViltProcessor on a batch of images and texts, and returns CPU tensors
+        Used inside collate functions, so that tokenization, resizing, normalization and pixel_mask creation
+        happen in the DataLoader worker processes instead of the training loop
+
+        args:
+        processor - instance of ViltProcessor (with BertTokenizerFast as tokenizer)
+        max_text_length - maximum number of text tokens
+        '''
+
+        self.processor = processor
+        self.max_text_length = max_text_length
+
+    def __call__(self, images: List, texts: List[str]) -> Dict:
+        '''
+        Returns dictionary with input_ids, attention_mask, token_type_ids, pixel_values and pixel_mask tensors
+        If images is a raw image batch (see data.image_collation.letterbox_collate), only the texts are tokenized,
+        and the uint8 pixel_values and image_sizes are returned as they are (see raw_images_to_pixel_inputs)
+        '''
+
+        if isinstance(images, dict):
+            encodings = dict(self.processor.tokenizer(texts, max_length=self.max_text_length,
+                padding=True, truncation=True, return_tensors='pt'))
+            encodings.update(images)
+            return encodings
+        encodings = self.processor(images=images, text=texts, max_length=self.max_text_length,
+            padding=True, truncation=True, return_tensors='pt')
+        return dict(encodings)
+
+def raw_images_to_pixel_inputs(pixel_values: torch.ByteTensor, image_sizes: torch.LongTensor) -> Dict:
+    '''
+    Converts a raw image batch (see data.image_collation.letterbox_collate) into ViLT's pixel_values and pixel_mask,
+    with vectorized ops on the whole batch (on the batch's device), instead of per image in the ViltFeatureExtractor
+
+    Pixels are normalized to [-1, 1] like ViltFeatureExtractor (mean=std=0.5), and padded pixels are 0 and have pixel_mask=0
+
+    Args:
+    pixel_values: uint8 tensor of size (B, 3, H, W)
+    image_sizes: LongTensor of size (B, 2) with the (height, width) of every image
+
+    Returns:
+    dictionary with pixel_values, torch.FloatTensor of size (B, 3, H, W), and pixel_mask, torch.LongTensor of size (B, H, W)
+    '''
+
+    height, width = pixel_values.shape[-2:]
+    valid_rows = torch.arange(height, device=pixel_values.device)[None, :] < image_sizes[:, 0:1]
+    valid_cols = torch.arange(width, device=pixel_values.device)[None, :] < image_sizes[:, 1:2]
+    pixel_mask = (valid_rows[:, :, None] & valid_cols[:, None, :]).long()
+    pixel_values = pixel_values.float().div_(255).sub_(0.5).div_(0.5).mul_(pixel_mask[:, None])
+    return {'pixel_values': pixel_values, 'pixel_mask': pixel_mask}
+
+def vilt_uses_adapters(vilt: ViltModel) -> bool:
+    '''
+    Returns True if adapters are active in the ViltModel
+    Adapter layers are only set up inside ViltModel's own forward pass, so the manual forward paths below are not used with adapters
+    '''
+    return getattr(vilt, 'active_adapters', None) is not None
+
+def embed_vilt_images(vilt: ViltModel, pixel_values: torch.FloatTensor, pixel_mask: torch.LongTensor) -> Tuple[torch.FloatTensor, torch.LongTensor]:
+    '''
+    Patch-embeds images with ViLT's visual embedding layer (including position embeddings, but not modality type embeddings)
+    https://github.com/huggingface/transformers/blob/v4.16.2/src/transformers/models/vilt/modeling_vilt.py#L131
+
+    Returns:
+    image_embeds: torch.FloatTensor of size (num_images, num_patches+1, hidden_size)
+    image_masks: torch.LongTensor of size (num_images, num_patches+1)
+    '''
+    image_embeds, image_masks, _ = vilt.embeddings.visual_embed(pixel_values, pixel_mask, max_image_length=vilt.config.max_image_length)
+    return image_embeds, image_masks
+
+def vilt_embed_with_image_embeds(vilt: ViltModel,
+                                 image_embeds: torch.FloatTensor,
+                                 image_masks: torch.LongTensor,
+                                 attention_mask: torch.LongTensor,
+                                 input_ids: torch.LongTensor = None,
+                                 token_type_ids: torch.LongTensor = None,
+                                 inputs_embeds: torch.FloatTensor = None,
+                                 image_token_type_idx=1,
+                                 text_embeds: torch.FloatTensor = None) -> Tuple[torch.FloatTensor, torch.LongTensor]:
+    '''
+    Same computation as ViltEmbeddings' forward pass, but starting from image embeddings created by embed_vilt_images
+    https://github.com/huggingface/transformers/blob/v4.16.2/src/transformers/models/vilt/modeling_vilt.py#L207
+
+    Args:
+    image_embeds, image_masks: outputs of embed_vilt_images, one row for every text
+    attention_mask, input_ids, token_type_ids, inputs_embeds: text inputs, as in ViltModel's forward pass
+    image_token_type_idx: modality type of the image tokens - either an int, or a LongTensor with one value for every row
+    text_embeds: precomputed text embedding layer output (before dropout) of a single constant text, shared by all rows (optional)
+
+    Returns:
+    embedding_output: torch.FloatTensor of size (batch_size, text_length+num_patches+1, hidden_size)
+    masks: attention mask over the text and image tokens, torch.LongTensor of size (batch_size, text_length+num_patches+1)
+    '''
+
+    embeddings = vilt.embeddings
+    if text_embeds is not None:
+        # Every row gets its own dropout mask, as in the regular forward pass
+        text_embeds = embeddings.text_embeddings.dropout(text_embeds.expand(len(image_embeds), -1, -1))
+    else:
+        text_embeds = embeddings.text_embeddings(input_ids=input_ids, token_type_ids=token_type_ids, inputs_embeds=inputs_embeds)
+
+    # Add modality type embeddings
+    if image_token_type_idx is None:
+        image_token_type_idx = 1
+    text_embeds = text_embeds + embeddings.token_type_embeddings(torch.zeros_like(attention_mask))
+    if isinstance(image_token_type_idx, int):
+        image_type_ids = torch.full_like(image_masks, image_token_type_idx)
+    else:
+        image_type_ids = image_token_type_idx.view(-1, 1).expand_as(image_masks)
+    image_embeds = image_embeds + embeddings.token_type_embeddings(image_type_ids)
+
+    embedding_output = torch.cat([text_embeds, image_embeds], dim=1)
+    masks = torch.cat([attention_mask, image_masks], dim=1)
+    return embedding_output, masks
+
+def run_vilt_layers(vilt: ViltModel, hidden_states: torch.FloatTensor, masks: torch.LongTensor, start_layer: int = 0, end_layer: int = None) -> torch.FloatTensor:
+    '''
+    Runs hidden_states through ViLT transformer layers start_layer, ..., end_layer-1 (same computation as ViltEncoder's forward pass for all layers)
+    '''
+
+    extended_attention_mask = vilt.get_extended_attention_mask(masks, masks.size(), masks.device)
+    for layer in vilt.encoder.layer[start_layer:end_layer]:
+        hidden_states = layer(hidden_states, attention_mask=extended_attention_mask)[0]
+    return hidden_states
+
+def vilt_pool(vilt: ViltModel, hidden_states: torch.FloatTensor) -> torch.FloatTensor:
+    '''
+    Returns pooler_output of size (batch_size, hidden_size) from the output of the last ViLT transformer layer
+    '''
+
+    sequence_output = vilt.layernorm(hidden_states)
+    return vilt.pooler(sequence_output)
+
+def vilt_embed_and_run_layers(vilt: ViltModel, 
+                              num_layers: int, 
+                              image_index: torch.LongTensor = None, 
+                              image_embeds: Tuple[torch.FloatTensor, torch.LongTensor] = None, 
+                              text_embeds: torch.FloatTensor = None, 
+                              **encodings: Dict) -> Tuple[torch.FloatTensor, torch.LongTensor]:
+    '''
+    Embeds the text and image inputs, and runs the embeddings through the bottom num_layers ViLT transformer layers
+
+    Args:
+    num_layers: number of transformer layers to run (0 returns the embedding output)
+    image_index: if given, pixel_values contains every unique image once, and image_index[i] is the image of the i-th text
+    image_embeds: precomputed (image_embeds, image_masks) visual embedding layer outputs (before dropout) of the unique images (optional)
+    text_embeds: precomputed text embedding layer output (before dropout) of a single constant text (optional)
+    encodings: Dictionary containing inputs ViltModel's forward pass
+
+    Returns:
+    hidden_states: output of layer num_layers-1, torch.FloatTensor of size (batch_size, num_tokens, hidden_size)
+    masks: attention mask over the text and image tokens, torch.LongTensor of size (batch_size, num_tokens)
+    '''
+
+    if image_embeds is None:
+        image_embeds, image_masks = embed_vilt_images(vilt, encodings['pixel_values'], encodings['pixel_mask'])
+        if image_index is not None:
+            image_embeds, image_masks = image_embeds[image_index], image_masks[image_index]
+    else:
+        image_embeds, image_masks = image_embeds
+        if image_index is not None:
+            image_embeds, image_masks = image_embeds[image_index], image_masks[image_index]
+        image_embeds = vilt.embeddings.dropout(image_embeds)
+    embedding_output, masks = vilt_embed_with_image_embeds(vilt,
+                                                           image_embeds,
+                                                           image_masks,
+                                                           encodings['attention_mask'],
+                                                           input_ids=encodings.get('input_ids'),
+                                                           token_type_ids=encodings.get('token_type_ids'),
+                                                           inputs_embeds=encodings.get('inputs_embeds'),
+                                                           image_token_type_idx=encodings.get('image_token_type_idx', 1),
+                                                           text_embeds=text_embeds)
+    hidden_states = run_vilt_layers(vilt, embedding_output, masks, 0, num_layers)
+    return hidden_states, masks
+
+class ViltFrozenLayersCache:
+
+    def __init__(self, cache_dir: str, max_text_length: int, max_image_length: int, hidden_size: int):
+        '''
+        On-disk cache of the hidden states after ViLT's frozen embeddings and bottom transformer layers, for every text-image input of the registered datasets
+        Inputs are keyed by the dataset index of their example (see index_task_dataloaders), so the hidden states are re-used across epochs
+        (and across experiments with the same frozen weights and datasets), without copying or hashing the inputs
+        Hidden states of every dataset split are kept in preallocated, memory-mapped shards of a ShardedRowStore, with one row per encoder input
+        that holds the valid (non-padding) text tokens and image tokens, in float16
+
+        Cached hidden states must not depend on random dropout masks, so the frozen layers are always run in eval mode (without dropout) when the cache is enabled,
+        also for inputs that are not cached. Image patches must also be deterministic, i.e. ViltConfig.max_image_length < 0 (the default), so that no random subset of patches is sampled
+
+        The cache is shared (not copied) by deep copies of the encoder, e.g. best-model snapshots
+
+        Args:
+        cache_dir: directory where hidden states are stored - should be specific to the frozen weights
+        max_text_length: maximum number of text tokens of an input
+        max_image_length: maximum number of image tokens of an input (image [CLS] token and patches)
+        hidden_size: size of the hidden states
+        '''
+
+        self.cache_dir = cache_dir
+        self.max_text_length = max_text_length
+        self.max_image_length = max_image_length
+        self.hidden_size = hidden_size
+        self.row_stores = {}
+
+    def __deepcopy__(self, memo):
+        return self
+
+    def index_dataloader(self, namespace: str, dataloader: DataLoader, rows_per_example: int) -> DataLoader:
+        '''
+        Creates the row store of dataloader's dataset, with rows_per_example encoder inputs per example,
+        and returns a dataloader whose batches contain the examples' dataset indices
+        '''
+
+        dataset = dataloader.dataset
+        self.row_stores[namespace] = ShardedRowStore(os.path.join(self.cache_dir, namespace),
+                                                     num_rows=len(dataset)*rows_per_example,
+                                                     segment_sizes=[self.max_text_length, self.max_image_length],
+                                                     feature_shape=(self.hidden_size,),
+                                                     fingerprint=example_ids_digest(dataset.get_example_ids()))
+        return build_example_indexed_dataloader(dataloader, namespace)
+
+    def index_task_dataloaders(self, task_key: str, task_config: Dict, task_trainer):
+        '''
+        Replaces the task trainer's train and val dataloaders with dataloaders whose batches contain the dataset index of every example,
+        which the ContinualLearner's forward pass maps to rows of the cache
+
+        Args:
+        task_key: key of the task
+        task_config: config of the task - multi-choice tasks have num_choices encoder inputs per example, other tasks num_images
+        task_trainer: trainer of the task, whose datasets implement get_example_ids() - returns the ids of all examples, in order
+        '''
+
+        rows_per_example = task_config['num_choices'] if task_config['model_type'] == 'multi-choice' else task_config['num_images']
+        dataloaders = []
+        for dataloader in [task_trainer.get_train_dataloader(), task_trainer.get_eval_dataloader()]:
+            namespace = '{}_{}'.format(task_key, dataloader.dataset.split)
+            dataloaders.append(self.index_dataloader(namespace, dataloader, rows_per_example))
+        task_trainer.replace_dataloaders(*dataloaders)
+
+    def compute_hidden_states(self, vilt: ViltModel, num_frozen_layers: int, image_index: torch.LongTensor, encodings: Dict) -> Tuple[torch.FloatTensor, torch.LongTensor]:
+        '''
+        Runs the frozen layers without dropout and gradients, and returns the hidden states (rounded to float16, like cached hidden states) and the attention mask
+        '''
+
+        frozen_modules = [vilt.embeddings] + list(vilt.encoder.layer[:num_frozen_layers])
+        was_training = [m.training for m in frozen_modules]
+        for m in frozen_modules:
+            m.eval()
+        with torch.no_grad():
+            hidden_states, masks = vilt_embed_and_run_layers(vilt, num_frozen_layers, image_index, **encodings)
+        for m, training in zip(frozen_modules, was_training):
+            m.train(training)
+        return hidden_states.to(torch.float16).to(hidden_states.dtype), masks
+
+    def store_rows(self, row_store: ShardedRowStore, vilt: ViltModel, num_frozen_layers: int, image_index: torch.LongTensor, encodings: Dict, rows: List[int], batch_rows: List[int]):
+        '''
+        Computes the hidden states of the batch rows batch_rows, and writes the valid text tokens and image tokens of every row to the store rows
+        '''
+
+        row_index = torch.LongTensor(batch_rows).to(encodings['attention_mask'].device)
+        row_encodings = {}
+        for k, v in encodings.items():
+            if k in ['pixel_values', 'pixel_mask'] or not torch.is_tensor(v):
+                row_encodings[k] = v
+            else:
+                row_encodings[k] = v[row_index]
+        row_image_index = image_index[row_index] if image_index is not None else row_index
+        hidden_states, masks = self.compute_hidden_states(vilt, num_frozen_layers, row_image_index, row_encodings)
+
+        text_width = row_encodings['attention_mask'].shape[1]
+        hidden_states = hidden_states.to(torch.float16).cpu().numpy()
+        text_lengths = masks[:, :text_width].sum(dim=1).tolist()
+        image_lengths = masks[:, text_width:].sum(dim=1).tolist()
+        for r, row in enumerate(rows):
+            # Valid image tokens (image [CLS] token and patches) come before padding patches
+            row_store.write(row, [hidden_states[r, :text_lengths[r]], hidden_states[r, text_width:text_width+image_lengths[r]]])
+
+    def get_hidden_states(self, 
+                          vilt: ViltModel, 
+                          num_frozen_layers: int, 
+                          image_index: torch.LongTensor, 
+                          encodings: Dict, 
+                          cache_rows: Tuple[str, torch.LongTensor] = None) -> Tuple[torch.FloatTensor, torch.LongTensor]:
+        '''
+        Returns the hidden states after the bottom num_frozen_layers layers, and the attention mask over text and image tokens
+        Hidden states of rows that are not in the cache yet are computed and added to the cache
+
+        Args:
+        cache_rows: (namespace, rows) - the row store and the row of every input in the batch (see get_frozen_cache_rows)
+                    If None, the hidden states are computed (in eval mode, like cached hidden states), but not cached
+        '''
+
+        if cache_rows is None:
+            return self.compute_hidden_states(vilt, num_frozen_layers, image_index, encodings)
+
+        namespace, rows = cache_rows
+        row_store = self.row_stores[namespace]
+        rows = rows.tolist()
+        # Segment lengths of the stored rows are on the CPU, so cache hits need no copies from the device
+        lengths = row_store.get_lengths(rows)
+        missing_rows = [i for i in range(len(rows)) if lengths[i, 1] == 0]
+        if len(missing_rows) > 0:
+            self.store_rows(row_store, vilt, num_frozen_layers, image_index, encodings, [rows[i] for i in missing_rows], missing_rows)
+            lengths = row_store.get_lengths(rows)
+
+        # Text tokens are padded to the batch's text length, and image tokens to the longest image in the batch
+        attention_mask = encodings['attention_mask']
+        text_width = attention_mask.shape[1]
+        image_width = int(lengths[:, 1].max())
+        hidden_states = torch.from_numpy(row_store.read(rows, [text_width, image_width]))
+        image_masks = torch.from_numpy((np.arange(image_width)[None, :] < lengths[:, 1:2]).astype(np.int64))
+
+        dtype = vilt.embeddings.token_type_embeddings.weight.dtype
+        hidden_states = hidden_states.to(attention_mask.device, non_blocking=True).to(dtype)
+        masks = torch.cat([attention_mask, image_masks.to(attention_mask.device, attention_mask.dtype)], dim=1)
+        return hidden_states, masks
+
+def get_vilt_max_image_length(vilt: ViltModel, image_size) -> int:
+    '''
+    Returns the maximum number of image tokens (image [CLS] token and patches) of an image resized by ViltFeatureExtractor with size=image_size,
+    whose short side is scaled to image_size and long side to at most 1333/800 * image_size
+    '''
+
+    shorter = max(image_size) if isinstance(image_size, (tuple, list)) else image_size
+    longer = int((1333 / 800) * shorter)
+    patch_size = vilt.config.patch_size
+    return (shorter // patch_size) * (longer // patch_size) + 1
+
+def get_frozen_cache_rows(example_index: Tuple[str, torch.LongTensor], rows_per_example: int) -> Tuple[str, torch.LongTensor]:
+    '''
+    Maps the (namespace, dataset indices) of a batch's examples to the (namespace, rows) of its encoder inputs in ViltFrozenLayersCache,
+    where every example has rows_per_example consecutive inputs (e.g. one per NLVR2 image or VCR answer choice)
+    '''
+
+    if example_index is None:
+        return None
+    namespace, indices = example_index
+    rows = indices.repeat_interleave(rows_per_example) * rows_per_example + torch.arange(rows_per_example).repeat(len(indices))
+    return namespace, rows
+
+def vilt_forward_from_pixels(vilt: ViltModel, 
+                             image_index: torch.LongTensor = None, 
+                             num_frozen_layers: int = 0, 
+                             frozen_layers_cache: ViltFrozenLayersCache = None, 
+                             cache_rows: Tuple[str, torch.LongTensor] = None, 
+                             image_embeds: Tuple[torch.FloatTensor, torch.LongTensor] = None, 
+                             text_embeds: torch.FloatTensor = None, 
+                             **encodings: Dict) -> torch.FloatTensor:
+    '''
+    Forward pass that patch-embeds the images separately from the texts, and runs the transformer layers one by one. 
+    This supports the following cases, which ViltModel's forward pass does not:
+    - image_index is given: pixel_values/pixel_mask contain every unique image in the batch only once, and image_index maps every text to its image.
+      Each unique image is patch-embedded once, and its embeddings are shared by all its texts
+    - image_token_type_idx is a LongTensor: every row has its own image modality type (e.g. stacked NLVR2 image slots)
+    - num_frozen_layers > 0: the embeddings and bottom num_frozen_layers layers are frozen, so they are run under torch.no_grad and cut from the autograd graph.
+      If frozen_layers_cache is given, their output hidden states are read from (and written to) the cache rows cache_rows (see get_frozen_cache_rows)
+    - image_embeds/text_embeds are given: embedding layer outputs of a constant image or text (see ViltConstantModalityCache) are broadcast to all rows
+
+    Returns:
+    pooler_output: torch.FloatTensor of size (batch_size, hidden_size)
+    '''
+
+    if vilt_uses_adapters(vilt):
+        assert not torch.is_tensor(encodings.get('image_token_type_idx')), "Per-row image_token_type_idx is not supported with adapters"
+        if image_index is not None:
+            encodings['pixel_values'] = encodings['pixel_values'][image_index]
+            encodings['pixel_mask'] = encodings['pixel_mask'][image_index]
+        return vilt(**encodings).pooler_output
+
+    if num_frozen_layers > 0 and frozen_layers_cache is not None:
+        hidden_states, masks = frozen_layers_cache.get_hidden_states(vilt, num_frozen_layers, image_index, encodings, cache_rows)
+    elif num_frozen_layers > 0:
+        with torch.no_grad():
+            hidden_states, masks = vilt_embed_and_run_layers(vilt, num_frozen_layers, image_index, image_embeds, text_embeds, **encodings)
+    else:
+        hidden_states, masks = vilt_embed_and_run_layers(vilt, 0, image_index, image_embeds, text_embeds, **encodings)
+
+    hidden_states = run_vilt_layers(vilt, hidden_states, masks, start_layer=num_frozen_layers)
+    return vilt_pool(vilt, hidden_states)
+
+class ViltConstantModalityCache:
+
+    def __init__(self):
+        '''
+        Language-only tasks pair every text with the same constant image (the mean MS-COCO image),
+        and vision-only tasks pair every image with the same dummy text.
+        This class caches the processed tensors of the constant input, which only depend on the processor settings,
+        and its embedding layer outputs (before dropout), which are re-used as long as the embedding weights do not change.
+        The cached outputs are broadcast across the batch, instead of re-computing them for every row
+        '''
+
+        self.processed_inputs = {}
+        self.embeddings = {}
+
+    def get_processed_inputs(self, key: str, source, settings, process_fn) -> Dict:
+        '''
+        Returns the output of process_fn(), which is computed again only if source (the constant input) or settings (processor settings, device) changed
+        '''
+
+        entry = self.processed_inputs.get(key)
+        if entry is None or not (entry[0] is source or entry[0] == source) or entry[1] != settings:
+            entry = (source, settings, process_fn())
+            self.processed_inputs[key] = entry
+            # Embeddings of the previous constant input are stale
+            self.embeddings.pop(key, None)
+        return entry[2]
+
+    def get_embeddings(self, key: str, module: nn.Module, embed_fn):
+        '''
+        Returns the output of embed_fn(), computed with module in eval mode (without dropout)
+        The output is cached and re-used until module's weights are updated (tracked by the parameters' in-place version counters),
+        unless gradients are needed for module's weights - then it is computed again for every batch, for a single row
+        '''
+
+        params = list(module.parameters())
+        weights_state = tuple((p.data_ptr(), p._version) for p in params)
+        cacheable = not torch.is_grad_enabled() or not any(p.requires_grad for p in params)
+        entry = self.embeddings.get(key)
+        if cacheable and entry is not None and entry[0] == weights_state:
+            return entry[1]
+
+        was_training = module.training
+        module.eval()
+        output = embed_fn()
+        module.train(was_training)
+        if cacheable:
+            self.embeddings[key] = (weights_state, output)
+        return output
+
+
 class ViltEncoderWrapper(EncoderWrapper):
 
     def __init__(self, 
@@ -49,6 +484,9 @@ class ViltEncoderWrapper(EncoderWrapper):
         self.processor.tokenizer = BertTokenizerFast.from_pretrained("bert-base-uncased")
         self.max_text_length = self.vilt.config.max_position_embeddings
         self.encoder_dim = self.vilt.config.hidden_size
+        self.num_frozen_layers = 0
+        self.frozen_layers_cache = None
+        self.constant_modality_cache = ViltConstantModalityCache()
 
     def reset_processor(self, max_text_length: int, img_size: tuple):
         self.max_text_length = max_text_length
@@ -80,21 +518,80 @@ class ViltEncoderWrapper(EncoderWrapper):
         self.vilt.embeddings.text_embeddings.\
             register_buffer("position_ids", torch.arange(max_len).expand((1, -1)))
 
-    def process_inputs(self, images: List, texts: List[str]) -> Dict:
+    def process_inputs(self, images: List, texts: List[str], encodings: Dict = None) -> Dict:
         '''
         Returns encodings that can be inputted to the ViLT transformer
 
         Args:
         images - list of PIL Image objects
         texts - list of text strings
+        encodings - tensors already created by a ViltBatchEncoder in the DataLoader workers (optional).
+                    If given, images and texts are not processed again, and the tensors are only moved to the device.
+                    If encodings only contain text tensors (pre-tokenized texts from the dataset), only the images are processed,
+                    and if they only contain a raw image batch, only the texts are tokenized.
+                    Raw image batches (uint8 pixel_values with image_sizes) are normalized on the device, see raw_images_to_pixel_inputs
 
         Returns:
         encodings - dictionary, where each key corresponds to a different argument of the vilt's forward method
         '''
-        encodings = self.processor(images=images, text=texts, max_length=self.max_text_length,
-            padding=True, truncation=True, return_tensors='pt').to(self.device)
+        if encodings is None:
+            encodings = self.processor(images=images, text=texts, max_length=self.max_text_length,
+                padding=True, truncation=True, return_tensors='pt')
+        else:
+            encodings = dict(encodings)
+            if 'input_ids' not in encodings:
+                encodings.update(self.processor.tokenizer(texts, max_length=self.max_text_length,
+                    padding=True, truncation=True, return_tensors='pt'))
+            if 'pixel_values' not in encodings:
+                encodings.update(self.processor.feature_extractor(images, return_tensors='pt'))
+        encodings = {k: v.to(self.device, non_blocking=True) for k, v in encodings.items()}
+        if 'image_sizes' in encodings:
+            encodings.update(raw_images_to_pixel_inputs(encodings.pop('pixel_values'), encodings.pop('image_sizes')))
+        return encodings
+
+    def process_inputs_with_constant_image(self, image: Image, texts: List[str]) -> Dict:
+        '''
+        Returns encodings for texts that are all paired with the same constant image (e.g. the mean image for language-only tasks)
+        The image is processed and patch-embedded once (see ViltConstantModalityCache), and shared by all texts through image_index
+        '''
+
+        encodings = self.processor.tokenizer(texts, max_length=self.max_text_length,
+            padding=True, truncation=True, return_tensors='pt')
+        encodings = {k: v.to(self.device, non_blocking=True) for k, v in encodings.items()}
+        process_image_fn = lambda: {k: v.to(self.device) for k, v in self.processor.feature_extractor([image], return_tensors='pt').items()}
+        image_encodings = self.constant_modality_cache.get_processed_inputs('image', image,
+            (str(self.processor.feature_extractor.size), str(self.device)), process_image_fn)
+        encodings.update(image_encodings)
+        encodings['image_index'] = torch.zeros(len(encodings['input_ids']), dtype=torch.long, device=self.device)
+        if not vilt_uses_adapters(self.vilt):
+            embed_image_fn = lambda: embed_vilt_images(self.vilt, image_encodings['pixel_values'], image_encodings['pixel_mask'])
+            encodings['image_embeds'] = self.constant_modality_cache.get_embeddings('image', self.vilt.embeddings, embed_image_fn)
         return encodings
 
+    def process_inputs_with_constant_text(self, images: List, text: str) -> Dict:
+        '''
+        Returns encodings for images that are all paired with the same constant text (e.g. the dummy text for vision-only tasks)
+        The text is tokenized and embedded once (see ViltConstantModalityCache), and broadcast across the batch
+        '''
+
+        encodings = self.processor.feature_extractor(images, return_tensors='pt')
+        encodings = {k: v.to(self.device, non_blocking=True) for k, v in encodings.items()}
+        process_text_fn = lambda: {k: v.to(self.device) for k, v in self.processor.tokenizer([text], max_length=self.max_text_length,
+            padding=True, truncation=True, return_tensors='pt').items()}
+        text_encodings = self.constant_modality_cache.get_processed_inputs('text', text, (self.max_text_length, str(self.device)), process_text_fn)
+        bs = len(encodings['pixel_values'])
+        encodings.update({k: v.expand(bs, -1) for k, v in text_encodings.items()})
+        if not vilt_uses_adapters(self.vilt):
+            embed_text_fn = lambda: self.vilt.embeddings.text_embeddings(input_ids=text_encodings['input_ids'], token_type_ids=text_encodings['token_type_ids'])
+            encodings['text_embeds'] = self.constant_modality_cache.get_embeddings('text', self.vilt.embeddings.text_embeddings, embed_text_fn)
+        return encodings
+
+    def get_batch_encoder(self) -> ViltBatchEncoder:
+        '''
+        Returns a ViltBatchEncoder that matches the current processor settings, for preprocessing inside DataLoader workers
+        '''
+        return ViltBatchEncoder(self.processor, self.max_text_length)
+
     def expand_modality_type_embeddings(self, type_vocab_size=3):
         '''
         ViLT contains only 2 token type embeddings - some tasks (like NLVR) require three token type embeddings
@@ -108,18 +605,35 @@ class ViltEncoderWrapper(EncoderWrapper):
         self.vilt.embeddings.token_type_embeddings.weight.data[1, :] = emb_data[1, :]
         self.vilt.embeddings.token_type_embeddings.weight.data[2, :] = emb_data[1, :]
 
-    def forward(self, **encodings: Dict) -> torch.FloatTensor:
+    def forward(self, 
+                image_index: torch.LongTensor = None, 
+                image_embeds: Tuple[torch.FloatTensor, torch.LongTensor] = None, 
+                text_embeds: torch.FloatTensor = None, 
+                cache_rows: Tuple[str, torch.LongTensor] = None, 
+                **encodings: Dict) -> torch.FloatTensor:
         '''
         Does forward pass of input encodings through ViltModel
         https://huggingface.co/docs/transformers/model_doc/vilt#transformers.ViltModel.forward
 
         Args:
-        encodings: Dictionary containing inputs ViltModel's forward pass
+        image_index: if given, pixel_values contains every unique image once, and image_index[i] is the image of the i-th text
+        image_embeds, text_embeds: cached embedding layer outputs of a constant image/text (see process_inputs_with_constant_image/text)
+        cache_rows: (namespace, rows) of the inputs in the frozen layers cache, if it is enabled (see enable_frozen_layers_cache)
+        encodings: Dictionary containing inputs ViltModel's forward pass (image_token_type_idx can also be a LongTensor with one value per row)
 
         Returns:
         pooler_output: torch.FloatTensor of size (batch_size, hidden_size)
         '''
 
+        if image_index is not None or torch.is_tensor(encodings.get('image_token_type_idx')) or self.num_frozen_layers > 0 \
+                or image_embeds is not None or text_embeds is not None:
+            return vilt_forward_from_pixels(self.vilt, image_index, 
+                                            num_frozen_layers=self.num_frozen_layers,
+                                            frozen_layers_cache=self.frozen_layers_cache,
+                                            cache_rows=cache_rows,
+                                            image_embeds=image_embeds,
+                                            text_embeds=text_embeds,
+                                            **encodings)
         output = self.vilt(**encodings)
         return output.pooler_output
 
@@ -134,6 +648,7 @@ class ViltEncoderWrapper(EncoderWrapper):
     def freeze_bottom_k_layers(self, k: int):
         '''
         Freeze embedding parameters and bottom K transformer layer parameters
+        The frozen layers are then run without gradients in the forward pass
         '''
 
         assert k < len(self.vilt.encoder.layer)
@@ -142,6 +657,23 @@ class ViltEncoderWrapper(EncoderWrapper):
         for i in range(k):
             for p in self.vilt.encoder.layer[i].parameters():
                 p.requires_grad = False
+        self.num_frozen_layers = k
+
+    def enable_frozen_layers_cache(self, cache_dir: str):
+        '''
+        Caches the hidden states after the frozen bottom K layers on disk (see ViltFrozenLayersCache), in a sub-directory specific to the frozen weights
+        Must be called after freeze_bottom_k_layers
+        '''
+
+        assert self.num_frozen_layers > 0
+        frozen_modules = [('embeddings', self.vilt.embeddings)] + [('layer.{}'.format(i), self.vilt.encoder.layer[i]) for i in range(self.num_frozen_layers)]
+        frozen_weights_hash = state_dict_hash([('{}.{}'.format(prefix, n), p) for prefix, m in frozen_modules for n, p in m.state_dict().items()])
+        frozen_layers_cache_dir = os.path.join(cache_dir, '{}_{}layers'.format(frozen_weights_hash, self.num_frozen_layers))
+        self.frozen_layers_cache = ViltFrozenLayersCache(frozen_layers_cache_dir,
+                                                         max_text_length=self.max_text_length,
+                                                         max_image_length=get_vilt_max_image_length(self.vilt, self.processor.feature_extractor.size),
+                                                         hidden_size=self.vilt.config.hidden_size)
+        logger.info("Caching hidden states of {} frozen ViLT layers in {}".format(self.num_frozen_layers, frozen_layers_cache_dir))
 
 
 class ViltContinualLearner(ContinualLearner):
@@ -215,7 +747,8 @@ class ViltContinualLearner(ContinualLearner):
         return optimizer
 
 
-    def forward(self, task_key: str, images: List, texts: List[str]):
+    def forward(self, task_key: str, images: List = None, texts: List[str] = None, encodings: Dict = None, image_index: torch.LongTensor = None,
+                encoder_features: torch.FloatTensor = None, example_index: Tuple[str, torch.LongTensor] = None):
         '''
         Does forward pass of image and text inputs through model, 
         depending on if the task is multichoice or classification with one or more images
@@ -224,21 +757,31 @@ class ViltContinualLearner(ContinualLearner):
         task_key - string which indicates which task to do forward pass for
         images - list of PIL Image objects
         texts - list of text strings
+        encodings - ready input tensors created by the collate function in the DataLoader workers (optional, replaces images and texts)
+        image_index - if given, images contains every unique image of the batch once, and image_index maps each text to its image (single-image tasks only)
+        encoder_features - pooled outputs of a frozen encoder, cached by FrozenEncoderFeatureCache (optional, replaces all other inputs)
+        example_index - (namespace, dataset indices) of the batch's examples, used to look up the frozen layers' cached hidden states (see ViltFrozenLayersCache) (optional)
 
         Returns:
         https://huggingface.co/docs/transformers/v4.21.1/en/main_classes/output#transformers.modeling_outputs.BaseModelOutputWithPooling
         '''
 
         task_config = self.task_configs[task_key]
+        if encoder_features is not None:
+            return self.forward_encoder_features(task_key, encoder_features)
         if task_config['model_type'] == 'multi-choice':
-            return self.forward_multi_choice(task_key, images, texts, task_config['num_choices'])
+            return self.forward_multi_choice(task_key, images, texts, task_config['num_choices'], encodings=encodings,
+                                             cache_rows=get_frozen_cache_rows(example_index, task_config['num_choices']))
         elif task_config['model_type'] == 'classification':
             if task_config['num_images'] == 1:
-                return self.forward_single_image(task_key, images, texts)
+                return self.forward_single_image(task_key, images, texts, encodings=encodings, image_index=image_index,
+                                                 cache_rows=get_frozen_cache_rows(example_index, 1))
             else:
-                return self.forward_multi_images(task_key, images, texts, task_config['num_images'])
+                return self.forward_multi_images(task_key, images, texts, task_config['num_images'], encodings=encodings,
+                                                 cache_rows=get_frozen_cache_rows(example_index, task_config['num_images']))
 
-    def forward_single_image(self, task_key: str, images: List, texts: List[str]) -> Tuple[torch.FloatTensor, torch.FloatTensor]:
+    def forward_single_image(self, task_key: str, images: List, texts: List[str], encodings: Dict = None, image_index: torch.LongTensor = None,
+                             cache_rows: Tuple[str, torch.LongTensor] = None) -> Tuple[torch.FloatTensor, torch.FloatTensor]:
         '''
         Does forward pass of image and text inputs through model, 
         where every input has one image and one text
@@ -247,108 +790,145 @@ class ViltContinualLearner(ContinualLearner):
         task_key - string which indicates which task to do forward pass for
         images - list of PIL Image objects
         texts - list of text strings
+        encodings - ready input tensors created in the DataLoader workers (optional)
+        image_index - if given, images contains every unique image once and image_index[i] is the image of texts[i],
+                      so that each unique image is preprocessed and patch-embedded only once
+        cache_rows - (namespace, rows) of the inputs in the frozen layers cache (optional)
 
         Returns:
         encoder_output: https://huggingface.co/docs/transformers/v4.21.1/en/main_classes/output#transformers.modeling_outputs.BaseModelOutputWithPooling
         output_logits: logits for each output class (batch_size, num_labels)
         '''
 
-        encodings = self.vilt_encoder.process_inputs(images, texts)
+        encodings = self.vilt_encoder.process_inputs(images, texts, encodings)
+        if image_index is not None:
+            encodings['image_index'] = image_index.to(self.vilt_encoder.device, non_blocking=True)
 
-        encoder_output = self.vilt_encoder(**encodings)
+        encoder_output = self.vilt_encoder(cache_rows=cache_rows, **encodings)
 
         output_logits = self.task_layer[task_key](encoder_output)
         return encoder_output, output_logits
 
-    def forward_multi_images(self, task_key: str, images: List[List], texts: List[str], num_images=2) -> Tuple[torch.FloatTensor, torch.FloatTensor]:
+    def forward_multi_images(self, task_key: str, images: List[List], texts: List[str], num_images=2, encodings: Dict = None,
+                             cache_rows: Tuple[str, torch.LongTensor] = None) -> Tuple[torch.FloatTensor, torch.FloatTensor]:
 
         '''
         Does forward pass of image and text inputs through model, 
         where every input has multiple images and one text
-        For tasks like NLVR2, do multiple text-image passes with each image and aggregate results
+        For tasks like NLVR2, do a text-image pass with each image (stacked into a single encoder pass) and aggregate results
 
         Args:
         task_key - string which indicates which task to do forward pass for
         images - batch_size-sized list of num_images-sized list of PIL Image objects
         texts - list of text strings
+        encodings - ready input tensors created in the DataLoader workers from the flattened images list (optional)
+        cache_rows - (namespace, rows) of the stacked (example, image slot) inputs in the frozen layers cache (optional, not used with adapters)
 
         Returns:
         pooled_output: pooled feature Tensor of size (batch_size, num_images*hidden_size)
         output_logits: logits for each output class (batch_size, num_labels)
         '''
 
-        flat_images_list = list(itertools.chain(*images))
-        encodings = self.vilt_encoder.process_inputs(flat_images_list, texts)
+        flat_images_list = list(itertools.chain(*images)) if encodings is None else None
+        encodings = self.vilt_encoder.process_inputs(flat_images_list, texts, encodings)
 
         input_ids, attention_mask, token_type_ids = \
             encodings['input_ids'], encodings['attention_mask'], encodings['token_type_ids']
-        # reshape
         bs = len(input_ids)
-        pixel_values = encodings['pixel_values'].view(bs, num_images, *encodings["pixel_values"].shape[-3:])
-        pixel_mask = encodings['pixel_mask'].view(bs, num_images, *encodings["pixel_mask"].shape[-2:])
 
-        # https://github.com/huggingface/transformers/blob/v4.16.2/src/transformers/models/vilt/modeling_vilt.py#L1351
-        pooler_outputs = []
-        for i in range(num_images):
-            # forward every image through the model
+        if vilt_uses_adapters(self.vilt_encoder.vilt):
+            # Adapters need ViltModel's own forward pass, which takes a single image_token_type_idx - forward every image slot separately
+            # reshape
+            pixel_values = encodings['pixel_values'].view(bs, num_images, *encodings["pixel_values"].shape[-3:])
+            pixel_mask = encodings['pixel_mask'].view(bs, num_images, *encodings["pixel_mask"].shape[-2:])
+
+            # https://github.com/huggingface/transformers/blob/v4.16.2/src/transformers/models/vilt/modeling_vilt.py#L1351
+            pooler_outputs = []
+            for i in range(num_images):
+                # forward every image through the model
+                encodings = {
+                    'input_ids': input_ids,
+                    'attention_mask': attention_mask,
+                    'token_type_ids': token_type_ids,
+                    'pixel_values': pixel_values[:, i, :, :, :],
+                    'pixel_mask': pixel_mask[:, i, :, :],
+                    'image_token_type_idx': i + 1,
+                }
+                pooled_out = self.vilt_encoder(**encodings)
+                pooler_outputs.append(pooled_out)
+            pooled_output = torch.cat(pooler_outputs, dim=-1) # [bs, 1536]
+
+        else:
+            # Stack all image slots into a single forward pass of size bs*num_images - the flattened images are ordered as
+            # (example 0: image 1, image 2, ..., example 1: image 1, ...), so every text is repeated num_images times
+            # and every row gets the image_token_type_idx of its image slot
             encodings = {
-                'input_ids': input_ids,
-                'attention_mask': attention_mask,
-                'token_type_ids': token_type_ids,
-                'pixel_values': pixel_values[:, i, :, :, :],
-                'pixel_mask': pixel_mask[:, i, :, :],
-                'image_token_type_idx': i + 1,
+                'input_ids': input_ids.repeat_interleave(num_images, dim=0),
+                'attention_mask': attention_mask.repeat_interleave(num_images, dim=0),
+                'token_type_ids': token_type_ids.repeat_interleave(num_images, dim=0),
+                'pixel_values': encodings['pixel_values'],
+                'pixel_mask': encodings['pixel_mask'],
+                'image_token_type_idx': torch.arange(1, num_images+1, device=input_ids.device).repeat(bs),
             }
-            pooled_out = self.vilt_encoder(**encodings)
-            pooler_outputs.append(pooled_out)
-        pooled_output = torch.cat(pooler_outputs, dim=-1) # [bs, 1536]
+            pooled_out = self.vilt_encoder(cache_rows=cache_rows, **encodings)
+            # (bs*num_images, hidden_size) -> (bs, num_images*hidden_size), same layout as concatenating the per-image outputs
+            pooled_output = pooled_out.view(bs, -1)
 
         output_logits = self.task_layer[task_key](pooled_output)
         return pooled_output, output_logits
 
-    def forward_multi_choice(self, task_key: str, images: List, texts: List[List[str]], num_choices) -> Tuple[torch.FloatTensor, torch.FloatTensor]:
+    def forward_multi_choice(self, task_key: str, images: List, texts: List[List[str]], num_choices, encodings: Dict = None,
+                             cache_rows: Tuple[str, torch.LongTensor] = None) -> Tuple[torch.FloatTensor, torch.FloatTensor]:
 
         '''
         Does forward pass of image and text inputs through model, 
         where every input has one image and multiple text choices
-        For tasks like VCR, do multiple text-image passes with each text, and select the text with highest score
+        For tasks like VCR, do a text-image pass with each text (all in a single encoder pass), and select the text with highest score
 
         Args:
         task_key - string which indicates which task to do forward pass for
         images - batch_size-sized list of num_images-sized list of PIL Image objects
         texts - list of text strings
+        encodings - ready input tensors created in the DataLoader workers from the flattened texts list (optional)
+        cache_rows - (namespace, rows) of the (example, choice) inputs in the frozen layers cache (optional)
 
         Returns:
         pooled_output: pooled feature Tensor of size (batch_size, num_images*hidden_size)
         output_logits: logits for each output class (batch_size, num_labels)
         '''
 
-        texts_list = list(itertools.chain(*texts))
-        encodings = self.vilt_encoder.process_inputs(images, texts_list)
-        bs = len(images)
-        unflat_input_ids = encodings['input_ids'].view(bs, num_choices, -1)
-        unflat_attention_mask = encodings['attention_mask'].view(bs, num_choices, -1)
-        unflat_token_type_ids = encodings['token_type_ids'].view(bs, num_choices, -1)
-        pixel_values, pixel_mask = encodings['pixel_values'], encodings['pixel_mask']
+        texts_list = list(itertools.chain(*texts)) if encodings is None else None
+        encodings = self.vilt_encoder.process_inputs(images, texts_list, encodings)
+        bs = len(encodings['pixel_values'])
 
-        pooler_outputs = []
-        for i in range(num_choices):
-            # Forward every choice through the model
-            encodings = {
-                'input_ids': unflat_input_ids[:, i, :],
-                'attention_mask': unflat_attention_mask[:, i, :],
-                'token_type_ids': unflat_token_type_ids[:, i, :],
-                'pixel_values': pixel_values,
-                'pixel_mask': pixel_mask
-            }
-            pooled_out = self.vilt_encoder(**encodings)
-            pooler_outputs.append(pooled_out)
-        #pooled_output = torch.cat(pooler_outputs, dim=-1) # [bs, 1536]
-        pooled_output = torch.stack(pooler_outputs, dim=0).transpose(0, 1)
+        # All choices are forwarded in a single pass of size bs*num_choices. The texts are flattened as
+        # (example 0: choice 1, choice 2, ..., example 1: choice 1, ...), so every image is patch-embedded once and shared by its num_choices texts
+        image_index = torch.arange(bs, device=encodings['pixel_values'].device).repeat_interleave(num_choices)
+        pooled_out = self.vilt_encoder(image_index=image_index, cache_rows=cache_rows, **encodings)
+        pooled_output = pooled_out.view(bs, num_choices, -1)
 
         output_logits = self.task_layer[task_key](pooled_output).squeeze()
         return pooled_output, output_logits
 
+    def forward_encoder_features(self, task_key: str, encoder_features: torch.FloatTensor) -> Tuple[torch.FloatTensor, torch.FloatTensor]:
+        '''
+        Does forward pass of cached encoder outputs through the task head only
+
+        Args:
+        task_key - string which indicates which task to do forward pass for
+        encoder_features - pooled encoder outputs (batch_size, num_images*hidden_size), or (batch_size, num_choices, hidden_size) for multi-choice tasks
+
+        Returns:
+        encoder_features: the encoder_features, moved to the model's device
+        output_logits: logits for each output class (batch_size, num_labels)
+        '''
+
+        encoder_features = encoder_features.to(self.vilt_encoder.device, non_blocking=True)
+        output_logits = self.task_layer[task_key](encoder_features)
+        if self.task_configs[task_key]['model_type'] == 'multi-choice':
+            output_logits = output_logits.squeeze()
+        return encoder_features, output_logits
+
     def get_encoder(self):
 
         return self.vilt_encoder
@@ -388,15 +968,20 @@ class ViltForImageClassification(nn.Module):
                             nn.Linear(encoder_dim*2, num_labels)
                         )
 
-    def forward(self, images: List, texts: List[str]) -> torch.FloatTensor:
+    def forward(self, images: List, texts: List[str], encodings: Dict = None, image_index: torch.LongTensor = None) -> torch.FloatTensor:
         '''
         Does forward pass of image and text inputs through model, where texts are dummy texts
 
         Args:
         images - batch_size-sized list of num_images-sized list of PIL Image objects
         texts - list of dummy text strings
+        encodings - ready input tensors created in the DataLoader workers (optional)
+        image_index - not used for image classification, where every image has a single dummy text
         '''
-        encodings = self.vilt_encoder.process_inputs(images, texts)
+        if encodings is None and len(set(texts)) == 1:
+            encodings = self.vilt_encoder.process_inputs_with_constant_text(images, texts[0])
+        else:
+            encodings = self.vilt_encoder.process_inputs(images, texts, encodings)
         encoder_output = self.vilt_encoder(**encodings)
 
         output_logits = self.clf_layer(encoder_output)
@@ -434,11 +1019,8 @@ class ViltForSequenceClassification(nn.Module):
         texts - list of text strings
         '''
 
-        encodings = self.encoder.process_inputs(images, texts)
-        # expand to batch size
-        bs = len(encodings['input_ids'])
-        encodings['pixel_values'] = encodings['pixel_values'].expand([bs, *encodings['pixel_values'].shape[1:]])
-        encodings['pixel_mask'] = encodings['pixel_mask'].expand([bs, *encodings['pixel_mask'].shape[1:]])
+        # the average image is shared by all texts in the batch
+        encodings = self.encoder.process_inputs_with_constant_image(images[0], texts)
         encoder_output = self.encoder(**encodings)
 
         output_logits = self.clf_layer(encoder_output)
@@ -466,11 +1048,8 @@ class ViltForMultipleChoice(nn.Module):
                         )
 
     def forward(self, images, texts):
-        encodings = self.encoder.process_inputs(images, texts)
+        encodings = self.encoder.process_inputs_with_constant_image(images[0], texts)
         # unflat_input_ids = encodings['input_ids'].view(self.num_labels, 32, -1).transpose(0, 1)
-        bs = len(encodings['input_ids'])
-        encodings['pixel_values'] = encodings['pixel_values'].expand([bs, *encodings['pixel_values'].shape[1:]])
-        encodings['pixel_mask'] = encodings['pixel_mask'].expand([bs, *encodings['pixel_mask'].shape[1:]])
         encoder_output = self.encoder(**encodings)
         reshape_output = encoder_output.view(self.num_labels, -1, self.encoder_dim).transpose(0, 1).contiguous()
 
@@ -549,8 +1128,20 @@ def convert_batch_to_vilt_input_dict(batch: Dict):
     '''
     Convert inputs from batch_collate into format consumable by the ViltProcessor
     '''
-    return {'images': batch['images'],
-            'texts': batch['raw_texts']}
+    if 'encoder_features' in batch:
+        return {'encoder_features': batch['encoder_features']}
+    # Texts that were already tokenized by the dataset are not tokenized again
+    encodings = batch.get('encodings', batch.get('text_encodings'))
+    images = batch['images']
+    if isinstance(images, dict):
+        # Raw image batches are moved to the device together with the text tensors, and normalized there
+        encodings = dict(encodings or {}, **images)
+        images = None
+    return {'images': images,
+            'texts': batch['raw_texts'],
+            'encodings': encodings,
+            'image_index': batch.get('image_index'),
+            'example_index': batch.get('example_index')}
 
 def convert_seq_batch_to_vilt_input_dict(batch: List, mean_image: Image):
     return {'images': [mean_image],
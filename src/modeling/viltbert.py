@@ -5,7 +5,7 @@ import itertools
 import pdb
 import time
 from PIL import Image
-from typing import List, Dict
+from typing import List, Dict, Tuple
 
 import numpy as np
 import torch
@@ -19,6 +19,9 @@ from transformers import BertTokenizerFast
 from transformers import logging as transformers_logging
 
 from modeling.continual_learner import EncoderWrapper, ContinualLearner
+from modeling.vilt import ViltBatchEncoder, ViltConstantModalityCache, ViltFrozenLayersCache, get_frozen_cache_rows, get_vilt_max_image_length
+from modeling.vilt import vilt_uses_adapters, embed_vilt_images, vilt_forward_from_pixels, raw_images_to_pixel_inputs
+from utils.tensor_cache import LRUTensorCache, PersistentTensorCache, state_dict_hash, tensors_digest
 
 logger = logging.getLogger(__name__)
 logging.basicConfig(
@@ -27,6 +30,91 @@ logging.basicConfig(
         level=logging.INFO)
 transformers_logging.set_verbosity_error()
 
+class BertOutputCache:
+
+    def __init__(self, max_memory_bytes: int, cache_dir: str = None):
+        '''
+        Cache of the (frozen) BERT's last_hidden_state for every tokenized text, so that BERT only runs on texts it has not seen before
+        Only the hidden states of the valid (non-padding) tokens of each text are cached. Lookups go through two tiers:
+        - an in-memory LRU tier with a byte budget (float32)
+        - an optional persistent tier of .npy files (float16), re-used across epochs, tasks and experiments.
+          Files are read into memory on a miss of the in-memory tier, and kept there in float32
+
+        Cached hidden states must not depend on random dropout masks, so BERT is run in eval mode (without dropout) on cache misses
+
+        The cache belongs to the encoder, but is not part of its weights: deep copies of the encoder (e.g. best-model snapshots) share the cache,
+        and pickled copies get an empty in-memory tier
+
+        Args:
+        max_memory_bytes: byte budget of the in-memory tier
+        cache_dir: directory of the persistent tier - should be specific to the BERT weights (optional)
+        '''
+
+        self.memory_cache = LRUTensorCache(max_memory_bytes)
+        self.disk_cache = PersistentTensorCache(cache_dir) if cache_dir is not None else None
+
+    def __deepcopy__(self, memo):
+        return self
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['memory_cache'] = LRUTensorCache(self.memory_cache.max_bytes)
+        return state
+
+    def get_input_keys(self, input_ids: torch.LongTensor, attention_mask: torch.LongTensor, token_type_ids: torch.LongTensor) -> List[str]:
+        '''
+        Returns a cache key for every row, from its valid tokens
+        '''
+
+        input_ids, token_type_ids = input_ids.cpu(), token_type_ids.cpu()
+        text_lengths = attention_mask.sum(dim=1).tolist()
+        return [tensors_digest(input_ids[i, :l], token_type_ids[i, :l]) for i, l in enumerate(text_lengths)]
+
+    def lookup(self, key: str) -> torch.Tensor:
+        hidden_states = self.memory_cache.get(key)
+        if hidden_states is None and self.disk_cache is not None:
+            hidden_states = self.disk_cache.get(key)
+            if hidden_states is not None:
+                hidden_states = hidden_states.float()
+                self.memory_cache.put(key, hidden_states)
+        return hidden_states
+
+    def get_bert_outputs(self, bert: BertModel, input_ids: torch.LongTensor, attention_mask: torch.LongTensor, token_type_ids: torch.LongTensor) -> torch.FloatTensor:
+        '''
+        Returns BERT's last_hidden_state of size (batch_size, text_length, hidden_size), with zeros at the padding tokens
+        Rows that are not in the cache are run through BERT (as a single sub-batch) and added to the cache
+        '''
+
+        if token_type_ids is None:
+            token_type_ids = torch.zeros_like(input_ids)
+        keys = self.get_input_keys(input_ids, attention_mask, token_type_ids)
+        row_hidden_states = [self.lookup(key) for key in keys]
+
+        missing_rows = [i for i, h in enumerate(row_hidden_states) if h is None]
+        if len(missing_rows) > 0:
+            row_index = torch.LongTensor(missing_rows).to(input_ids.device)
+            was_training = bert.training
+            bert.eval()
+            with torch.no_grad():
+                output = bert(input_ids=input_ids[row_index], 
+                              attention_mask=attention_mask[row_index],
+                              token_type_ids=token_type_ids[row_index])
+            bert.train(was_training)
+            last_hidden_state = output.last_hidden_state.float().cpu()
+            text_lengths = attention_mask[row_index].sum(dim=1).tolist()
+            for r, (i, l) in enumerate(zip(missing_rows, text_lengths)):
+                row_hidden_states[i] = last_hidden_state[r, :l].clone()
+                self.memory_cache.put(keys[i], row_hidden_states[i])
+                if self.disk_cache is not None:
+                    self.disk_cache.put(keys[i], row_hidden_states[i])
+
+        hidden_size = row_hidden_states[0].shape[-1]
+        hidden_states = torch.zeros(len(keys), input_ids.shape[1], hidden_size)
+        for i, h in enumerate(row_hidden_states):
+            hidden_states[i, :len(h)] = h
+        dtype = bert.embeddings.word_embeddings.weight.dtype
+        return hidden_states.to(input_ids.device, non_blocking=True).to(dtype)
+
 
 class ViltBertEncoderWrapper(EncoderWrapper):
 
@@ -52,6 +140,10 @@ class ViltBertEncoderWrapper(EncoderWrapper):
         self.bert = bert
         self.max_text_length = self.vilt.config.max_position_embeddings
         self.encoder_dim = self.vilt.config.hidden_size
+        self.num_frozen_layers = 0
+        self.frozen_layers_cache = None
+        self.bert_output_cache = None
+        self.constant_modality_cache = ViltConstantModalityCache()
 
     def reset_processor(self, max_text_length: int, img_size: tuple):
         self.max_text_length = max_text_length
@@ -84,21 +176,62 @@ class ViltBertEncoderWrapper(EncoderWrapper):
         self.vilt.embeddings.text_embeddings.\
             register_buffer("position_ids", torch.arange(max_len).expand((1, -1)))
 
-    def process_inputs(self, images: List, texts: List[str]) -> Dict:
+    def process_inputs(self, images: List, texts: List[str], encodings: Dict = None) -> Dict:
         '''
         Returns encodings that can be inputted to the ViLT transformer
 
         Args:
         images - list of PIL Image objects
         texts - list of text strings
+        encodings - tensors already created by a ViltBatchEncoder in the DataLoader workers (optional).
+                    If given, images and texts are not processed again, and the tensors are only moved to the device.
+                    If encodings only contain text tensors (pre-tokenized texts from the dataset), only the images are processed,
+                    and if they only contain a raw image batch, only the texts are tokenized.
+                    Raw image batches (uint8 pixel_values with image_sizes) are normalized on the device, see raw_images_to_pixel_inputs
 
         Returns:
         encodings - dictionary, where each key corresponds to a different argument of the vilt's forward method
         '''
-        encodings = self.processor(images=images, text=texts, max_length=self.max_text_length,
-            padding=True, truncation=True, return_tensors='pt').to(self.device)
+        if encodings is None:
+            encodings = self.processor(images=images, text=texts, max_length=self.max_text_length,
+                padding=True, truncation=True, return_tensors='pt')
+        else:
+            encodings = dict(encodings)
+            if 'input_ids' not in encodings:
+                encodings.update(self.processor.tokenizer(texts, max_length=self.max_text_length,
+                    padding=True, truncation=True, return_tensors='pt'))
+            if 'pixel_values' not in encodings:
+                encodings.update(self.processor.feature_extractor(images, return_tensors='pt'))
+        encodings = {k: v.to(self.device, non_blocking=True) for k, v in encodings.items()}
+        if 'image_sizes' in encodings:
+            encodings.update(raw_images_to_pixel_inputs(encodings.pop('pixel_values'), encodings.pop('image_sizes')))
+        return encodings
+
+    def process_inputs_with_constant_image(self, image: Image, texts: List[str]) -> Dict:
+        '''
+        Returns encodings for texts that are all paired with the same constant image (e.g. the mean image for language-only tasks)
+        The image is processed and patch-embedded once (see ViltConstantModalityCache), and shared by all texts through image_index
+        '''
+
+        encodings = self.processor.tokenizer(texts, max_length=self.max_text_length,
+            padding=True, truncation=True, return_tensors='pt')
+        encodings = {k: v.to(self.device, non_blocking=True) for k, v in encodings.items()}
+        process_image_fn = lambda: {k: v.to(self.device) for k, v in self.processor.feature_extractor([image], return_tensors='pt').items()}
+        image_encodings = self.constant_modality_cache.get_processed_inputs('image', image,
+            (str(self.processor.feature_extractor.size), str(self.device)), process_image_fn)
+        encodings.update(image_encodings)
+        encodings['image_index'] = torch.zeros(len(encodings['input_ids']), dtype=torch.long, device=self.device)
+        if not vilt_uses_adapters(self.vilt):
+            embed_image_fn = lambda: embed_vilt_images(self.vilt, image_encodings['pixel_values'], image_encodings['pixel_mask'])
+            encodings['image_embeds'] = self.constant_modality_cache.get_embeddings('image', self.vilt.embeddings, embed_image_fn)
         return encodings
 
+    def get_batch_encoder(self) -> ViltBatchEncoder:
+        '''
+        Returns a ViltBatchEncoder that matches the current processor settings, for preprocessing inside DataLoader workers
+        '''
+        return ViltBatchEncoder(self.processor, self.max_text_length)
+
     def expand_modality_type_embeddings(self, type_vocab_size=3):
         '''
         ViLT contains only 2 token type embeddings - some tasks (like NLVR) require three token type embeddings
@@ -112,7 +245,27 @@ class ViltBertEncoderWrapper(EncoderWrapper):
         self.vilt.embeddings.token_type_embeddings.weight.data[1, :] = emb_data[1, :]
         self.vilt.embeddings.token_type_embeddings.weight.data[2, :] = emb_data[1, :]
 
+    def enable_bert_output_cache(self, max_memory_mb: int, cache_dir: str = None):
+        '''
+        Caches BERT outputs by tokenized text (see BertOutputCache), so that forward passes skip BERT for texts that have been seen before
+
+        Args:
+        max_memory_mb: memory budget of the in-memory LRU tier, in MB
+        cache_dir: if given, outputs are also stored on disk, in a sub-directory specific to the BERT weights
+        '''
+
+        if cache_dir is not None:
+            bert_hash = state_dict_hash(self.bert.state_dict().items())
+            cache_dir = os.path.join(cache_dir, 'bert_{}'.format(bert_hash))
+            logger.info("Caching BERT outputs in {}".format(cache_dir))
+        self.bert_output_cache = BertOutputCache(max_memory_mb*1024*1024, cache_dir)
+
     def get_bert_outputs(self, **encodings: Dict):
+        if self.bert_output_cache is not None:
+            return self.bert_output_cache.get_bert_outputs(self.bert, 
+                                                           encodings['input_ids'], 
+                                                           encodings['attention_mask'], 
+                                                           encodings.get('token_type_ids'))
         with torch.no_grad():
             output = self.bert(input_ids=encodings['input_ids'], 
                                 attention_mask=encodings['attention_mask'],
@@ -132,13 +285,20 @@ class ViltBertEncoderWrapper(EncoderWrapper):
         return optimizer
 
 
-    def forward(self, **encodings: Dict) -> torch.FloatTensor:
+    def forward(self, 
+                image_index: torch.LongTensor = None, 
+                image_embeds: Tuple[torch.FloatTensor, torch.LongTensor] = None, 
+                cache_rows: Tuple[str, torch.LongTensor] = None, 
+                **encodings: Dict) -> torch.FloatTensor:
         '''
         Does forward pass of input encodings through ViltModel
         https://huggingface.co/docs/transformers/model_doc/vilt#transformers.ViltModel.forward
 
         Args:
-        encodings: Dictionary containing inputs ViltModel's forward pass
+        image_index: if given, pixel_values contains every unique image once, and image_index[i] is the image of the i-th text
+        image_embeds: cached embedding layer outputs of a constant image (see process_inputs_with_constant_image)
+        cache_rows: (namespace, rows) of the inputs in the frozen layers cache, if it is enabled (see enable_frozen_layers_cache)
+        encodings: Dictionary containing inputs ViltModel's forward pass (image_token_type_idx can also be a LongTensor with one value per row)
 
         Returns:
         pooler_output: torch.FloatTensor of size (batch_size, hidden_size)
@@ -147,6 +307,13 @@ class ViltBertEncoderWrapper(EncoderWrapper):
         encodings['inputs_embeds'] = self.get_bert_outputs(**encodings)
         encodings['input_ids'] = None
 
+        if image_index is not None or torch.is_tensor(encodings.get('image_token_type_idx')) or self.num_frozen_layers > 0:
+            return vilt_forward_from_pixels(self.vilt, image_index, 
+                                            num_frozen_layers=self.num_frozen_layers,
+                                            frozen_layers_cache=self.frozen_layers_cache,
+                                            cache_rows=cache_rows,
+                                            image_embeds=image_embeds,
+                                            **encodings)
         output = self.vilt(**encodings)
         return output.pooler_output
 
@@ -158,6 +325,7 @@ class ViltBertEncoderWrapper(EncoderWrapper):
     def freeze_bottom_k_layers(self, k: int):
         '''
         Freeze embedding parameters and bottom K transformer layer parameters
+        The frozen layers are then run without gradients in the forward pass
         '''
 
         assert k < len(self.vilt.encoder.layer)
@@ -166,6 +334,23 @@ class ViltBertEncoderWrapper(EncoderWrapper):
         for i in range(k):
             for p in self.vilt.encoder.layer[i].parameters():
                 p.requires_grad = False
+        self.num_frozen_layers = k
+
+    def enable_frozen_layers_cache(self, cache_dir: str):
+        '''
+        Caches the hidden states after the frozen bottom K layers on disk (see ViltFrozenLayersCache), in a sub-directory specific to the frozen weights
+        Must be called after freeze_bottom_k_layers
+        '''
+
+        assert self.num_frozen_layers > 0
+        frozen_modules = [('embeddings', self.vilt.embeddings)] + [('layer.{}'.format(i), self.vilt.encoder.layer[i]) for i in range(self.num_frozen_layers)]
+        frozen_weights_hash = state_dict_hash([('{}.{}'.format(prefix, n), p) for prefix, m in frozen_modules for n, p in m.state_dict().items()])
+        frozen_layers_cache_dir = os.path.join(cache_dir, '{}_{}layers'.format(frozen_weights_hash, self.num_frozen_layers))
+        self.frozen_layers_cache = ViltFrozenLayersCache(frozen_layers_cache_dir,
+                                                         max_text_length=self.max_text_length,
+                                                         max_image_length=get_vilt_max_image_length(self.vilt, self.processor.feature_extractor.size),
+                                                         hidden_size=self.vilt.config.hidden_size)
+        logger.info("Caching hidden states of {} frozen ViLT layers in {}".format(self.num_frozen_layers, frozen_layers_cache_dir))
 
 
 class ViltBertContinualLearner(ContinualLearner):
@@ -226,7 +411,8 @@ class ViltBertContinualLearner(ContinualLearner):
                         )
             self.task_layer_dict[task_key] = clf_layer
 
-    def forward(self, task_key: str, images: List, texts: List[str]):
+    def forward(self, task_key: str, images: List = None, texts: List[str] = None, encodings: Dict = None, image_index: torch.LongTensor = None,
+                encoder_features: torch.FloatTensor = None, example_index: Tuple[str, torch.LongTensor] = None):
         '''
         Does forward pass of image and text inputs through model, 
         depending on if the task is multichoice or classification with one or more images
@@ -235,21 +421,31 @@ class ViltBertContinualLearner(ContinualLearner):
         task_key - string which indicates which task to do forward pass for
         images - list of PIL Image objects
         texts - list of text strings
+        encodings - ready input tensors created by the collate function in the DataLoader workers (optional, replaces images and texts)
+        image_index - if given, images contains every unique image of the batch once, and image_index maps each text to its image (single-image tasks only)
+        encoder_features - pooled outputs of a frozen encoder, cached by FrozenEncoderFeatureCache (optional, replaces all other inputs)
+        example_index - (namespace, dataset indices) of the batch's examples, used to look up the frozen layers' cached hidden states (see ViltFrozenLayersCache) (optional)
 
         Returns:
         https://huggingface.co/docs/transformers/v4.21.1/en/main_classes/output#transformers.modeling_outputs.BaseModelOutputWithPooling
         '''
 
         task_config = self.task_configs[task_key]
+        if encoder_features is not None:
+            return self.forward_encoder_features(task_key, encoder_features)
         if task_config['model_type'] == 'multi-choice':
-            return self.forward_multi_choice(task_key, images, texts, task_config['num_choices'])
+            return self.forward_multi_choice(task_key, images, texts, task_config['num_choices'], encodings=encodings,
+                                             cache_rows=get_frozen_cache_rows(example_index, task_config['num_choices']))
         elif task_config['model_type'] == 'classification':
             if task_config['num_images'] == 1:
-                return self.forward_single_image(task_key, images, texts)
+                return self.forward_single_image(task_key, images, texts, encodings=encodings, image_index=image_index,
+                                                 cache_rows=get_frozen_cache_rows(example_index, 1))
             else:
-                return self.forward_multi_images(task_key, images, texts, task_config['num_images'])
+                return self.forward_multi_images(task_key, images, texts, task_config['num_images'], encodings=encodings,
+                                                 cache_rows=get_frozen_cache_rows(example_index, task_config['num_images']))
 
-    def forward_single_image(self, task_key: str, images: List, texts: List[str]) -> (torch.FloatTensor, torch.FloatTensor):
+    def forward_single_image(self, task_key: str, images: List, texts: List[str], encodings: Dict = None, image_index: torch.LongTensor = None,
+                             cache_rows: Tuple[str, torch.LongTensor] = None) -> (torch.FloatTensor, torch.FloatTensor):
         '''
         Does forward pass of image and text inputs through model, 
         where every input has one image and one text
@@ -258,107 +454,145 @@ class ViltBertContinualLearner(ContinualLearner):
         task_key - string which indicates which task to do forward pass for
         images - list of PIL Image objects
         texts - list of text strings
+        encodings - ready input tensors created in the DataLoader workers (optional)
+        image_index - if given, images contains every unique image once and image_index[i] is the image of texts[i],
+                      so that each unique image is preprocessed and patch-embedded only once
+        cache_rows - (namespace, rows) of the inputs in the frozen layers cache (optional)
 
         Returns:
         encoder_output: https://huggingface.co/docs/transformers/v4.21.1/en/main_classes/output#transformers.modeling_outputs.BaseModelOutputWithPooling
         output_logits: logits for each output class (batch_size, num_labels)
         '''
 
-        encodings = self.viltbert_encoder.process_inputs(images, texts)
+        encodings = self.viltbert_encoder.process_inputs(images, texts, encodings)
+        if image_index is not None:
+            encodings['image_index'] = image_index.to(self.viltbert_encoder.device, non_blocking=True)
 
-        encoder_output = self.viltbert_encoder(**encodings)
+        encoder_output = self.viltbert_encoder(cache_rows=cache_rows, **encodings)
 
         output_logits = self.task_layer[task_key](encoder_output)
         return encoder_output, output_logits
 
-    def forward_multi_images(self, task_key: str, images: List[List], texts: List[str], num_images=2) -> (torch.FloatTensor, torch.FloatTensor):
+    def forward_multi_images(self, task_key: str, images: List[List], texts: List[str], num_images=2, encodings: Dict = None,
+                             cache_rows: Tuple[str, torch.LongTensor] = None) -> (torch.FloatTensor, torch.FloatTensor):
 
         '''
         Does forward pass of image and text inputs through model, 
         where every input has multiple images and one text
-        For tasks like NLVR2, do multiple text-image passes with each image and aggregate results
+        For tasks like NLVR2, do a text-image pass with each image (stacked into a single encoder pass) and aggregate results
 
         Args:
         task_key - string which indicates which task to do forward pass for
         images - batch_size-sized list of num_images-sized list of PIL Image objects
         texts - list of text strings
+        encodings - ready input tensors created in the DataLoader workers from the flattened images list (optional)
+        cache_rows - (namespace, rows) of the stacked (example, image slot) inputs in the frozen layers cache (optional, not used with adapters)
 
         Returns:
         pooled_output: pooled feature Tensor of size (batch_size, num_images*hidden_size)
         output_logits: logits for each output class (batch_size, num_labels)
         '''
 
-        flat_images_list = list(itertools.chain(*images))
-        encodings = self.viltbert_encoder.process_inputs(flat_images_list, texts)
+        flat_images_list = list(itertools.chain(*images)) if encodings is None else None
+        encodings = self.viltbert_encoder.process_inputs(flat_images_list, texts, encodings)
 
         input_ids, attention_mask, token_type_ids = \
             encodings['input_ids'], encodings['attention_mask'], encodings['token_type_ids']
-        # reshape
         bs = len(input_ids)
-        pixel_values = encodings['pixel_values'].view(bs, num_images, *encodings["pixel_values"].shape[-3:])
-        pixel_mask = encodings['pixel_mask'].view(bs, num_images, *encodings["pixel_mask"].shape[-2:])
 
-        # https://github.com/huggingface/transformers/blob/v4.16.2/src/transformers/models/vilt/modeling_vilt.py#L1351
-        pooler_outputs = []
-        for i in range(num_images):
-            # forward every image through the model
+        if vilt_uses_adapters(self.viltbert_encoder.vilt):
+            # Adapters need ViltModel's own forward pass, which takes a single image_token_type_idx - forward every image slot separately
+            # reshape
+            pixel_values = encodings['pixel_values'].view(bs, num_images, *encodings["pixel_values"].shape[-3:])
+            pixel_mask = encodings['pixel_mask'].view(bs, num_images, *encodings["pixel_mask"].shape[-2:])
+
+            # https://github.com/huggingface/transformers/blob/v4.16.2/src/transformers/models/vilt/modeling_vilt.py#L1351
+            pooler_outputs = []
+            for i in range(num_images):
+                # forward every image through the model
+                encodings = {
+                    'input_ids': input_ids,
+                    'attention_mask': attention_mask,
+                    'token_type_ids': token_type_ids,
+                    'pixel_values': pixel_values[:, i, :, :, :],
+                    'pixel_mask': pixel_mask[:, i, :, :],
+                    'image_token_type_idx': i + 1,
+                }
+                pooled_out = self.viltbert_encoder(**encodings)
+                pooler_outputs.append(pooled_out)
+            pooled_output = torch.cat(pooler_outputs, dim=-1) # [bs, 1536]
+
+        else:
+            # Stack all image slots into a single forward pass of size bs*num_images - the flattened images are ordered as
+            # (example 0: image 1, image 2, ..., example 1: image 1, ...), so every text is repeated num_images times
+            # and every row gets the image_token_type_idx of its image slot
             encodings = {
-                'input_ids': input_ids,
-                'attention_mask': attention_mask,
-                'token_type_ids': token_type_ids,
-                'pixel_values': pixel_values[:, i, :, :, :],
-                'pixel_mask': pixel_mask[:, i, :, :],
-                'image_token_type_idx': i + 1,
+                'input_ids': input_ids.repeat_interleave(num_images, dim=0),
+                'attention_mask': attention_mask.repeat_interleave(num_images, dim=0),
+                'token_type_ids': token_type_ids.repeat_interleave(num_images, dim=0),
+                'pixel_values': encodings['pixel_values'],
+                'pixel_mask': encodings['pixel_mask'],
+                'image_token_type_idx': torch.arange(1, num_images+1, device=input_ids.device).repeat(bs),
             }
-            pooled_out = self.viltbert_encoder(**encodings)
-            pooler_outputs.append(pooled_out)
-        pooled_output = torch.cat(pooler_outputs, dim=-1) # [bs, 1536]
+            pooled_out = self.viltbert_encoder(cache_rows=cache_rows, **encodings)
+            # (bs*num_images, hidden_size) -> (bs, num_images*hidden_size), same layout as concatenating the per-image outputs
+            pooled_output = pooled_out.view(bs, -1)
 
         output_logits = self.task_layer[task_key](pooled_output)
         return pooled_output, output_logits
 
-    def forward_multi_choice(self, task_key: str, images: List, texts: List[List[str]], num_choices) -> (torch.FloatTensor, torch.FloatTensor):
+    def forward_multi_choice(self, task_key: str, images: List, texts: List[List[str]], num_choices, encodings: Dict = None,
+                             cache_rows: Tuple[str, torch.LongTensor] = None) -> (torch.FloatTensor, torch.FloatTensor):
 
         '''
         Does forward pass of image and text inputs through model, 
         where every input has one image and multiple text choices
-        For tasks like VCR, do multiple text-image passes with each text, and select the text with highest score
+        For tasks like VCR, do a text-image pass with each text (all in a single encoder pass), and select the text with highest score
 
         Args:
         task_key - string which indicates which task to do forward pass for
         images - batch_size-sized list of num_images-sized list of PIL Image objects
         texts - list of text strings
+        encodings - ready input tensors created in the DataLoader workers from the flattened texts list (optional)
+        cache_rows - (namespace, rows) of the (example, choice) inputs in the frozen layers cache (optional)
 
         Returns:
         pooled_output: pooled feature Tensor of size (batch_size, num_images*hidden_size)
         output_logits: logits for each output class (batch_size, num_labels)
         '''
 
-        texts_list = list(itertools.chain(*texts))
-        encodings = self.viltbert_encoder.process_inputs(images, texts_list)
-        bs = len(images)
-        unflat_input_ids = encodings['input_ids'].view(bs, num_choices, -1)
-        unflat_attention_mask = encodings['attention_mask'].view(bs, num_choices, -1)
-        unflat_token_type_ids = encodings['token_type_ids'].view(bs, num_choices, -1)
-        pixel_values, pixel_mask = encodings['pixel_values'], encodings['pixel_mask']
+        texts_list = list(itertools.chain(*texts)) if encodings is None else None
+        encodings = self.viltbert_encoder.process_inputs(images, texts_list, encodings)
+        bs = len(encodings['pixel_values'])
 
-        pooler_outputs = []
-        for i in range(num_choices):
-            # Forward every choice through the model
-            encodings = {
-                'input_ids': unflat_input_ids[:, i, :],
-                'attention_mask': unflat_attention_mask[:, i, :],
-                'token_type_ids': unflat_token_type_ids[:, i, :],
-                'pixel_values': pixel_values,
-                'pixel_mask': pixel_mask
-            }
-            pooled_out = self.viltbert_encoder(**encodings)
-            pooler_outputs.append(pooled_out)
-        pooled_output = torch.stack(pooler_outputs, dim=0).transpose(0, 1)
+        # All choices are forwarded in a single pass of size bs*num_choices. The texts are flattened as
+        # (example 0: choice 1, choice 2, ..., example 1: choice 1, ...), so every image is patch-embedded once and shared by its num_choices texts
+        image_index = torch.arange(bs, device=encodings['pixel_values'].device).repeat_interleave(num_choices)
+        pooled_out = self.viltbert_encoder(image_index=image_index, cache_rows=cache_rows, **encodings)
+        pooled_output = pooled_out.view(bs, num_choices, -1)
 
         output_logits = self.task_layer[task_key](pooled_output).squeeze()
         return pooled_output, output_logits
 
+    def forward_encoder_features(self, task_key: str, encoder_features: torch.FloatTensor) -> Tuple[torch.FloatTensor, torch.FloatTensor]:
+        '''
+        Does forward pass of cached encoder outputs through the task head only
+
+        Args:
+        task_key - string which indicates which task to do forward pass for
+        encoder_features - pooled encoder outputs (batch_size, num_images*hidden_size), or (batch_size, num_choices, hidden_size) for multi-choice tasks
+
+        Returns:
+        encoder_features: the encoder_features, moved to the model's device
+        output_logits: logits for each output class (batch_size, num_labels)
+        '''
+
+        encoder_features = encoder_features.to(self.viltbert_encoder.device, non_blocking=True)
+        output_logits = self.task_layer[task_key](encoder_features)
+        if self.task_configs[task_key]['model_type'] == 'multi-choice':
+            output_logits = output_logits.squeeze()
+        return encoder_features, output_logits
+
     def get_encoder(self):
 
         return self.viltbert_encoder
@@ -409,11 +643,8 @@ class ViltBertForSequenceClassification(nn.Module):
         texts - list of text strings
         '''
 
-        encodings = self.encoder.process_inputs(images, texts)
-        # expand to batch size
-        bs = len(encodings['input_ids'])
-        encodings['pixel_values'] = encodings['pixel_values'].expand([bs, *encodings['pixel_values'].shape[1:]])
-        encodings['pixel_mask'] = encodings['pixel_mask'].expand([bs, *encodings['pixel_mask'].shape[1:]])
+        # the average image is shared by all texts in the batch
+        encodings = self.encoder.process_inputs_with_constant_image(images[0], texts)
 
         encoder_output = self.encoder(**encodings)
 
@@ -443,11 +674,8 @@ class ViltBertForMultipleChoice(nn.Module):
 
 
     def forward(self, images, texts):
-        encodings = self.encoder.process_inputs(images, texts)
+        encodings = self.encoder.process_inputs_with_constant_image(images[0], texts)
         # unflat_input_ids = encodings['input_ids'].view(self.num_labels, 32, -1).transpose(0, 1)
-        bs = len(texts)
-        encodings['pixel_values'] = encodings['pixel_values'].expand([bs, *encodings['pixel_values'].shape[1:]])
-        encodings['pixel_mask'] = encodings['pixel_mask'].expand([bs, *encodings['pixel_mask'].shape[1:]])
 
         encoder_output = self.encoder(**encodings)
         reshape_output = encoder_output.view(self.num_labels, -1, self.encoder_dim).transpose(0, 1).contiguous()
@@ -529,8 +757,20 @@ def convert_batch_to_viltbert_input_dict(batch: Dict):
     Convert inputs from batch_collate into format consumable by the ViltProcessor
     '''
 
-    return {'images': batch['images'],
-            'texts': batch['raw_texts']}
+    if 'encoder_features' in batch:
+        return {'encoder_features': batch['encoder_features']}
+    # Texts that were already tokenized by the dataset are not tokenized again
+    encodings = batch.get('encodings', batch.get('text_encodings'))
+    images = batch['images']
+    if isinstance(images, dict):
+        # Raw image batches are moved to the device together with the text tensors, and normalized there
+        encodings = dict(encodings or {}, **images)
+        images = None
+    return {'images': images,
+            'texts': batch['raw_texts'],
+            'encodings': encodings,
+            'image_index': batch.get('image_index'),
+            'example_index': batch.get('example_index')}
 
 def convert_seq_batch_to_model_input_dict(batch: List, mean_image: Image):
 
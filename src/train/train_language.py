@@ -28,6 +28,7 @@ from modeling import load_encoder_map
 from configs.model_configs import model_configs
 from configs.task_configs import task_configs
 from utils.seed_utils import set_seed
+from utils.metrics import AccuracyAccumulator
 
 os.environ["TOKENIZERS_PARALLELISM"] = "false"
 
@@ -94,7 +95,8 @@ def train_language(args, encoder, task_config, model_config, tokenizer, device):
         num_workers = args.num_workers,
         data_dir = data_dir,
         n_shot = n_shot,
-        seed = subsample_seed
+        seed = subsample_seed,
+        length_bucket_size = args.length_bucket_size
     )
 
     val_dataloader = get_data_loader(tokenizer, 
@@ -210,17 +212,16 @@ def eval(args, model, mean_image, eval_dataloader, device, batch2inputs_converte
     '''
 
     model.eval()
-    eval_score = 0
+    accuracy = AccuracyAccumulator(device)
     for step, batch in enumerate(tqdm(eval_dataloader, desc='Evaluating...')):
         labels = batch[-1]
         inputs = batch2inputs_converter(batch, mean_image)
         with torch.no_grad():
             logits = model(**inputs)
 
-        batch_scores = (logits.argmax(-1).cpu() == labels)
-        eval_score += batch_scores.sum().item()
+        accuracy.update(logits, labels)
 
-    eval_score = eval_score/len(eval_dataloader.dataset)*100.0
+    eval_score = accuracy.compute()
     logger.info(f'Eval_acc: {eval_score:.3f}')
 
     model.train()
@@ -251,6 +252,12 @@ def main():
                         help="Batch size.")
     parser.add_argument("--num_workers", type=int, default=2,
                         help="Number of workers for dataloader")
+    parser.add_argument("--length_bucket_size", type=int, default=0,
+                        help="If > 0, training batches contain examples of similar text lengths, drawn from buckets of this many batches, to reduce text padding.")
+    parser.add_argument("--bert_cache_memory_mb", type=int, default=0,
+                        help="If > 0, outputs of the frozen BERT in viltbert encoders are cached by tokenized text, in an in-memory LRU cache of this size (in MB).")
+    parser.add_argument("--bert_cache_dir", type=str, default=None,
+                        help="If given, outputs of the frozen BERT in viltbert encoders are also cached on disk in this directory.")
     parser.add_argument("--seed", type=int, default=42,
                         help="Random seed.")
 
@@ -277,6 +284,9 @@ def main():
     model_config = model_configs[args.model_catog]
     load_encoder_method = load_encoder_map[args.encoder_name]
     encoder = load_encoder_method(args.checkpoint_name, device, args.pretrained_model_name)
+    if args.bert_cache_memory_mb > 0 or args.bert_cache_dir is not None:
+        assert args.encoder_name == 'viltbert'
+        encoder.enable_bert_output_cache(args.bert_cache_memory_mb, args.bert_cache_dir)
 
     results = []
     logger.info("-"*100)
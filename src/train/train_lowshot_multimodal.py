@@ -46,7 +46,7 @@ def train_low_shot(args, low_shot_model, low_shot_task_key, model_config, device
                                                                              low_shot_task_name, 
                                                                              low_shot_config))
     task_trainer_class = low_shot_config['task_trainer']
-    task_trainer = task_trainer_class(args, task_configs, model_config, device, low_shot_config=low_shot_config)
+    task_trainer = task_trainer_class(args, task_configs, model_config, device, low_shot_model.get_encoder(), low_shot_config=low_shot_config)
     best_eval_score, best_model = task_trainer.train(low_shot_model)
 
     return best_eval_score, low_shot_config
@@ -80,6 +80,10 @@ def main():
                         help="Strategy for sampling memory buffer samples.")
     parser.add_argument("--replay_frequency", type=int,
                         help="Number of training steps after which to do a memory replay step.")
+    parser.add_argument("--replay_num_workers", type=int, default=1,
+                        help="Number of DataLoader workers per memory buffer that load replay batches in the background.")
+    parser.add_argument("--replay_prefetch_batches", type=int, default=2,
+                        help="Number of replay batches that are kept ready per memory buffer.")
 
     # Arguments specific to Adapters algorithm
     parser.add_argument("--adapter_config", choices=list(ADAPTER_MAP.keys()),
@@ -104,6 +108,22 @@ def main():
                         help="Batch size.")
     parser.add_argument("--num_workers", type=int, default=2,
                         help="Number of workers for dataloader")
+    parser.add_argument("--use_image_shards", action='store_true',
+                        help="Read pre-decoded MS-COCO/Flickr30K images from image shards (see data.image_datasets.image_shards).")
+    parser.add_argument("--worker_preprocessing", action='store_true',
+                        help="Tokenize and preprocess images inside the DataLoader workers, instead of in the training loop.")
+    parser.add_argument("--raw_image_inputs", action='store_true',
+                        help="For VQA/SNLI-VE, DataLoader workers send re-sized uint8 image tensors, which are normalized on the device once per batch.")
+    parser.add_argument("--image_group_size", type=int, default=0,
+                        help="If > 0, VQA/SNLI-VE training batches group up to this many examples of the same image, and each image is embedded once per batch.")
+    parser.add_argument("--length_bucket_size", type=int, default=0,
+                        help="If > 0, training batches of VQA/SNLI-VE (without --image_group_size), NLVR2 and VCR contain examples of similar text lengths, drawn from buckets of this many batches, to reduce text padding.")
+    parser.add_argument("--aspect_ratio_buckets", action='store_true',
+                        help="Batch VQA/SNLI-VE (without --image_group_size or --length_bucket_size) and VCR training examples whose images have the same model input shape, to reduce padded image patches.")
+    parser.add_argument("--bert_cache_memory_mb", type=int, default=0,
+                        help="If > 0, outputs of the frozen BERT in viltbert encoders are cached by tokenized text, in an in-memory LRU cache of this size (in MB).")
+    parser.add_argument("--bert_cache_dir", type=str, default=None,
+                        help="If given, outputs of the frozen BERT in viltbert encoders are also cached on disk in this directory.")
     parser.add_argument("--seed", type=int, default=42,
                         help="Random seed.")
 
@@ -138,6 +158,9 @@ def main():
                                 task_configs=task_configs,
                                 device=device)
     args.visual_input_type = model_config['visual_input_type']
+    if args.bert_cache_memory_mb > 0 or args.bert_cache_dir is not None:
+        assert args.encoder_name == 'viltbert'
+        model.get_encoder().enable_bert_output_cache(args.bert_cache_memory_mb, args.bert_cache_dir)
 
     # ------------------------------------------ Print some model info ------------------------------------------
     logger.info("Succesfully initialized {}-based Continual Learner".format(model_config['encoder_name']))
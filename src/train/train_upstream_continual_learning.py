@@ -23,7 +23,7 @@ from transformers.adapters import AdapterConfig
 
 from modeling import load_encoder_map, create_continual_learner_map
 
-from cl_algorithms import ExperienceReplayMemory, EWC, AdapterHandler
+from cl_algorithms import ExperienceReplayMemory, EWC, AdapterHandler, FrozenEncoderFeatureCache
 from cl_algorithms.adapters import ADAPTER_MAP, SUPPORTED_ADAPTER_METHODS
 from cl_evaluation.evaluate_cl_algorithm import upstream_knowledge_transfer_eval, catastrophic_forgetting_eval
 
@@ -72,6 +72,10 @@ def main():
                         help="Strategy for sampling memory buffer samples.")
     parser.add_argument("--replay_frequency", type=int,
                         help="Number of training steps after which to do a memory replay step.")
+    parser.add_argument("--replay_num_workers", type=int, default=1,
+                        help="Number of DataLoader workers per memory buffer that load replay batches in the background.")
+    parser.add_argument("--replay_prefetch_batches", type=int, default=2,
+                        help="Number of replay batches that are kept ready per memory buffer.")
 
     # Arguments specific to Adapters algorithm
     parser.add_argument("--adapter_method", choices=SUPPORTED_ADAPTER_METHODS,
@@ -87,9 +91,16 @@ def main():
     parser.add_argument("--ewc_loss_weight", type=float, default=0.0,
                         help="Factoring for scaling the EWC loss")
 
+    # Arguments specific to frozen encoder algorithm
+    parser.add_argument("--frozen_features_cache_dir", type=str, default=None,
+                        help="If given, frozen encoder outputs are computed once per task split and cached in this directory, and only the task heads are trained on them")
+
     # Arguments specific to frozen bottom-k layers algorithm
     parser.add_argument("--layers_to_freeze", type=int, default=0,
                         help="Number of layers to freeze (if freezing bottom-k layers)")
+    parser.add_argument("--frozen_layers_cache_dir", type=str, default=None,
+                        help="If given, hidden states after the frozen bottom-k layers are cached on disk in this directory (one row per example input in memory-mapped shards), "
+                             "and re-used across epochs and experiments. With the cache, the frozen layers always run without dropout, also when computing uncached inputs.")
 
     parser.add_argument("--output_dir", type=str, required=True,
                         help="Name of output directory, where all experiment results and checkpoints are saved.")
@@ -100,6 +111,22 @@ def main():
                         help="Batch size.")
     parser.add_argument("--num_workers", type=int, default=2,
                         help="Number of workers for dataloader")
+    parser.add_argument("--use_image_shards", action='store_true',
+                        help="Read pre-decoded MS-COCO/Flickr30K images from image shards (see data.image_datasets.image_shards).")
+    parser.add_argument("--worker_preprocessing", action='store_true',
+                        help="Tokenize and preprocess images inside the DataLoader workers, instead of in the training loop.")
+    parser.add_argument("--raw_image_inputs", action='store_true',
+                        help="For VQA/SNLI-VE, DataLoader workers send re-sized uint8 image tensors, which are normalized on the device once per batch.")
+    parser.add_argument("--image_group_size", type=int, default=0,
+                        help="If > 0, VQA/SNLI-VE training batches group up to this many examples of the same image, and each image is embedded once per batch.")
+    parser.add_argument("--length_bucket_size", type=int, default=0,
+                        help="If > 0, training batches of VQA/SNLI-VE (without --image_group_size), NLVR2 and VCR contain examples of similar text lengths, drawn from buckets of this many batches, to reduce text padding.")
+    parser.add_argument("--aspect_ratio_buckets", action='store_true',
+                        help="Batch VQA/SNLI-VE (without --image_group_size or --length_bucket_size) and VCR training examples whose images have the same model input shape, to reduce padded image patches.")
+    parser.add_argument("--bert_cache_memory_mb", type=int, default=0,
+                        help="If > 0, outputs of the frozen BERT in viltbert encoders are cached by tokenized text, in an in-memory LRU cache of this size (in MB).")
+    parser.add_argument("--bert_cache_dir", type=str, default=None,
+                        help="If given, outputs of the frozen BERT in viltbert encoders are also cached on disk in this directory.")
     parser.add_argument("--seed", type=int, default=42,
                         help="Random seed.")
 
@@ -151,6 +178,9 @@ def main():
                                 task_configs=task_configs,
                                 device=device)
     args.visual_input_type = model_config['visual_input_type']
+    if args.bert_cache_memory_mb > 0 or args.bert_cache_dir is not None:
+        assert args.encoder_name == 'viltbert'
+        model.get_encoder().enable_bert_output_cache(args.bert_cache_memory_mb, args.bert_cache_dir)
 
 
     # --------------------- CL algorithm-specific initializations  ------------------------------------------
@@ -159,6 +189,8 @@ def main():
     replay_memory = None
     ewc = None
     adapter_handler = None
+    frozen_feature_cache = None
+    frozen_layers_cache = None
     if args.cl_algorithm == 'experience_replay':
         # Initialize an empty replay memory
         replay_memory = ExperienceReplayMemory()
@@ -174,10 +206,15 @@ def main():
     elif args.cl_algorithm == 'freeze_encoder':
         # Freeze encoder weights
         model.get_encoder().freeze_all_weights()
+        if args.frozen_features_cache_dir is not None:
+            frozen_feature_cache = FrozenEncoderFeatureCache(args, model)
 
     elif args.cl_algorithm == 'freeze_bottom_k_layers':
         # Freeze bottom K layers
         model.get_encoder().freeze_bottom_k_layers(k=args.layers_to_freeze)
+        if args.frozen_layers_cache_dir is not None:
+            model.get_encoder().enable_frozen_layers_cache(args.frozen_layers_cache_dir)
+            frozen_layers_cache = model.get_encoder().frozen_layers_cache
 
     # ------------------------------------------ Print some model info ------------------------------------------
     logger.info("Succesfully initialized {}-based Continual Learner".format(model_config['encoder_name']))
@@ -237,7 +274,9 @@ def main():
                 logger.info("Loaded model checkpoint from task {}! Moving on to next task...".format(task_name))
 
                 task_trainer_class = task_configs[task_key]['task_trainer']
-                task_trainer = task_trainer_class(args, task_configs, model_config, device)
+                task_trainer = task_trainer_class(args, task_configs, model_config, device, model.get_encoder())
+                if frozen_layers_cache is not None:
+                    frozen_layers_cache.index_task_dataloaders(task_key, task_configs[task_key], task_trainer)
 
             else:
 
@@ -251,7 +290,11 @@ def main():
                 # Create the Trainer method for the current CL task, and call the train method
                 logger.info("Training {} model on task #{}: {}".format(args.encoder_name, task_num+1, task_name))
                 task_trainer_class = task_configs[task_key]['task_trainer']
-                task_trainer = task_trainer_class(args, task_configs, model_config, device)
+                task_trainer = task_trainer_class(args, task_configs, model_config, device, model.get_encoder())
+                if frozen_feature_cache is not None:
+                    frozen_feature_cache.replace_task_dataloaders(task_key, task_trainer, model)
+                if frozen_layers_cache is not None:
+                    frozen_layers_cache.index_task_dataloaders(task_key, task_configs[task_key], task_trainer)
                 best_eval_score, best_model = task_trainer.train(model,
                                                                 replay_memory=replay_memory,
                                                                 ewc=ewc)
@@ -311,7 +354,11 @@ def main():
             task_trainers = {}
             for task_num, task_key in enumerate(args.ordered_cl_tasks):
                 task_trainer_class = task_configs[task_key]['task_trainer']
-                task_trainer = task_trainer_class(args, task_configs, model_config, device)
+                task_trainer = task_trainer_class(args, task_configs, model_config, device, model.get_encoder())
+                if frozen_feature_cache is not None:
+                    frozen_feature_cache.replace_task_dataloaders(task_key, task_trainer, model, eval_only=True)
+                if frozen_layers_cache is not None:
+                    frozen_layers_cache.index_task_dataloaders(task_key, task_configs[task_key], task_trainer)
                 task_trainers[task_key] = task_trainer
         else:
             for task_num, task_key in enumerate(args.ordered_cl_tasks):
@@ -19,7 +19,6 @@ from tqdm import tqdm
 import numpy as np
 import torch
 from torch import nn
-from sklearn.metrics import f1_score
 from torch.optim import AdamW
 from transformers import get_polynomial_decay_schedule_with_warmup
 from transformers import BertTokenizer
@@ -28,6 +27,7 @@ from modeling import load_encoder_map
 from configs.model_configs import model_configs
 from configs.task_configs import task_configs
 from utils.seed_utils import set_seed
+from utils.metrics import AccuracyAccumulator, MultiLabelF1Accumulator
 
 os.environ["TOKENIZERS_PARALLELISM"] = "false"
 
@@ -89,23 +89,27 @@ def train_vision(args, encoder, task_config, model_config, tokenizer, device):
 
     eval_fn = eval_coco if args.task_name == 'coco-cls' else eval_acc
 
+    batch_encoder = encoder.get_batch_encoder() if args.worker_preprocessing else None
     train_dataloader = get_data_loader(
         args,
         data_dir,
         'train', 
         n_shot,
-        subsample_seed
+        subsample_seed,
+        batch_encoder=batch_encoder
     )
     val_dataloader = get_data_loader(
         args,
         data_dir,
         'val',
-        n_shot
+        n_shot,
+        batch_encoder=batch_encoder
     ) 
     test_dataloader = get_data_loader(
         args,
         data_dir,
-        'test'
+        'test',
+        batch_encoder=batch_encoder
     ) 
 
     # Training hyperparameters
@@ -207,24 +211,17 @@ def eval_coco(args, model, eval_dataloader, device, batch2inputs_converter):
     '''
 
     model.eval()
-    act_fn = nn.Sigmoid()
+    f1_micro = MultiLabelF1Accumulator(device, threshold=0.5)
 
-    all_labels = torch.zeros((len(eval_dataloader.dataset), 80), dtype=torch.bool)
-    all_preds = all_labels.clone()
-    offset = 0
     for step, batch in enumerate(tqdm(eval_dataloader, desc='Evaluating...')):
         labels = batch['labels']
         inputs = batch2inputs_converter(batch)
         with torch.no_grad():
             logits = model(**inputs)
-            preds = act_fn(logits) > 0.5
-
-        all_labels[offset: offset+len(labels)] = labels.bool().cpu()
-        all_preds[offset: offset+len(labels)] = preds.cpu()
 
-        offset += len(labels)
+        f1_micro.update(logits, labels)
 
-    f1 = f1_score(all_labels, all_preds, average='micro')*100.0
+    f1 = f1_micro.compute()
     logger.info(f'Eval_F1: {f1:.3f}')
 
     model.train()
@@ -242,17 +239,16 @@ def eval_acc(args, model, eval_dataloader, device, batch2inputs_converter):
     '''
 
     model.eval()
-    eval_score = 0
+    accuracy = AccuracyAccumulator(device)
     for step, batch in enumerate(tqdm(eval_dataloader, desc='Evaluating...')):
         labels = batch['labels']
         inputs = batch2inputs_converter(batch)
         with torch.no_grad():
             logits = model(**inputs)
 
-        batch_scores = (logits.argmax(-1).cpu() == labels)
-        eval_score += batch_scores.sum().item()
+        accuracy.update(logits, labels)
 
-    eval_score = eval_score/len(eval_dataloader.dataset)*100.0
+    eval_score = accuracy.compute()
     logger.info(f'Eval_acc: {eval_score:.3f}')
 
     model.train()
@@ -282,6 +278,20 @@ def main():
                         help="Batch size.")
     parser.add_argument("--num_workers", type=int, default=2,
                         help="Number of workers for dataloader")
+    parser.add_argument("--use_image_shards", action='store_true',
+                        help="Read pre-decoded MS-COCO/Flickr30K images from image shards (see data.image_datasets.image_shards).")
+    parser.add_argument("--worker_preprocessing", action='store_true',
+                        help="Tokenize and preprocess images inside the DataLoader workers, instead of in the training loop.")
+    parser.add_argument("--image_archive", type=str, default=None,
+                        help="Uncompressed tar archive of the ImageNet/Places365/iNat2019 images, which are then read from the archive without extracting it.")
+    parser.add_argument("--image_archive_root", type=str, default='',
+                        help="Directory inside --image_archive that corresponds to the task's data_dir (e.g. places365_standard).")
+    parser.add_argument("--stream_train_images", action='store_true',
+                        help="Stream the training images sequentially from --image_archive, in shuffled shards through a shuffle buffer.")
+    parser.add_argument("--shuffle_buffer_size", type=int, default=1000,
+                        help="Number of images in the shuffle buffer of each DataLoader worker, with --stream_train_images.")
+    parser.add_argument("--stream_open_shards", type=int, default=16,
+                        help="Number of archive shards (of 1000 consecutive images, often of a single class) that each DataLoader worker reads interleaved, with --stream_train_images.")
     parser.add_argument("--seed", type=int, default=42,
                         help="Random seed.")
 
@@ -21,7 +21,9 @@ from torch.optim import AdamW
 from transformers import get_polynomial_decay_schedule_with_warmup
 
 from data.visionlanguage_datasets.nlvr2_dataset import build_nlvr2_dataloader
+from modeling.continual_learner import EncoderWrapper
 from train.visionlanguage_tasks.task_trainer import TaskTrainer
+from utils.metrics import AccuracyAccumulator
 from utils.wandb import wandb_logger
 
 sys.path.insert(0, '.')
@@ -39,7 +41,8 @@ class NLVR2Trainer(TaskTrainer):
                  args: argparse.Namespace, 
                  task_configs: Dict, 
                  model_config: Dict, 
-                 device: torch.device):
+                 device: torch.device,
+                 encoder: EncoderWrapper):
         '''
         Initializes a Trainer that handles training of a model on the NLVR2 task
 
@@ -47,6 +50,7 @@ class NLVR2Trainer(TaskTrainer):
         task_configs: dictionary containing task-specific configuration parameters for all tasks
         model_config: dictionary containing model-specific configuration parameters
         device: cuda/cpu
+        encoder: the model's encoder, whose processor settings are used for preprocessing
         '''
 
         super().__init__()
@@ -60,17 +64,24 @@ class NLVR2Trainer(TaskTrainer):
         # Model-specific stuff
         self.visual_input_type = model_config['visual_input_type']
         self.batch2inputs_converter = model_config['batch2inputs_converter']
+        # Run the model's processor inside the DataLoader workers, if requested
+        self.batch_encoder = None
+        if args.worker_preprocessing:
+            self.batch_encoder = encoder.get_batch_encoder()
 
         # Create dataloaders for training and validation
         self.nlvr_train_dataloader = build_nlvr2_dataloader(args=args,
                                                     data_dir=self.data_dir,
                                                     split='train',
-                                                    visual_input_type=self.visual_input_type)
+                                                    visual_input_type=self.visual_input_type,
+                                                    batch_encoder=self.batch_encoder,
+                                                    length_bucket_size=args.length_bucket_size)
 
         self.nlvr_val_dataloader = build_nlvr2_dataloader(args=args,
                                                      data_dir=self.data_dir,
                                                      split='val',
-                                                     visual_input_type=self.visual_input_type)
+                                                     visual_input_type=self.visual_input_type,
+                                                     batch_encoder=self.batch_encoder)
 
         # Training hyperparameters
         self.num_epochs = self.nlvr_config['num_epochs']
@@ -89,6 +100,17 @@ class NLVR2Trainer(TaskTrainer):
     def get_train_dataloader(self):
         return self.nlvr_train_dataloader
 
+    def get_eval_dataloader(self):
+        return self.nlvr_val_dataloader
+
+    def replace_dataloaders(self, train_dataloader, eval_dataloader):
+        '''
+        Replaces the train and val dataloaders (e.g. with dataloaders over cached encoder features)
+        '''
+        self.nlvr_train_dataloader = train_dataloader
+        self.nlvr_val_dataloader = eval_dataloader
+        self.max_steps = len(self.nlvr_train_dataloader) * self.num_epochs
+
     def get_collate_fn(self):
         return self.nlvr_train_dataloader.collate_fn
 
@@ -229,15 +251,14 @@ class NLVR2Trainer(TaskTrainer):
         '''
 
         model.eval()
-        eval_score = 0
+        accuracy = AccuracyAccumulator(self.device)
 
         for step, batch in enumerate(tqdm(self.nlvr_val_dataloader, desc='Evaluating on NLVR2 val set')):
             output = self.forward_pass(model, batch, do_eval=True)
             logits = output[1]
-            batch_scores = (logits.argmax(-1).cpu() == batch['labels'])
-            eval_score += batch_scores.sum().item()
+            accuracy.update(logits, batch['labels'])
 
-        eval_score = eval_score/len(self.nlvr_val_dataloader.dataset)*100.0
+        eval_score = accuracy.compute()
 
         model.train()
         return eval_score
@@ -265,6 +286,7 @@ class LowShotNLVR2Trainer(NLVR2Trainer):
                  task_configs: Dict, 
                  model_config: Dict, 
                  device: torch.device, 
+                 encoder: EncoderWrapper,
                  low_shot_config: Dict = None):
 
         '''
@@ -274,10 +296,11 @@ class LowShotNLVR2Trainer(NLVR2Trainer):
         task_configs: dictionary containing task-specific configuration parameters for all tasks
         model_config: dictionary containing model-specific configuration parameters
         device: cuda/cpu
+        encoder: the model's encoder, whose processor settings are used for preprocessing
         low_shot_config: dictionary containing low-shot configuration parameters
         '''
 
-        super(LowShotNLVR2Trainer, self).__init__(args, task_configs, model_config, device)
+        super(LowShotNLVR2Trainer, self).__init__(args, task_configs, model_config, device, encoder)
         self.low_shot_config = low_shot_config
         self.eval_epochs = [x-1 for x in low_shot_config['eval_epochs']]
 
@@ -24,7 +24,10 @@ from transformers import get_polynomial_decay_schedule_with_warmup
 
 from data.image_datasets.flickr30kimages_dataset import Flickr30KImagesDataset
 from data.visionlanguage_datasets.snli_ve_dataset import build_snli_ve_dataloader
+from data.text_collation import get_special_token_ids
+from modeling.continual_learner import EncoderWrapper
 from train.visionlanguage_tasks.task_trainer import TaskTrainer
+from utils.metrics import AccuracyAccumulator
 from utils.wandb import wandb_logger
 
 logger = logging.getLogger(__name__)
@@ -39,7 +42,8 @@ class SNLIVETrainer(TaskTrainer):
                  args: argparse.Namespace, 
                  task_configs: Dict, 
                  model_config: Dict, 
-                 device: torch.device):
+                 device: torch.device,
+                 encoder: EncoderWrapper):
         '''
         Initializes a Trainer that handles training of a model on the SNLI-VE task
 
@@ -47,6 +51,7 @@ class SNLIVETrainer(TaskTrainer):
         task_configs: dictionary containing task-specific configuration parameters for all tasks
         model_config: dictionary containing model-specific configuration parameters
         device: cuda/cpu
+        encoder: the model's encoder, whose processor settings are used for preprocessing
         '''
 
         super().__init__()
@@ -59,26 +64,52 @@ class SNLIVETrainer(TaskTrainer):
 
         # Model-specific stuff
         self.visual_input_type = model_config['visual_input_type']
+        if args.raw_image_inputs:
+            # Images are sent from the DataLoader workers as uint8 tensors, and normalized by the encoder
+            self.visual_input_type = 'raw'
         self.batch2inputs_converter = model_config['batch2inputs_converter']
+        # Run the model's processor inside the DataLoader workers, if requested
+        self.batch_encoder = None
+        if args.worker_preprocessing:
+            self.batch_encoder = encoder.get_batch_encoder()
+        # Texts are tokenized once by the dataset, and passed to the model as ready tensors
+        self.tokenizer = encoder.processor.tokenizer
+        self.max_text_length = encoder.max_text_length
+        self.special_token_ids = get_special_token_ids(self.tokenizer)
 
         # Load Flickr30K Images dataset for image data backbone
         images_source = self.snli_ve_config['images_source']
         flickr30k_config = task_configs[images_source]
         images_dataset = Flickr30KImagesDataset(os.path.join(args.climb_data_dir, flickr30k_config['data_dir']), 
-                         visual_input_type=self.visual_input_type)
+                         visual_input_type=self.visual_input_type,
+                         use_image_shards=args.use_image_shards)
 
         # Create dataloaders for training and validation
         self.snli_ve_train_dataloader = build_snli_ve_dataloader(args=args,
                                                                  data_dir=self.data_dir,
                                                                  images_dataset=images_dataset,
                                                                  split='train',
-                                                                 visual_input_type=self.visual_input_type)
+                                                                 visual_input_type=self.visual_input_type,
+                                                                 batch_encoder=self.batch_encoder,
+                                                                 image_group_size=args.image_group_size,
+                                                                 length_bucket_size=args.length_bucket_size,
+                                                                 aspect_ratio_buckets=args.aspect_ratio_buckets,
+                                                                 max_text_length=self.max_text_length,
+                                                                 special_token_ids=self.special_token_ids,
+                                                                 tokenizer=self.tokenizer)
 
         self.snli_ve_dev_dataloader = build_snli_ve_dataloader(args=args,
                                                                data_dir=self.data_dir,
                                                                images_dataset=images_dataset,
                                                                split='dev',
-                                                               visual_input_type=self.visual_input_type)
+                                                               visual_input_type=self.visual_input_type,
+                                                               batch_encoder=self.batch_encoder,
+                                                               image_group_size=args.image_group_size,
+                                                               length_bucket_size=args.length_bucket_size,
+                                                               aspect_ratio_buckets=args.aspect_ratio_buckets,
+                                                               max_text_length=self.max_text_length,
+                                                               special_token_ids=self.special_token_ids,
+                                                               tokenizer=self.tokenizer)
 
         # Training hyperparameters
         self.num_epochs = self.snli_ve_config['num_epochs']
@@ -97,6 +128,17 @@ class SNLIVETrainer(TaskTrainer):
     def get_train_dataloader(self):
         return self.snli_ve_train_dataloader
 
+    def get_eval_dataloader(self):
+        return self.snli_ve_dev_dataloader
+
+    def replace_dataloaders(self, train_dataloader, eval_dataloader):
+        '''
+        Replaces the train and val dataloaders (e.g. with dataloaders over cached encoder features)
+        '''
+        self.snli_ve_train_dataloader = train_dataloader
+        self.snli_ve_dev_dataloader = eval_dataloader
+        self.max_steps = len(self.snli_ve_train_dataloader) * self.num_epochs
+
     def get_collate_fn(self):
         return self.snli_ve_train_dataloader.collate_fn
 
@@ -235,16 +277,15 @@ class SNLIVETrainer(TaskTrainer):
         '''
 
         model.eval()
-        eval_score = 0
+        accuracy = AccuracyAccumulator(self.device)
 
         for step, batch in enumerate(tqdm(self.snli_ve_dev_dataloader, desc='Evaluating on SNLI-VE val set')):
             output = self.forward_pass(model, batch, do_eval=True)
 
             logits = output[1]
-            batch_scores = (logits.argmax(-1).cpu() == batch['labels'])
-            eval_score += batch_scores.sum().item()
+            accuracy.update(logits, batch['labels'])
 
-        eval_score = eval_score/len(self.snli_ve_dev_dataloader.dataset)*100.0
+        eval_score = accuracy.compute()
 
         model.train()
         return eval_score
@@ -273,6 +314,7 @@ class LowShotSNLIVETrainer(SNLIVETrainer):
                  task_configs: Dict, 
                  model_config: Dict, 
                  device: torch.device, 
+                 encoder: EncoderWrapper,
                  low_shot_config: Dict = None):
 
         '''
@@ -282,10 +324,11 @@ class LowShotSNLIVETrainer(SNLIVETrainer):
         task_configs: dictionary containing task-specific configuration parameters for all tasks
         model_config: dictionary containing model-specific configuration parameters
         device: cuda/cpu
+        encoder: the model's encoder, whose processor settings are used for preprocessing
         low_shot_config: dictionary containing low-shot configuration parameters
         '''
 
-        super(LowShotSNLIVETrainer, self).__init__(args, task_configs, model_config, device)
+        super(LowShotSNLIVETrainer, self).__init__(args, task_configs, model_config, device, encoder)
         self.low_shot_config = low_shot_config
         self.eval_epochs = [x-1 for x in low_shot_config['eval_epochs']]
 
@@ -23,7 +23,9 @@ from torch.optim import AdamW
 from transformers import get_polynomial_decay_schedule_with_warmup
 
 from data.visionlanguage_datasets.vcr_dataset import build_vcr_dataloader
+from modeling.continual_learner import EncoderWrapper
 from train.visionlanguage_tasks.task_trainer import TaskTrainer
+from utils.metrics import AccuracyAccumulator
 from utils.wandb import wandb_logger
 
 logger = logging.getLogger(__name__)
@@ -39,7 +41,8 @@ class VCRTrainer(TaskTrainer):
                  args: argparse.Namespace, 
                  task_configs: Dict, 
                  model_config: Dict, 
-                 device: torch.device):
+                 device: torch.device,
+                 encoder: EncoderWrapper):
         '''
         Initializes a Trainer that handles training of a model on the VCR task
 
@@ -47,6 +50,7 @@ class VCRTrainer(TaskTrainer):
         task_configs: dictionary containing task-specific configuration parameters for all tasks
         model_config: dictionary containing model-specific configuration parameters
         device: cuda/cpu
+        encoder: the model's encoder, whose processor settings are used for preprocessing
         '''
 
         super().__init__()
@@ -61,19 +65,29 @@ class VCRTrainer(TaskTrainer):
         # Model-specific stuff
         self.visual_input_type = model_config['visual_input_type']
         self.batch2inputs_converter = model_config['batch2inputs_converter']
+        # Run the model's processor inside the DataLoader workers, if requested
+        self.batch_encoder = None
+        if args.worker_preprocessing:
+            self.batch_encoder = encoder.get_batch_encoder()
 
         # Create dataloaders for training and validation
         self.vcr_train_dataloader = build_vcr_dataloader(args=args,
                                                 data_dir=self.data_dir,
                                                 split='train',
                                                 task_type=self.task_type,
-                                                visual_input_type=self.visual_input_type)
+                                                visual_input_type=self.visual_input_type,
+                                                batch_encoder=self.batch_encoder,
+                                                batch_size_divisor=self.vcr_config['batch_size_divisor'],
+                                                length_bucket_size=args.length_bucket_size,
+                                                aspect_ratio_buckets=args.aspect_ratio_buckets)
     
         self.vcr_val_dataloader = build_vcr_dataloader(args=args,
                                                 data_dir=self.data_dir,
                                                 split='val',
                                                 task_type=self.task_type,
-                                                visual_input_type=self.visual_input_type)
+                                                visual_input_type=self.visual_input_type,
+                                                batch_encoder=self.batch_encoder,
+                                                batch_size_divisor=self.vcr_config['batch_size_divisor'])
 
         # Training hyperparameters
         self.num_epochs = self.vcr_config['num_epochs']
@@ -92,6 +106,17 @@ class VCRTrainer(TaskTrainer):
     def get_train_dataloader(self):
         return self.vcr_train_dataloader
 
+    def get_eval_dataloader(self):
+        return self.vcr_val_dataloader
+
+    def replace_dataloaders(self, train_dataloader, eval_dataloader):
+        '''
+        Replaces the train and val dataloaders (e.g. with dataloaders over cached encoder features)
+        '''
+        self.vcr_train_dataloader = train_dataloader
+        self.vcr_val_dataloader = eval_dataloader
+        self.max_steps = len(self.vcr_train_dataloader) * self.num_epochs
+
     def get_collate_fn(self):
         return self.vcr_train_dataloader.collate_fn
 
@@ -230,16 +255,15 @@ class VCRTrainer(TaskTrainer):
         '''
 
         model.eval()
-        eval_score = 0
+        accuracy = AccuracyAccumulator(self.device)
 
         for step, batch in enumerate(tqdm(self.vcr_val_dataloader, desc='Evaluating on VCR val set')):
             output = self.forward_pass(model, batch, do_eval=True)
 
             logits = output[1]
-            batch_scores = (logits.argmax(-1).cpu() == batch['labels'])
-            eval_score += batch_scores.sum().item()
+            accuracy.update(logits, batch['labels'])
 
-        eval_score = eval_score/len(self.vcr_val_dataloader.dataset)*100.0
+        eval_score = accuracy.compute()
 
         model.train()
         return eval_score
@@ -267,6 +291,7 @@ class LowShotVCRTrainer(VCRTrainer):
                  task_configs: Dict, 
                  model_config: Dict, 
                  device: torch.device, 
+                 encoder: EncoderWrapper,
                  low_shot_config: Dict = None):
 
         '''
@@ -276,10 +301,11 @@ class LowShotVCRTrainer(VCRTrainer):
         task_configs: dictionary containing task-specific configuration parameters for all tasks
         model_config: dictionary containing model-specific configuration parameters
         device: cuda/cpu
+        encoder: the model's encoder, whose processor settings are used for preprocessing
         low_shot_config: dictionary containing low-shot configuration parameters
         '''
 
-        super(LowShotVCRTrainer, self).__init__(args, task_configs, model_config, device)
+        super(LowShotVCRTrainer, self).__init__(args, task_configs, model_config, device, encoder)
         self.low_shot_config = low_shot_config
         self.eval_epochs = [x-1 for x in low_shot_config['eval_epochs']]
 
@@ -24,7 +24,10 @@ from transformers import get_polynomial_decay_schedule_with_warmup
 
 from data.image_datasets.cocoimages_dataset import MSCOCOImagesDataset
 from data.visionlanguage_datasets.vqa_dataset import build_vqa_dataloader
+from data.text_collation import get_special_token_ids
+from modeling.continual_learner import EncoderWrapper
 from train.visionlanguage_tasks.task_trainer import TaskTrainer
+from utils.metrics import VQAScoreAccumulator
 from utils.wandb import wandb_logger
 
 logger = logging.getLogger(__name__)
@@ -39,7 +42,8 @@ class VQATrainer(TaskTrainer):
                  args: argparse.Namespace, 
                  task_configs: Dict, 
                  model_config: Dict, 
-                 device: torch.device):
+                 device: torch.device,
+                 encoder: EncoderWrapper):
 
         '''
         Initializes a Trainer that handles training of a model on the VQA task
@@ -48,6 +52,7 @@ class VQATrainer(TaskTrainer):
         task_configs: dictionary containing task-specific configuration parameters for all tasks
         model_config: dictionary containing model-specific configuration parameters
         device: cuda/cpu
+        encoder: the model's encoder, whose processor settings are used for preprocessing
         '''
 
         super().__init__()
@@ -60,26 +65,52 @@ class VQATrainer(TaskTrainer):
 
         # Model-specific stuff
         self.visual_input_type = model_config['visual_input_type']
+        if args.raw_image_inputs:
+            # Images are sent from the DataLoader workers as uint8 tensors, and normalized by the encoder
+            self.visual_input_type = 'raw'
         self.batch2inputs_converter = model_config['batch2inputs_converter']
+        # Run the model's processor inside the DataLoader workers, if requested
+        self.batch_encoder = None
+        if args.worker_preprocessing:
+            self.batch_encoder = encoder.get_batch_encoder()
+        # Texts are tokenized once by the dataset, and passed to the model as ready tensors
+        self.tokenizer = encoder.processor.tokenizer
+        self.max_text_length = encoder.max_text_length
+        self.special_token_ids = get_special_token_ids(self.tokenizer)
 
         # Load COCO Images dataset for image data backbone
         images_source = self.vqa_config['images_source']
         mscoco_config = task_configs[images_source]
         self.images_dataset = MSCOCOImagesDataset(coco_dir=os.path.join(args.climb_data_dir, mscoco_config['data_dir']),
-                                                  visual_input_type=args.visual_input_type)
+                                                  visual_input_type=self.visual_input_type,
+                                                  use_image_shards=args.use_image_shards)
 
         # Create dataloaders for training and validation
         self.vqa_train_dataloader = build_vqa_dataloader(args=args,
                                                     data_dir=self.data_dir,
                                                     images_dataset=self.images_dataset,
                                                     split='train',
-                                                    visual_input_type=self.visual_input_type)
+                                                    visual_input_type=self.visual_input_type,
+                                                    batch_encoder=self.batch_encoder,
+                                                    image_group_size=args.image_group_size,
+                                                    length_bucket_size=args.length_bucket_size,
+                                                    aspect_ratio_buckets=args.aspect_ratio_buckets,
+                                                    max_text_length=self.max_text_length,
+                                                    special_token_ids=self.special_token_ids,
+                                                    tokenizer=self.tokenizer)
 
         self.vqa_val_dataloader = build_vqa_dataloader(args=args,
                                                   data_dir=self.data_dir,
                                                   images_dataset=self.images_dataset,
                                                   split='val',
-                                                  visual_input_type=self.visual_input_type)
+                                                  visual_input_type=self.visual_input_type,
+                                                  batch_encoder=self.batch_encoder,
+                                                  image_group_size=args.image_group_size,
+                                                  length_bucket_size=args.length_bucket_size,
+                                                  aspect_ratio_buckets=args.aspect_ratio_buckets,
+                                                  max_text_length=self.max_text_length,
+                                                  special_token_ids=self.special_token_ids,
+                                                  tokenizer=self.tokenizer)
 
         # Training hyperparameters
         self.num_epochs = self.vqa_config['num_epochs']
@@ -96,25 +127,20 @@ class VQATrainer(TaskTrainer):
         self.max_steps = len(self.vqa_train_dataloader) * self.num_epochs
         self.warmup_ratio = 0.1 # TODO remove hard code
 
-    def compute_score_with_logits(self, logits: torch.Tensor, labels: torch.Tensor) -> torch.Tensor:
-        '''
-        Given logits for each answer in VQA classification, selects answer with max logit and returns VQA-score for that answer
-        logits: logits for each answer - size=(batch_size, num_answers)
-        labels: label for each answer in {0, 0.3, 0.6, 1} (batch_size, num_answers)
-        
-        Returns:
-        scores: score of predicted answer (batch_size, num_answers)
-        '''
-
-        logits = torch.max(logits, 1)[1].data # argmax
-        one_hots = torch.zeros(*labels.size()).to(self.device)
-        one_hots.scatter_(1, logits.view(-1, 1), 1)
-        scores = (one_hots * labels)
-        return scores
-    
     def get_train_dataloader(self):
         return self.vqa_train_dataloader
 
+    def get_eval_dataloader(self):
+        return self.vqa_val_dataloader
+
+    def replace_dataloaders(self, train_dataloader, eval_dataloader):
+        '''
+        Replaces the train and val dataloaders (e.g. with dataloaders over cached encoder features)
+        '''
+        self.vqa_train_dataloader = train_dataloader
+        self.vqa_val_dataloader = eval_dataloader
+        self.max_steps = len(self.vqa_train_dataloader) * self.num_epochs
+
     def get_collate_fn(self):
         return self.vqa_train_dataloader.collate_fn
 
@@ -250,17 +276,14 @@ class VQATrainer(TaskTrainer):
         Returns validation VQA score
         '''
         model.eval()
-        eval_score = 0
+        vqa_score = VQAScoreAccumulator(self.device)
 
         for step, batch in enumerate(tqdm(self.vqa_val_dataloader, desc='Evaluating on VQA val set')):
             output = self.forward_pass(model, batch, do_eval=True)
             logits = output[1]
-            target = batch['target_scores'].to(self.device)
-            answer_scores = self.compute_score_with_logits(logits, target)
-            batch_scores = torch.sum(answer_scores, 1)
-            eval_score += batch_scores.sum().item()
+            vqa_score.update(logits, batch['target_scores'])
 
-        eval_score = eval_score/len(self.vqa_val_dataloader.dataset)*100.0
+        eval_score = vqa_score.compute()
 
         model.train()
         return eval_score
@@ -288,6 +311,7 @@ class LowShotVQATrainer(VQATrainer):
                  task_configs: Dict, 
                  model_config: Dict, 
                  device: torch.device, 
+                 encoder: EncoderWrapper,
                  low_shot_config: Dict = None):
 
         '''
@@ -297,10 +321,11 @@ class LowShotVQATrainer(VQATrainer):
         task_configs: dictionary containing task-specific configuration parameters for all tasks
         model_config: dictionary containing model-specific configuration parameters
         device: cuda/cpu
+        encoder: the model's encoder, whose processor settings are used for preprocessing
         low_shot_config: dictionary containing low-shot configuration parameters
         '''
 
-        super(LowShotVQATrainer, self).__init__(args, task_configs, model_config, device)
+        super(LowShotVQATrainer, self).__init__(args, task_configs, model_config, device, encoder)
         self.low_shot_config = low_shot_config
         self.eval_epochs = [x-1 for x in low_shot_config['eval_epochs']]
 
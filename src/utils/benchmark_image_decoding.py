@@ -0,0 +1,71 @@
+import os
+import sys
+import time
+import random
+import logging
+import argparse
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(
+        format='%(asctime)s - %(levelname)s - %(name)s - %(message)s',
+        datefmt='%m/%d/%Y %H:%M:%S',
+        level=logging.INFO)
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg')
+
+def find_images(image_dir, num_images, seed=2022):
+
+    '''
+    Returns a random sample of num_images JPEG filenames from image_dir and its sub-directories
+    '''
+
+    filenames = []
+    for root, _, files in os.walk(image_dir):
+        filenames.extend(os.path.join(root, fn) for fn in files if fn.lower().endswith(IMAGE_EXTENSIONS))
+    random.seed(seed)
+    return random.sample(filenames, min(num_images, len(filenames)))
+
+def time_decoding(filenames, fast_decode):
+
+    '''
+    Decodes and resizes every image with load_resized_pil_image, and returns the decoded images and the average time per image in ms
+    '''
+
+    from utils.image_utils import load_resized_pil_image
+
+    images = []
+    start_time = time.time()
+    for fn in filenames:
+        images.append(load_resized_pil_image(fn, short_side=384, max_size=640, fast_decode=fast_decode))
+    return images, 1000 * (time.time() - start_time) / len(filenames)
+
+def main():
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--image_dirs", type=str, nargs='+', required=True,
+                        help="Image directories to benchmark, e.g. the ImageNet/Places365/iNat2019 train folders and the MS-COCO images folder")
+    parser.add_argument("--num_images", type=int, default=500,
+                        help="Number of images sampled from each directory")
+    args = parser.parse_args()
+
+    for image_dir in args.image_dirs:
+        filenames = find_images(image_dir, args.num_images)
+        if len(filenames) == 0:
+            logger.info("No JPEG images found in {}".format(image_dir))
+            continue
+
+        # The first pass over the files warms up the OS page cache, so that both decoders read from memory
+        full_images, full_time = time_decoding(filenames, fast_decode=False)
+        full_images, full_time = time_decoding(filenames, fast_decode=False)
+        fast_images, fast_time = time_decoding(filenames, fast_decode=True)
+
+        assert all(x.size == y.size for x, y in zip(full_images, fast_images))
+        mean_abs_diff = np.mean([np.abs(np.asarray(x, dtype=np.float32) - np.asarray(y, dtype=np.float32)).mean() for x, y in zip(full_images, fast_images)])
+        logger.info("{}: {} images, full decode {:.1f} ms/image, reduced-resolution decode {:.1f} ms/image ({:.2f}x speedup), mean abs pixel difference {:.2f}".format(
+                    image_dir, len(filenames), full_time, fast_time, full_time / fast_time, mean_abs_diff))
+
+if __name__ == '__main__':
+    sys.path.insert(0, '.')
+    main()
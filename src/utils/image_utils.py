@@ -49,11 +49,80 @@ def resize_image(image, desired_shape):
             image_arr = np.stack((image_arr,)*3, axis=-1)
         elif len(image_arr.shape) == 3 and image_arr.shape[2] > 3:
             image_arr = image_arr[:, :, :3]
-        padded_image = np.zeros((d_h, d_w, 3,), dtype=np.float64)
+        padded_image = np.zeros((d_h, d_w, 3,), dtype=np.uint8)
         padded_image[:image_arr.shape[0], :image_arr.shape[1]] = image_arr
         return padded_image
     except Exception as e:
         d_w = max(desired_shape)
         d_h = min(desired_shape)
-        padded_image = np.zeros((d_h, d_w, 3,), dtype=np.float64)
-        return padded_image
\ No newline at end of file
+        padded_image = np.zeros((d_h, d_w, 3,), dtype=np.uint8)
+        return padded_image
+
+def get_resized_shape(image_size, short_side=384, max_size=640):
+
+    '''
+    Returns the (width, height) that torchvision's T.Resize(size=short_side, max_size=max_size) resizes a PIL image of size image_size=(width, height) to
+    '''
+
+    w, h = image_size
+    short, long = (w, h) if w <= h else (h, w)
+    new_short, new_long = short_side, int(short_side * long / short)
+    if new_long > max_size:
+        new_short, new_long = int(max_size * new_short / new_long), max_size
+    return (new_short, new_long) if w <= h else (new_long, new_short)
+
+def load_resized_pil_image(image_fn, short_side=384, max_size=640, fast_decode=True):
+
+    '''
+    Loads an image as an RGB PIL.Image, and downscales it like T.Resize(size=short_side, max_size=max_size) if its short side is larger than short_side
+
+    With fast_decode, JPEGs are decoded directly at a reduced scale (1/2, 1/4 or 1/8 of the full resolution, using libjpeg's DCT-domain scaling through Image.draft),
+    choosing the smallest scale that is still at least as large as the output size. Only the final, much smaller resize is then done on the decoded pixels.
+    The output size is the same as without fast_decode, and pixel values differ only slightly
+    '''
+
+    image = Image.open(image_fn)
+    resized_shape = None
+    if min(list(image.size)) > short_side:
+        resized_shape = get_resized_shape(image.size, short_side, max_size)
+        if fast_decode:
+            image.draft('RGB', resized_shape)
+    image = image.convert('RGB')
+    if resized_shape is not None:
+        # Same interpolation as T.Resize on PIL images
+        image = image.resize(resized_shape, resample=Image.BILINEAR)
+    return image
+
+def get_vilt_input_shape(image_size, shorter=384, longer=None, size_divisor=32):
+
+    '''
+    Returns the (height, width) that ViltFeatureExtractor resizes an image of size image_size=(width, height) to, before padding it to the largest image of the batch
+    The short side is scaled to shorter (while the long side is at most longer, by default 1333/800 * shorter like ViltFeatureExtractor),
+    and both sides are rounded down to a multiple of size_divisor (the patch size)
+    '''
+
+    if longer is None:
+        longer = int((1333 / 800) * shorter)
+    w, h = image_size
+    scale = shorter / min(w, h)
+    new_h, new_w = (shorter, scale * w) if h < w else (scale * h, shorter)
+    if max(new_h, new_w) > longer:
+        scale = longer / max(new_h, new_w)
+        new_h, new_w = new_h * scale, new_w * scale
+    new_h, new_w = int(new_h + 0.5), int(new_w + 0.5)
+    return new_h // size_divisor * size_divisor, new_w // size_divisor * size_divisor
+
+def get_vilt_input_array(image, shorter=384, longer=None, size_divisor=32):
+
+    '''
+    Resizes an image (PIL.Image or (H, W, 3) uint8 array) to its ViLT input shape (see get_vilt_input_shape), with the same interpolation as ViltFeatureExtractor,
+    and returns it as a (3, H, W) uint8 array. Normalization and padding are left to the model, so that images are passed between processes with 1 byte per channel
+    '''
+
+    if not isinstance(image, Image.Image):
+        image = Image.fromarray(np.asarray(image))
+    image = image.convert('RGB')
+    new_h, new_w = get_vilt_input_shape(image.size, shorter, longer, size_divisor)
+    if (new_w, new_h) != image.size:
+        image = image.resize((new_w, new_h), resample=Image.BICUBIC)
+    return np.ascontiguousarray(np.asarray(image).transpose(2, 0, 1))
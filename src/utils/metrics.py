@@ -0,0 +1,206 @@
+import logging
+from typing import List, Dict
+
+import torch
+import torch.distributed as dist
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(
+        format='%(asctime)s - %(levelname)s - %(name)s - %(message)s',
+        datefmt='%m/%d/%Y %H:%M:%S',
+        level=logging.INFO)
+
+class MetricAccumulator:
+
+    # Names of the running sums in self.state
+    state_names = []
+
+    def __init__(self, device: torch.device = None):
+        '''
+        Streaming evaluation metric, whose running sums are kept in a single tensor on the device of the model outputs
+
+        update() only launches tensor ops on the device, without synchronizing with the host, and compute() copies the sums
+        to the host once at the end of the evaluation. Partial states (e.g. of several evaluation workers) are combined with merge() or all_reduce()
+
+        Args:
+        device: device of the running sums. If not given, the device of the first update() is used
+        '''
+
+        self.device = device
+        self.state = None
+        if device is not None:
+            self.reset()
+
+    def reset(self):
+        self.state = torch.zeros(len(self.state_names), dtype=torch.float64, device=self.device)
+
+    def add(self, values: List):
+        '''
+        Adds device tensors (or Python numbers, e.g. the batch size) to the running sums
+        '''
+
+        if self.state is None:
+            self.device = values[0].device
+            self.reset()
+        # Numbers are filled in on the device, since copying them from the host would synchronize every batch
+        self.state += torch.stack([v.to(self.state.device, torch.float64) if torch.is_tensor(v)
+                                   else torch.full((), v, dtype=torch.float64, device=self.state.device) for v in values])
+
+    def state_dict(self) -> Dict[str, torch.Tensor]:
+        return {'state': self.state}
+
+    def load_state_dict(self, state_dict: Dict[str, torch.Tensor]):
+        self.state = state_dict['state'].to(self.device if self.device is not None else state_dict['state'].device, torch.float64).clone()
+
+    def merge(self, other):
+        '''
+        Adds the running sums of another accumulator of the same metric (or its state_dict()) to this one
+        '''
+
+        other_state = other['state'] if isinstance(other, dict) else other.state
+        if other_state is None:
+            return
+        if self.state is None:
+            self.load_state_dict({'state': other_state})
+        else:
+            self.state += other_state.to(self.state.device, torch.float64)
+
+    def all_reduce(self):
+        '''
+        Sums the running sums of all processes, if torch.distributed is initialized
+        '''
+
+        if dist.is_available() and dist.is_initialized():
+            if self.state is None:
+                self.reset()
+            dist.all_reduce(self.state)
+
+    def get_sums(self) -> Dict[str, float]:
+        # Single device-to-host copy
+        values = self.state.tolist() if self.state is not None else [0.0] * len(self.state_names)
+        return dict(zip(self.state_names, values))
+
+    def compute(self) -> float:
+        raise NotImplementedError
+
+
+class AccuracyAccumulator(MetricAccumulator):
+
+    state_names = ['correct', 'total']
+
+    def update(self, logits: torch.Tensor, labels):
+        '''
+        logits: (batch_size, num_labels) scores of every class
+        labels: (batch_size,) gold labels (tensor or list of ints)
+        '''
+
+        labels = torch.as_tensor(labels, device=logits.device)
+        self.add([(logits.argmax(-1) == labels).sum(), labels.numel()])
+
+    def compute(self) -> float:
+        '''
+        Returns the accuracy (in %)
+        '''
+
+        sums = self.get_sums()
+        return sums['correct'] / max(sums['total'], 1) * 100.0
+
+
+class VQAScoreAccumulator(MetricAccumulator):
+
+    state_names = ['score', 'total']
+
+    def update(self, logits: torch.Tensor, target_scores: torch.Tensor):
+        '''
+        logits: (batch_size, num_answers) logits of every answer
+        target_scores: (batch_size, num_answers) VQA score of every answer, in {0, 0.3, 0.6, 0.9, 1}
+        '''
+
+        target_scores = target_scores.to(logits.device, non_blocking=True)
+        # Score of the answer with the highest logit, without creating one-hot vectors of all answers
+        predicted_scores = target_scores.gather(1, logits.argmax(1, keepdim=True))
+        self.add([predicted_scores.sum(), len(logits)])
+
+    def compute(self) -> float:
+        '''
+        Returns the VQA score (in %)
+        '''
+
+        sums = self.get_sums()
+        return sums['score'] / max(sums['total'], 1) * 100.0
+
+
+class MultiLabelF1Accumulator(MetricAccumulator):
+
+    state_names = ['true_positives', 'false_positives', 'false_negatives']
+
+    def __init__(self, device: torch.device = None, threshold: float = 0.5):
+        '''
+        Micro-averaged F1 score of multi-label predictions (a label is predicted if its sigmoid probability is larger than threshold),
+        same as sklearn's f1_score(labels, preds, average='micro')
+        '''
+
+        super().__init__(device)
+        self.threshold = threshold
+
+    def update(self, logits: torch.Tensor, labels: torch.Tensor):
+        '''
+        logits: (batch_size, num_labels) logits of every label
+        labels: (batch_size, num_labels) multi-hot gold labels
+        '''
+
+        labels = labels.to(logits.device, non_blocking=True).bool()
+        preds = torch.sigmoid(logits) > self.threshold
+        self.add([(preds & labels).sum(), (preds & ~labels).sum(), (~preds & labels).sum()])
+
+    def compute(self) -> float:
+        '''
+        Returns the micro-F1 score (in %)
+        '''
+
+        sums = self.get_sums()
+        denominator = 2 * sums['true_positives'] + sums['false_positives'] + sums['false_negatives']
+        return 2 * sums['true_positives'] / denominator * 100.0 if denominator > 0 else 0.0
+
+
+class ConfusionMatrixAccumulator(MetricAccumulator):
+
+    def __init__(self, num_labels: int, device: torch.device = None):
+        '''
+        Counts of (gold label, predicted label) pairs of single-label predictions
+        '''
+
+        self.num_labels = num_labels
+        self.state_names = ['{}-{}'.format(i, j) for i in range(num_labels) for j in range(num_labels)]
+        super().__init__(device)
+
+    def update(self, logits: torch.Tensor, labels):
+        '''
+        logits: (batch_size, num_labels) scores of every class
+        labels: (batch_size,) gold labels (tensor or list of ints)
+        '''
+
+        labels = torch.as_tensor(labels, device=logits.device)
+        pairs = labels * self.num_labels + logits.argmax(-1)
+        counts = torch.bincount(pairs, minlength=self.num_labels ** 2)
+        if self.state is None:
+            self.device = logits.device
+            self.reset()
+        self.state += counts.to(torch.float64)
+
+    def get_matrix(self) -> torch.LongTensor:
+        '''
+        Returns the (num_labels, num_labels) confusion matrix on the CPU, where entry (i, j) counts the examples with gold label i and predicted label j
+        '''
+
+        if self.state is None:
+            return torch.zeros((self.num_labels, self.num_labels), dtype=torch.long)
+        return self.state.cpu().long().view(self.num_labels, self.num_labels)
+
+    def compute(self) -> float:
+        '''
+        Returns the accuracy (in %)
+        '''
+
+        matrix = self.get_matrix()
+        return matrix.diag().sum().item() / max(matrix.sum().item(), 1) * 100.0
@@ -0,0 +1,258 @@
+import os
+import json
+import shutil
+import hashlib
+import logging
+from collections import OrderedDict
+from typing import Iterable, List, Tuple
+
+import numpy as np
+import torch
+
+logger = logging.getLogger(__name__)
+
+def state_dict_hash(named_tensors: Iterable[Tuple[str, torch.Tensor]]) -> str:
+    '''
+    Returns a hash of (name, tensor) pairs, e.g. a module's state_dict().items() - used to key cached outputs to model weights
+    '''
+
+    sha = hashlib.sha1()
+    for name, tensor in sorted(named_tensors, key=lambda x: x[0]):
+        sha.update(name.encode('utf-8'))
+        sha.update(tensor.detach().cpu().contiguous().numpy().tobytes())
+    return sha.hexdigest()[:16]
+
+def tensors_digest(*tensors: torch.Tensor) -> str:
+    '''
+    Returns a hash of the contents (and shapes) of the given tensors, used as a cache key for model inputs
+    '''
+
+    sha = hashlib.sha1()
+    for tensor in tensors:
+        tensor = tensor.detach().cpu().contiguous()
+        sha.update(str(tuple(tensor.shape)).encode('utf-8'))
+        sha.update(tensor.numpy().tobytes())
+    return sha.hexdigest()
+
+def example_ids_digest(example_ids: List) -> str:
+    '''
+    Returns a hash of a dataset's example ids in dataset order, so that cached features are only re-used for the same examples in the same order
+    '''
+
+    sha = hashlib.sha1()
+    for example_id in example_ids:
+        sha.update(str(example_id).encode('utf-8'))
+        sha.update(b'\n')
+    return sha.hexdigest()[:16]
+
+class PersistentTensorCache:
+
+    def __init__(self, cache_dir: str, dtype=np.float16):
+        '''
+        Content-addressed cache of tensors on disk - every tensor is stored as a .npy file named by its key
+        Files are written to a temporary file and renamed, so the cache can be shared by concurrent processes
+
+        Args:
+        cache_dir: directory where tensors are stored
+        dtype: numpy dtype that tensors are stored in
+        '''
+
+        self.cache_dir = cache_dir
+        self.dtype = dtype
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+
+    def get_path(self, key: str) -> str:
+        # Keys are spread over sub-directories, to keep directory sizes manageable
+        return os.path.join(self.cache_dir, key[:2], '{}.npy'.format(key))
+
+    def get(self, key: str) -> torch.Tensor:
+        '''
+        Returns the cached tensor (in the stored dtype, on cpu), or None if key is not in the cache
+        '''
+
+        path = self.get_path(key)
+        if not os.path.exists(path):
+            return None
+        return torch.from_numpy(np.load(path))
+
+    def put(self, key: str, tensor: torch.Tensor):
+        path = self.get_path(key)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+        with open(tmp_path, 'wb') as f:
+            np.save(f, tensor.detach().float().cpu().numpy().astype(self.dtype))
+        os.replace(tmp_path, path)
+
+class LRUTensorCache:
+
+    def __init__(self, max_bytes: int):
+        '''
+        In-memory cache of tensors with a byte budget - the least recently used tensors are evicted once the budget is exceeded
+
+        Args:
+        max_bytes: maximum total size of the cached tensors
+        '''
+
+        self.max_bytes = max_bytes
+        self.num_bytes = 0
+        self.tensors = OrderedDict()
+
+    def __len__(self):
+        return len(self.tensors)
+
+    def get(self, key: str) -> torch.Tensor:
+        '''
+        Returns the cached tensor, or None if key is not in the cache
+        '''
+
+        tensor = self.tensors.get(key)
+        if tensor is not None:
+            self.tensors.move_to_end(key)
+        return tensor
+
+    def put(self, key: str, tensor: torch.Tensor):
+        tensor = tensor.detach()
+        num_bytes = tensor.numel() * tensor.element_size()
+        if num_bytes > self.max_bytes:
+            return
+        if key in self.tensors:
+            old_tensor = self.tensors.pop(key)
+            self.num_bytes -= old_tensor.numel() * old_tensor.element_size()
+        self.tensors[key] = tensor
+        self.num_bytes += num_bytes
+        while self.num_bytes > self.max_bytes:
+            _, evicted_tensor = self.tensors.popitem(last=False)
+            self.num_bytes -= evicted_tensor.numel() * evicted_tensor.element_size()
+
+class ShardedRowStore:
+
+    def __init__(self,
+                 store_dir: str,
+                 num_rows: int,
+                 segment_sizes: List[int],
+                 feature_shape: Tuple[int, ...],
+                 dtype=np.float16,
+                 shard_rows: int = 1024,
+                 fingerprint: str = ''):
+        '''
+        Fixed-size store of variable-length rows on disk, indexed by row number (e.g. a dataset index)
+        Every row holds len(segment_sizes) segments (e.g. text tokens and image tokens), each padded to its maximum size.
+        Rows are kept in preallocated .npy shards of shard_rows rows, which are memory-mapped and created on first write as sparse files,
+        and the valid length of every segment is kept in lengths.npy (all-zero lengths mark rows that have not been written yet)
+
+        Shards are created with a hard link from a temporary file, so processes that share the store never overwrite each other's shards
+
+        Args:
+        store_dir: directory of the store
+        num_rows: number of rows
+        segment_sizes: maximum length of every segment of a row
+        feature_shape: shape of every element of a segment (e.g. (hidden_size,))
+        dtype: numpy dtype that rows are stored in
+        shard_rows: number of rows per shard file
+        fingerprint: identifies the contents of the rows (e.g. a digest of the example ids) - a store with another fingerprint or layout is deleted and re-created
+        '''
+
+        self.store_dir = store_dir
+        self.num_rows = num_rows
+        self.segment_sizes = list(segment_sizes)
+        self.segment_starts = np.cumsum([0] + self.segment_sizes[:-1]).tolist()
+        self.feature_shape = tuple(feature_shape)
+        self.dtype = np.dtype(dtype)
+        self.shard_rows = shard_rows
+        self.meta = {'num_rows': num_rows,
+                     'segment_sizes': self.segment_sizes,
+                     'feature_shape': list(self.feature_shape),
+                     'dtype': self.dtype.str,
+                     'shard_rows': shard_rows,
+                     'fingerprint': fingerprint}
+
+        meta_file = os.path.join(store_dir, 'meta.json')
+        if os.path.exists(meta_file) and json.load(open(meta_file)) != self.meta:
+            logger.warning("Row store {} was created for other rows, re-creating it".format(store_dir))
+            shutil.rmtree(store_dir)
+        if not os.path.isdir(store_dir):
+            os.makedirs(store_dir, exist_ok=True)
+        if not os.path.exists(meta_file):
+            tmp_file = '{}.{}.tmp'.format(meta_file, os.getpid())
+            json.dump(self.meta, open(tmp_file, 'w'))
+            os.replace(tmp_file, meta_file)
+
+        self.lengths = None
+        self.shards = {}
+
+    def __getstate__(self):
+        # Memory maps are re-opened after unpickling
+        state = self.__dict__.copy()
+        state['lengths'] = None
+        state['shards'] = {}
+        return state
+
+    def open_memmap(self, filename: str, dtype, shape: Tuple[int, ...]) -> np.memmap:
+        '''
+        Memory-maps the .npy file filename of the store, creating it (filled with zeros) if it does not exist yet
+        '''
+
+        path = os.path.join(self.store_dir, filename)
+        if not os.path.exists(path):
+            tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+            array = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=dtype, shape=shape)
+            del array
+            try:
+                os.link(tmp_path, path)
+            except FileExistsError:
+                # Created by another process in the meantime
+                pass
+            os.remove(tmp_path)
+        return np.load(path, mmap_mode='r+')
+
+    def get_shard(self, shard_idx: int) -> np.memmap:
+        if shard_idx not in self.shards:
+            shard_rows = min(self.shard_rows, self.num_rows - shard_idx * self.shard_rows)
+            row_shape = (sum(self.segment_sizes), *self.feature_shape)
+            self.shards[shard_idx] = self.open_memmap('shard_{:05d}.npy'.format(shard_idx), self.dtype, (shard_rows, *row_shape))
+        return self.shards[shard_idx]
+
+    def get_lengths(self, rows: List[int]) -> np.ndarray:
+        '''
+        Returns the (len(rows), num_segments) segment lengths of the given rows, which are all zero for rows that have not been written yet
+        '''
+
+        if self.lengths is None:
+            self.lengths = self.open_memmap('lengths.npy', np.int32, (self.num_rows, len(self.segment_sizes)))
+        return np.array(self.lengths[rows])
+
+    def write(self, row: int, segments: List[np.ndarray]):
+        '''
+        Writes the segments of a row, each of size (length, *feature_shape) with length at most its segment size
+        Only the valid part of every segment is written, so the padding of sparse shard files takes no disk space
+        '''
+
+        lengths = [len(segment) for segment in segments]
+        assert all(0 < length <= size for length, size in zip(lengths, self.segment_sizes)), \
+            "Segment lengths {} do not fit in row store segments of size {}".format(lengths, self.segment_sizes)
+        shard_idx, offset = divmod(row, self.shard_rows)
+        shard = self.get_shard(shard_idx)
+        for segment, start in zip(segments, self.segment_starts):
+            shard[offset, start:start+len(segment)] = segment.astype(self.dtype, copy=False)
+        # Lengths are written last, so that a row is only marked as written once its contents are
+        self.get_lengths([row])
+        self.lengths[row] = lengths
+
+    def read(self, rows: List[int], widths: List[int]) -> np.ndarray:
+        '''
+        Returns the given rows as an array of size (len(rows), sum(widths), *feature_shape),
+        where every segment is cut (or zero-padded) to its width in widths
+        '''
+
+        output = np.zeros((len(rows), sum(widths), *self.feature_shape), dtype=self.dtype)
+        for i, row in enumerate(rows):
+            shard_idx, offset = divmod(row, self.shard_rows)
+            shard = self.get_shard(shard_idx)
+            output_start = 0
+            for start, size, width in zip(self.segment_starts, self.segment_sizes, widths):
+                width_in_store = min(width, size)
+                output[i, output_start:output_start+width_in_store] = shard[offset, start:start+width_in_store]
+                output_start += width
+        return output
@@ -5,7 +5,7 @@ import os
 import torch
 
 from collections import defaultdict, Counter
-from utils.word_utils import normalize_word
+from utils.word_utils import normalize_word, normalize_words
 
 def get_score(occurences):
     if occurences == 0:
@@ -19,16 +19,14 @@ def get_score(occurences):
     else:
         return 1.0
 
-def create_vqa_labels(vqa_dir):
+def create_vqa_labels(vqa_dir, num_workers=0):
 
     train_annotations = json.load(open(os.path.join(vqa_dir, 'v2_mscoco_train2014_annotations.json')))['annotations']
     val_annotations = json.load(open(os.path.join(vqa_dir, 'v2_mscoco_val2014_annotations.json')))['annotations']
 
-    all_major_answers = []
-    for anno in train_annotations:
-        all_major_answers.append(normalize_word(anno['multiple_choice_answer']))
-    for anno in val_annotations:
-        all_major_answers.append(normalize_word(anno['multiple_choice_answer']))
+    # Answers are normalized in one batch, where every distinct answer is normalized once
+    all_major_answers = [anno['multiple_choice_answer'] for anno in train_annotations + val_annotations]
+    all_major_answers = normalize_words(all_major_answers, num_workers).tolist()
     counter = {k: v for k, v in Counter(all_major_answers).items() if v >= 9}
 
     ans2label = {k: i for i, k in enumerate(counter.keys())}
@@ -52,5 +50,14 @@ def target_tensor(num_labels, labels, scores):
 
     return target
 
+def batch_target_tensor(num_labels, batch_labels, batch_scores):
+    """ create the (batch_size, num_labels) targets of a batch by the labels and scores of every example, with a single scatter into a preallocated tensor """
+    rows = [i for i, labels in enumerate(batch_labels) for _ in labels]
+    cols = [l for labels in batch_labels for l in labels]
+    target = torch.zeros(len(batch_labels), num_labels)
+    target[torch.LongTensor(rows), torch.LongTensor(cols)] = torch.tensor([s for scores in batch_scores for s in scores], dtype=target.dtype)
+
+    return target
+
 if __name__ == '__main__':
     create_vqa_labels('/people/cs/o/oxx220000/data/vqav2/')
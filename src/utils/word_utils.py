@@ -1,4 +1,8 @@
 import re
+from functools import lru_cache
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
 
 contractions = {
     "aint": "ain't",
@@ -164,21 +168,30 @@ punct = [
     "!",
 ]
 
+# Every punctuation character is either replaced with a space or deleted, so all of them are replaced with one str.translate call
+punct_space_table = str.maketrans({p: " " for p in punct})
+punct_delete_table = str.maketrans({p: None for p in punct})
+
+@lru_cache(maxsize=1 << 20)
 def normalize_word(token):
-    _token = token
-    for p in punct:
-        if (p + " " in token or " " + p in token) or (
-            re.search(comma_strip, token) != None
-        ):
-            _token = _token.replace(p, "")
-        else:
-            _token = _token.replace(p, " ")
+    # Answers are heavily repeated, so every distinct answer is normalized once
+    if re.search(comma_strip, token) != None:
+        _token = token.translate(punct_delete_table)
+    else:
+        # Punctuation next to a space is deleted, other punctuation is replaced with a space
+        spaced = [p for p in punct if p + " " in token or " " + p in token]
+        table = punct_space_table
+        if len(spaced) > 0:
+            table = dict(punct_space_table)
+            table.update({ord(p): None for p in spaced})
+        _token = token.translate(table)
+    # The third argument of sub() is the maximum number of replacements (re.UNICODE == 32)
     token = period_strip.sub("", _token, re.UNICODE)
 
     _token = []
     temp = token.lower().split()
     for word in temp:
-        word = manual_map.setdefault(word, word)
+        word = manual_map.get(word, word)
         if word not in articles:
             _token.append(word)
     for i, word in enumerate(_token):
@@ -186,4 +199,21 @@ def normalize_word(token):
             _token[i] = contractions[word]
     token = " ".join(_token)
     token = token.replace(",", "")
-    return token 
\ No newline at end of file
+    return token
+
+def normalize_words(tokens, num_workers=0):
+    """
+    Normalizes an array of answers (e.g. all answers of the VQAv2 annotations), and returns a NumPy string array of the normalized answers
+    Every distinct answer is normalized once, optionally in a pool of num_workers processes, and the results are scattered back to all answers
+    """
+    tokens = np.asarray(tokens, dtype=str)
+    if len(tokens) == 0:
+        return tokens
+    unique_tokens, inverse = np.unique(tokens, return_inverse=True)
+    unique_tokens = unique_tokens.tolist()
+    if num_workers > 0:
+        with ProcessPoolExecutor(num_workers) as executor:
+            normalized = list(executor.map(normalize_word, unique_tokens, chunksize=max(1, len(unique_tokens) // (4 * num_workers))))
+    else:
+        normalized = [normalize_word(token) for token in unique_tokens]
+    return np.array(normalized, dtype=str)[inverse]